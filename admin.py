@@ -0,0 +1,214 @@
+'''
+  admin.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import os
+import sys
+import time
+import pstats
+import signal
+import asyncio
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from helper import knxalog as log
+
+class AdminControl:
+    """ Runtime control of the daemon through a local unix socket and signals.
+        Send one command per line, e.g. with `socat - UNIX-CONNECT:knxadapter3.sock`:
+          profile [seconds]          cProfile the event loop thread
+          sample [seconds]           sample the event loop's stacks, attributed to task names
+          tracemalloc start|snapshot|stop
+          tasks                      dump all asyncio tasks with their stacks
+          reload                     apply the plugin changes of the config file
+          sync                       read the plugins' group values from LinKNX again
+        SIGUSR1 dumps the tasks, SIGUSR2 profiles for profile_seconds, SIGHUP reloads.
+        Results are written next to the config file. """
+
+    def __init__(self, daemon):
+        self.d = daemon
+        self.cfg = daemon.cfg["sys"]
+        self.out_dir = os.path.dirname(os.path.abspath(daemon.cfg_file))
+        self.profile_seconds = self.cfg.get("profile_seconds", 30)
+        self.commands = {"profile": self.profile, "sample": self.sample,
+                         "tracemalloc": self.tracemalloc, "tasks": self.dump_tasks, "reload": self.reload, "sync": self.sync}
+        self._server = None
+        self._socket_path = None
+        self._busy = False
+        self._snapshot = None
+        self._loop_thread = None
+        self._tasks = set()
+        self._files = 0
+
+    def _out_file(self, kind, ext):
+        self._files += 1
+        return os.path.join(self.out_dir, "knxadapter3-{}-{}-{}.{}".format(kind, time.strftime("%Y%m%d-%H%M%S"), self._files, ext))
+
+    def _background(self, coro):
+        task = asyncio.get_running_loop().create_task(coro, name=f"admin:{coro.__name__}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def start(self):
+        self._loop_thread = threading.get_ident()
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, lambda: self._background(self.dump_tasks()))
+            loop.add_signal_handler(signal.SIGUSR2, lambda: self._background(self.profile()))
+            loop.add_signal_handler(signal.SIGHUP, lambda: self._background(self.reload()))
+        except (NotImplementedError, AttributeError):
+            pass
+        if self.cfg.get("admin_socket"):
+            self._socket_path = os.path.join(self.out_dir, self.cfg["admin_socket"])
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
+            self._server = await asyncio.start_unix_server(self.handle, self._socket_path)
+            log.info(f"admin socket listening on {self._socket_path}")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = line.decode().split()
+                if not args:
+                    continue
+                command = self.commands.get(args[0])
+                if command:
+                    try:
+                        result = await command(*args[1:])
+                    except Exception as e:
+                        result = f"error: {e!r}"
+                else:
+                    result = "commands: " + ", ".join(sorted(self.commands))
+                writer.write((str(result) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def profile(self, seconds=None):
+        if self._busy:
+            return "profiler already running"
+        seconds = float(seconds or self.profile_seconds)
+        self._busy = True
+        profiler = cProfile.Profile()
+        log.warning(f"profiling event loop for {seconds} s")
+        try:
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self._busy = False
+        path = self._out_file("profile", "prof")
+        profiler.dump_stats(path)
+        with open(path[:-4] + "txt", "w") as f:
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(60)
+        log.warning(f"profile written to {path}")
+        return path
+
+    async def sample(self, seconds=None, interval="0.005"):
+        """ Collects the loop thread's stacks in a separate thread, written in the folded format for flamegraph tools """
+        if self._busy:
+            return "profiler already running"
+        seconds, interval = float(seconds or self.profile_seconds), float(interval)
+        loop = asyncio.get_running_loop()
+        stacks = Counter()
+        done = threading.Event()
+
+        def sampler():
+            while not done.wait(interval):
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is None:
+                    continue
+                task = asyncio.current_task(loop)
+                names = []
+                while frame:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                names.append(task.get_name() if task else "loop")
+                stacks[";".join(reversed(names))] += 1
+
+        self._busy = True
+        thread = threading.Thread(target=sampler, name="knxadapter-sampler", daemon=True)
+        log.warning(f"sampling event loop for {seconds} s")
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            done.set()
+            await loop.run_in_executor(None, thread.join)
+            self._busy = False
+        path = self._out_file("samples", "folded")
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        log.warning(f"{sum(stacks.values())} samples written to {path}")
+        return path
+
+    async def tracemalloc(self, action="snapshot", frames="1"):
+        if action == "start":
+            tracemalloc.start(int(frames))
+            self._snapshot = None
+            return "tracemalloc started"
+        if action == "stop":
+            tracemalloc.stop()
+            self._snapshot = None
+            return "tracemalloc stopped"
+        if not tracemalloc.is_tracing():
+            return "tracemalloc not started"
+        snapshot = tracemalloc.take_snapshot()
+        path = self._out_file("tracemalloc", "txt")
+        with open(path, "w") as f:
+            if self._snapshot:
+                f.write("top allocation changes since the previous snapshot:\n")
+                for stat in snapshot.compare_to(self._snapshot, "lineno")[:50]:
+                    f.write(f"{stat}\n")
+            else:
+                f.write("top allocations:\n")
+                for stat in snapshot.statistics("lineno")[:50]:
+                    f.write(f"{stat}\n")
+        self._snapshot = snapshot
+        return path
+
+    async def reload(self):
+        return await self.d.reload()
+
+    async def sync(self):
+        return "{} group values read".format(await self.d.sync_state())
+
+    async def dump_tasks(self):
+        tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+        path = self._out_file("tasks", "txt")
+        with open(path, "w") as f:
+            for task in tasks:
+                f.write(f"--- {task.get_name()} {task!r}\n")
+                task.print_stack(file=f)
+        log.warning(f"{len(tasks)} tasks dumped to {path}")
+        return path
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            if os.path.exists(self._socket_path):
+                os.unlink(self._socket_path)
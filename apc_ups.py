@@ -19,14 +19,18 @@
 '''
 
 import asyncio
+import logging
 import re
-from helper import BasePlugin, knxalog as log
+from time import monotonic
+from helper import BasePlugin, Deadband, NAN, log_ratelimited, knxalog as log
 from socket import gaierror
 
 def plugin_def():
     return ApcUps
 
 class ApcUps(BasePlugin):
+    STATUS_MAP = {"ONLINE": "true", "ONBATT": "false"}
+
     def __init__(self, daemon, cfg):
         super(ApcUps, self).__init__(daemon, cfg)
         self.ups_reader = None
@@ -35,21 +39,24 @@ class ApcUps(BasePlugin):
         for obj in self.obj_list:
             ups_expr = obj["ups_expr"]
             self.expression += ups_expr + '.*?'
-            group = obj["knx_group"]
+        self.regex = re.compile(self.expression, re.DOTALL)
         self.poll_interval = "poll_interval" in cfg and cfg["poll_interval"] or 10
+        self._poll_started = None
+        self._poll_duration = daemon.metrics.histogram("knxadapter_poll_seconds", "Duration of a plugin's poll cycle", plugin=self.device_name)
+        self.deadband = Deadband(self.obj_list, daemon.metrics.counter("knxadapter_hysteresis_suppressed_total", "Values not sent because of hysteresis", plugin=self.device_name))
 
-    async def ups_client(self, loop):
+    async def ups_client(self):
         try:
             host, port = self.cfg["host"], self.cfg["port"]
-            self.ups_reader, self.ups_writer = await asyncio.open_connection(
-                host, port, loop=loop)
+            self.ups_reader, self.ups_writer = await asyncio.open_connection(host, port)
         except gaierror as e:
             log.error(f"{self.device_name} can't connect to {host}:{port}. {e!r}")
 
     async def poll_ups(self):
         while True:
             hello = (chr(0)+chr(6)+"status").encode('ascii')
-            log.debug("{} polling APCD: {!r}".format(self.device_name, hello))
+            log.debug("%s polling APCD: %r", self.device_name, hello)
+            self._poll_started = monotonic()
             self.ups_writer.write(hello)
             await self.ups_writer.drain()
             await asyncio.sleep(self.poll_interval)
@@ -57,57 +64,43 @@ class ApcUps(BasePlugin):
     async def handle_ups(self):
         while True:
             data = await self.ups_reader.readuntil(b'\x00\x00')
-            debug_msg = []
-
             if not data:
                 break
 
             data = data.decode('ascii')
-            m = re.match(self.expression, data, re.DOTALL)
+            m = self.regex.match(data)
 
             if m:
                 group_value_dict = {}
-                for idx, o in enumerate(self.obj_list):
-                    group = o["knx_group"]
-                    val = m.groups(0)[idx]
-                    debug_line = "idx: {} group: {} val: {}".format(idx, group, val)
-                    prev_val = o["value"]
+                values = [NAN] * len(self.obj_list)
+                for i, (o, val) in enumerate(zip(self.obj_list, m.groups(0))):
                     try:
-                        value = float(val)
-                        debug_line += " numeric value: {0:g}".format(value)
-                        hysteresis = o["hysteresis"]
-                        if type(hysteresis) == str and "%" in hysteresis and abs(value - prev_val) <= float(hysteresis.strip('%'))*value*0.01 or type(hysteresis) == float and abs(value - prev_val) <= hysteresis:
-                            debug_msg.append("{}-{:g} < {:g} hysteresis, ignored!".format(debug_line, prev_val, hysteresis))
-                            continue
-                        elif prev_val == value:
-                            debug_msg.append("{} unchanged, ignored!".format(debug_line))
-                            continue
-                        group_value_dict[group] = "%.2f" % value
-
+                        values[i] = float(val)
                     except ValueError:
-                        if val == "ONLINE":
-                            value = "true"
-                        elif val == "ONBATT":
-                            value = "false"
-                        debug_line += " non-numeric value: ->{}".format(value)
-                        if prev_val == value:
-                            debug_msg.append("{} unchanged, ignored!".format(debug_line))
-                            continue
-                        group_value_dict[group] = value
+                        value = self.STATUS_MAP.get(val, val)
+                        if o.value != value:
+                            group_value_dict[o.knx_group] = value
+                            o.value = value
 
-                    o["value"] = value
-                    debug_msg.append(debug_line)
+                group_value_dict.update(self.deadband.evaluate(values))
+                log.debug("%s %r\n\tchanged: %r", self.device_name, data, group_value_dict)
 
-                log.debug("{} {!r}\t".format(self.device_name, data)+"\n\t".join(debug_msg))
+                if self._poll_started:
+                    self._poll_duration.observe(monotonic() - self._poll_started)
+                    self._poll_started = None
 
                 if group_value_dict:
                     await self.d.set_group_value_dict(group_value_dict)
 
             else:
-                log.warning("{} Couldn't parse {!r}".format(self.device_name, data))
+                log_ratelimited((self.device_name, "parse"), logging.WARNING, "%s Couldn't parse %r", self.device_name, data)
+
+    async def connect(self):
+        await self.ups_client()
+        if not self.ups_reader:
+            raise ConnectionError(f"{self.device_name} apcupsd not reachable")
 
     def _run(self):
-        self.client = self.d.loop.run_until_complete(self.ups_client(self.d.loop))
         if self.ups_reader and self.ups_writer:
             poll_task = self.d.loop.create_task(self.poll_ups())
             return [self.handle_ups(), poll_task]
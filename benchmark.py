@@ -0,0 +1,330 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+  benchmark.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+# Offline micro-benchmarks of the per-message parsing and change detection paths of the plugins.
+#   benchmark.py                                run all cases
+#   benchmark.py --baseline FILE                run all cases and compare them with the baseline in FILE
+#   benchmark.py --baseline FILE --save         run all cases and store the results as the new baseline
+#   benchmark.py -k apc pioneer  run only the cases whose name contains one of the words
+# Each case reports operations per second (best of --repeat runs), the peak memory traced
+# while handling a single message and the memory blocks still allocated per message
+# afterwards, which should stay at 0. Cases whose plugin dependencies aren't installed are skipped.
+# Baselines depend on the machine and python version, compare them on the same host only.
+
+import gc
+import os
+import logging
+import sys
+import json
+import struct
+import asyncio
+import argparse
+import platform
+import tracemalloc
+from time import perf_counter
+from collections import namedtuple
+from importlib import import_module
+from helper import setLogLevel
+from metrics import Metrics
+
+class BenchDaemon:
+    """ What a plugin sees as its daemon, swallows the group values """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.cfg = {"sys": {"listenHost": "127.0.0.1"}}
+        self.knx_read_cbs = []
+        self.value_direct_cbs = []
+        self.metrics = Metrics(enabled=False)
+        self.written = 0
+
+    async def set_group_value_dict(self, group_value_dict, process_direct=True):
+        self.written += len(group_value_dict)
+
+def make_plugin(daemon, module, cfg):
+    cfg.setdefault("enabled", True)
+    for obj in cfg["objects"]:
+        obj.setdefault("enabled", True)
+    return import_module(module).plugin_def()(daemon, cfg)
+
+def stream_reader(chunks, n):
+    """ A StreamReader already holding n messages, cycling through chunks, followed by EOF """
+    reader = asyncio.StreamReader(limit=2**24)
+    reader.feed_data(b"".join(chunks[i % len(chunks)] for i in range(n)))
+    reader.feed_eof()
+    return reader
+
+# Every case takes the daemon and returns run(n), which returns a coroutine handling n messages.
+# Messages alternate between values so that both the update and the hysteresis paths are taken.
+
+def bench_weather(daemon):
+    sensors = (("indoortempf", "F_to_C", 0.2), ("tempf", "F_to_C", 0.2), ("dewptf", "F_to_C", 0.2),
+               ("windchillf", "F_to_C", 0.2), ("indoorhumidity", False, 1.2), ("humidity", False, 1.0),
+               ("windspeedmph", "mph_to_kmh", 1.0), ("windgustmph", "mph_to_kmh", 1.0), ("winddir", False, 5.0),
+               ("absbaromin", "inHg_to_hPa", 0.5), ("baromin", "inHg_to_hPa", 0.5), ("rainin", "inch_to_mm", 0.1),
+               ("dailyrainin", "inch_to_mm", 0.1), ("solarradiation", False, 5.0), ("UV", False, 1.0))
+    objects = [{"sensor": s, "knx_group": f"sensors:weather:{s}", "conversion": c, "hysteresis": h} for s, c, h in sensors]
+    plugin = make_plugin(daemon, "weather_station", {"name": "WH2601", "listenPort": 8084, "objects": objects})
+    base = {"ID": "bench", "PASSWORD": "secret", "action": "updateraw", "realtime": "1", "rtfreq": "5",
+            "dateutc": "2021-03-01 12:00:00", "softwaretype": "WH2600GEN_V2.2.8"}
+    queries = []
+    for step in (0.0, 0.3, 0.1, 2.5):
+        query = dict(base)
+        query.update({"indoortempf": f"{71.2 + step:.1f}", "tempf": f"{45.3 - step:.1f}", "dewptf": f"{38.1 + step:.1f}",
+                      "windchillf": f"{43.0 - step:.1f}", "indoorhumidity": f"{41 + int(step * 2)}", "humidity": f"{78 - int(step)}",
+                      "windspeedmph": f"{4.5 + step:.1f}", "windgustmph": f"{6.9 + step:.1f}", "winddir": f"{220 + int(step * 10)}",
+                      "absbaromin": f"{29.62 + step / 10:.2f}", "baromin": f"{30.01 + step / 10:.2f}", "rainin": "0.00",
+                      "dailyrainin": f"{0.12 + step / 10:.2f}", "solarradiation": f"{412.5 + step * 30:.2f}", "UV": f"{int(step)}"})
+        queries.append(query)
+
+    async def run(n):
+        for i in range(n):
+            await plugin.process_values(queries[i % len(queries)])
+
+    return run
+
+def bench_apc(daemon):
+    exprs = ("STATUS *: (\\w*)", "LINEV *: ([0-9.]*) Volts", "BCHARGE  : ([0-9.]*) Percent",
+             "BATTV *: ([0-9.]*) Volts", "LINEFREQ : ([0-9.]*) Hz")
+    objects = [{"ups_expr": e, "knx_group": f"sensors:ups:{i}", "hysteresis": 0.2} for i, e in enumerate(exprs)]
+    objects[0].pop("hysteresis")
+    plugin = make_plugin(daemon, "apc_ups", {"name": "SmartUPS 750", "host": "localhost", "port": 3551, "objects": objects})
+    blocks = []
+    for status, linev, bcharge, linefreq in (("ONLINE", "230.4", "100.0", "50.0"), ("ONLINE", "230.5", "100.0", "50.0"),
+                                             ("ONBATT", "0.0", "98.0", "0.0"), ("ONLINE", "228.9", "99.0", "49.9")):
+        lines = ("APC      : 001,036,0887", "DATE     : 2021-03-01 12:00:00 +0100", "HOSTNAME : tichy",
+                 "VERSION  : 3.14.14 (31 May 2016) debian", "UPSNAME  : SmartUPS", "CABLE    : USB Cable",
+                 "DRIVER   : USB UPS Driver", "UPSMODE  : Stand Alone", "STARTTIME: 2021-02-20 08:13:10 +0100",
+                 "MODEL    : Smart-UPS 750", f"STATUS   : {status} ", f"LINEV    : {linev} Volts",
+                 "LOADPCT  : 17.5 Percent", f"BCHARGE  : {bcharge} Percent", "TIMELEFT : 48.0 Minutes",
+                 "MBATTCHG : 5 Percent", "MINTIMEL : 3 Minutes", "MAXTIME  : 0 Seconds", "OUTPUTV  : 230.4 Volts",
+                 "SENSE    : High", "DWAKE    : 0 Seconds", "DSHUTD   : 180 Seconds", "LOTRANS  : 208.0 Volts",
+                 "HITRANS  : 253.0 Volts", "RETPCT   : 0.0 Percent", "ITEMP    : 29.2 C", "ALARMDEL : 30 Seconds",
+                 "BATTV    : 27.3 Volts", f"LINEFREQ : {linefreq} Hz", "LASTXFER : Unacceptable line voltage changes",
+                 "NUMXFERS : 2", "TONBATT  : 0 Seconds", "CUMONBATT: 12 Seconds", "XOFFBATT : N/A",
+                 "SELFTEST : NO", "STATFLAG : 0x05000008", "SERIALNO : AS1234567890", "BATTDATE : 2019-05-02",
+                 "NOMOUTVOLT: 230 Volts", "NOMBATTV : 24.0 Volts", "FIRMWARE : UPS 09.3 / ID=18",
+                 "END APC  : 2021-03-01 12:00:01 +0100")
+        # the network information server prefixes every line with its length and ends with an empty record
+        blocks.append(b"".join(len(l + "\n").to_bytes(2, "big") + (l + "\n").encode("ascii") for l in lines) + b"\x00\x00")
+
+    def run(n):
+        plugin.ups_reader = stream_reader(blocks, n)
+        return plugin.handle_ups()
+
+    return run
+
+Message = namedtuple("Message", ("topic", "payload"))
+
+class Messages:
+    def __init__(self, messages, n):
+        self.messages = messages
+        self.n = n
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.n == 0:
+            raise StopAsyncIteration
+        self.n -= 1
+        return self.messages[self.n % len(self.messages)]
+
+def bench_mqtt(daemon):
+    objects = [{"topic": "openWB/lp/1/W", "knx_group": "other:wallbox:charge_power"},
+               {"topic": "openWB/lp/1/ChargeStatus", "knx_group": "other:wallbox:charge_status"},
+               {"topic": "openWB/global/ChargeMode", "publish_topic": "openWB/set/ChargeMode", "knx_group": "other:wallbox:charge_mode"},
+               {"topic": "shellies/plug/status", "knx_group": "sensors:plug:power", "valmap": {"apower": None}},
+               {"topic": "shellies/plug/status", "knx_group": "sensors:plug:switch", "valmap": {"output": {True: "on", False: "off"}}},
+               {"topic": "zigbee2mqtt/window", "knx_group": "sensors:window:contact", "valmap": {"contact": {True: "closed", False: "open"}}}]
+    plugin = make_plugin(daemon, "mqtt", {"name": "openWB", "host": "localhost", "port": 1883, "user": "", "pass": "", "objects": objects})
+    messages = []
+    for i in range(4):
+        messages += [Message("openWB/lp/1/W", f"{3680 + i * 230}".encode()),
+                     Message("openWB/lp/1/ChargeStatus", f"{i % 2}".encode()),
+                     Message("openWB/global/ChargeMode", b"2"),
+                     Message("shellies/plug/status", json.dumps({"id": 0, "source": "timer", "output": i % 2 == 0,
+                         "apower": 12.3 + i, "voltage": 231.2, "current": 0.07, "aenergy": {"total": 2034.1 + i}}).encode()),
+                     Message("zigbee2mqtt/window", json.dumps({"battery": 100, "contact": i < 2, "linkquality": 72,
+                         "voltage": 3025}).encode()),
+                     Message("zigbee2mqtt/unknown", b"ignored")]
+
+    def run(n):
+        return plugin.mqtt_handle(Messages(messages, n), None)
+
+    return run
+
+def bench_pioneer(daemon):
+    objects = [{"avr_object": "power", "knx_group": "other:homecinema:avr_power"},
+               {"avr_object": "fn", "knx_group": "other:homecinema:avr_input"},
+               {"avr_object": "volume", "knx_group": "other:homecinema:avr_volume"},
+               {"avr_object": "display_text", "knx_group": "other:homecinema:avr_title"}]
+    plugin = make_plugin(daemon, "pioneer_avr", {"name": "VSX-2020", "host": "localhost", "port": 8102, "objects": objects})
+    # the front display scrolls the title through a 14 character window, a blank window ends it
+    text = "              Radio Paradise - Mellow Mix - Nick Drake - Pink Moon              "
+    lines = [f"FL02{text[i:i + 14].encode('iso8859_15').hex().upper()}\r\n".encode("ascii") for i in range(len(text) - 13)]
+    lines.append(b"FL022020202020202020202020202020\r\n")
+    lines += [b"VOL121\r\n", b"VOL123\r\n", b"FN19\r\n"]
+
+    def run(n):
+        plugin.accu_word = None
+        plugin.avr_reader = stream_reader(lines, n)
+        return plugin.handle_avr()
+
+    return run
+
+def bench_onkyo(daemon):
+    onkyo = import_module("eiscp").core
+    objects = [{"avr_object": "system-power", "avr_zone": "main", "knx_group": "other:homecinema:avr_power"},
+               {"avr_object": "source", "avr_zone": "main", "knx_group": "other:homecinema:avr_input"},
+               {"avr_object": "master-volume", "avr_zone": "main", "knx_group": "other:homecinema:avr_volume"}]
+    plugin = make_plugin(daemon, "onkyo_avr", {"name": "VSX-LX305", "host": "localhost", "port": 60128, "objects": objects})
+    packets = [onkyo.command_to_packet(c) for c in ("PWR01", "MVL28", "MVL2A", "SLI10", "MVL2A", "SLI2B", "NTM00:01:23/00:04:56")]
+
+    def run(n):
+        plugin.avr_reader = stream_reader(packets, n)
+        return plugin.handle_avr()
+
+    return run
+
+def bench_modbus(daemon):
+    objects = [{"register": r, "knx_group": f"sensors:photovoltaic:{r}", "data_type": "U32"} for r in range(0, 40, 2)]
+    for obj in objects[::4]:
+        obj["hysteresis"] = 0.2
+    plugin = make_plugin(daemon, "modbus_device", {"name": "Kostal Smart Energy Meter", "host": "localhost", "port": 502,
+        "default_hysteresis": "1.0%", "default_magnitude": 0.1, "default_precision": 1, "modbus_wordorder": "BE", "objects": objects})
+    cycles = [[12000 + (i * 37 + step * 151) % 900 for i in range(len(plugin.obj_list))] for step in range(4)]
+
+    async def run(n):
+        for i in range(n):
+            plugin.process_readings(cycles[i % len(cycles)])
+
+    return run
+
+CASES = {"weather_station.process_values": bench_weather,
+         "apc_ups.handle_ups": bench_apc,
+         "mqtt.mqtt_handle": bench_mqtt,
+         "pioneer_avr.handle_avr": bench_pioneer,
+         "onkyo_avr.handle_avr": bench_onkyo,
+         "modbus_device.process_readings": bench_modbus}
+
+def execute(loop, coro):
+    """ Runs a case's coroutine, returns the seconds it took """
+    started = perf_counter()
+    try:
+        loop.run_until_complete(coro)
+    except (asyncio.IncompleteReadError, AssertionError, struct.error):
+        # stream based cases end with EOF
+        pass
+    return perf_counter() - started
+
+def measure(loop, run, min_time, repeat):
+    n = 1
+    while execute(loop, run(n)) < min_time / 10:
+        n *= 4
+    elapsed = execute(loop, run(n))
+    n = max(1, int(n * min_time / max(elapsed, 1e-9)))
+    ops = max(n / execute(loop, run(n)) for _ in range(repeat))
+
+    gc.collect()
+    tracemalloc.start()
+    peak = None
+    for _ in range(5):
+        coro = run(1)
+        tracemalloc.reset_peak()
+        traced = tracemalloc.get_traced_memory()[0]
+        execute(loop, coro)
+        used = tracemalloc.get_traced_memory()[1] - traced
+        peak = used if peak is None else min(peak, used)
+    tracemalloc.stop()
+
+    coro = run(n)
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    execute(loop, coro)
+    del coro
+    gc.collect()
+    retained = (sys.getallocatedblocks() - blocks) / n
+    return {"ops": round(ops, 1), "peak_bytes": peak, "retained_blocks": round(retained, 3) or 0.0}
+
+def main():
+    parser = argparse.ArgumentParser(description="knxadapter3 hot path micro-benchmarks")
+    parser.add_argument("-k", nargs="*", default=[], help="only run cases whose name contains one of these words")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline, needs --baseline")
+    parser.add_argument("--baseline", help="baseline file to compare with, or to write with --save")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown reported as regression (default %(default)s)")
+    parser.add_argument("--time", type=float, default=0.5, help="seconds per measurement (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per case, the best is kept (default %(default)s)")
+    args = parser.parse_args()
+    if args.save and not args.baseline:
+        parser.error("--save needs --baseline")
+    setLogLevel("error")
+    logging.getLogger("asyncio").setLevel(logging.ERROR)
+
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if baseline and baseline.get("python") != platform.python_version():
+        print(f"baseline was taken with python {baseline.get('python')}, results may not be comparable")
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    daemon = BenchDaemon(loop)
+    results = {}
+    regressions = []
+    print(f"{'case':34} {'ops/s':>12} {'peak B/op':>10} {'retained/op':>12}  vs baseline")
+    for name, case in CASES.items():
+        if args.k and not any(word in name for word in args.k):
+            continue
+        try:
+            run = case(daemon)
+        except ImportError as e:
+            print(f"{name:34} skipped, {e}")
+            continue
+        result = results[name] = measure(loop, run, args.time, args.repeat)
+        compared = ""
+        previous = baseline.get("cases", {}).get(name)
+        if previous:
+            change = result["ops"] / previous["ops"] - 1
+            compared = f"{change:+.1%}"
+            if change < -args.threshold:
+                compared += " REGRESSION"
+                regressions.append(name)
+            if result["peak_bytes"] > previous["peak_bytes"] * (1 + args.threshold) + 64:
+                compared += f" peak memory was {previous['peak_bytes']} B"
+                regressions.append(name)
+        print(f"{name:34} {result['ops']:>12,.0f} {result['peak_bytes']:>10} {result['retained_blocks']:>12}  {compared}")
+    loop.close()
+
+    if args.save:
+        cases = baseline.get("cases", {}) if args.k else {}
+        cases.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "cases": cases}, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+    elif regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
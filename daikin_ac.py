@@ -20,7 +20,8 @@
 
 import asyncio
 import logging
-from helper import BasePlugin, knxalog as log
+from time import monotonic
+from helper import BasePlugin, log_ratelimited, knxalog as log
 from daikinapi import Daikin
 from requests import ConnectionError
 
@@ -28,19 +29,27 @@ def plugin_def():
     return DaikinAC
 
 class DaikinAC(BasePlugin):
+    # the Daikin client isn't thread-safe, polls and writes take turns
+    executor_workers = 1
+
     def __init__(self, daemon, cfg):
         super(DaikinAC, self).__init__(daemon, cfg)
         daemon.knx_read_cbs.append(self.process_knx)
         self.poll_interval = "poll_interval" in cfg and cfg["poll_interval"] or 10
-        for obj in cfg["objects"]:
-            if obj["enabled"]:
-                obj.update({"value": None})
-        log.debug("{} obj_list: {!r}".format(self.device_name, self.obj_list))
+        self._poll_duration = daemon.metrics.histogram("knxadapter_poll_seconds", "Duration of a plugin's poll cycle", plugin=self.device_name)
+        for obj in self.obj_list:
+            obj.value = None
+        log.debug("%s obj_list: %r", self.device_name, self.obj_list)
 
     async def handle_ac(self):
-        log_msg = []
+        skipped = []
         while True:
-            self._client.receive_info()
+            started = monotonic()
+            try:
+                await self.run_blocking(self._client.receive_info)
+            except asyncio.TimeoutError:
+                await asyncio.sleep(self.poll_interval)
+                continue
             group_value_dict = {}
 
             for o in self.obj_list:
@@ -56,22 +65,23 @@ class DaikinAC(BasePlugin):
                 except KeyError:
                     continue
                 except ValueError as e:
-                    log.debug("{} {!r} on key {}".format(self.device_name, e, ac_obj))
+                    log.debug("%s %r on key %s", self.device_name, e, ac_obj)
                     continue
 
-                if value == o["value"]:
-                    log_msg.append("{!r}: {!r}".format(ac_obj, value))
+                if value == o.value:
+                    skipped.append((ac_obj, value))
                     continue
 
-                group_value_dict[o["knx_group"]] = str(value)
-                o["value"] = value
+                group_value_dict[o.knx_group] = str(value)
+                o.value = value
 
+            self._poll_duration.observe(monotonic() - started)
             if group_value_dict:
                 await self.d.set_group_value_dict(group_value_dict)
 
-            if log_msg:
-                log.debug(self.device_name+" skipped objects: "+', '.join(log_msg))
-                log_msg = []
+            if skipped:
+                log.debug("%s skipped objects: %r", self.device_name, skipped)
+                skipped = []
 
             await asyncio.sleep(self.poll_interval)
 
@@ -87,7 +97,7 @@ class DaikinAC(BasePlugin):
             try:
                 ac_obj = self.get_obj_by_knxgrp(knx_grp)["ac_object"]
             except StopIteration:
-                log.debug("{} no AC object for given KNX group, ignored".format(debug_msg))
+                log.debug("%s no AC object for given KNX group, ignored", debug_msg)
                 return True
 
             if ac_obj == "fan_rate":
@@ -103,11 +113,14 @@ class DaikinAC(BasePlugin):
                 value = raw
 
             if str(value) == str(self._get_value_by_acobj(ac_obj)):
-                log.debug("{} ac_obj {} unchanged value {}->{}, ignored!".format(debug_msg, ac_obj, str(self._get_value_by_acobj(ac_obj)), str(value)))
+                log.debug("%s ac_obj %s unchanged value %s, ignored!", debug_msg, ac_obj, value)
                 return True
 
-            log.debug("{} ac_obj {} updated value {}=>{}".format(debug_msg, ac_obj, self._get_value_by_acobj(ac_obj), value))
-            setattr(self._client, ac_obj, value)
+            log.debug("%s ac_obj %s updated value %s=>%s", debug_msg, ac_obj, self._get_value_by_acobj(ac_obj), value)
+            try:
+                await self.run_blocking(setattr, self._client, ac_obj, value)
+            except asyncio.TimeoutError:
+                log.warning("{} ac_obj {} couldn't be set to {}".format(debug_msg, ac_obj, value))
             return True
 
         except:
@@ -127,11 +140,11 @@ class DaikinAC(BasePlugin):
             def receive_info(self):
                 try:
                     self._cached_ctrl_fields = self._get("/aircon/get_control_info")
-                    log.debug("Daikin AC Control Fields {!r}".format(self._cached_ctrl_fields))
+                    log.debug("Daikin AC Control Fields %r", self._cached_ctrl_fields)
                     self._cached_sens_fields = self._get("/aircon/get_sensor_info")
-                    log.debug("Daikin AC Sensor Fields {!r}".format(self._cached_sens_fields))
+                    log.debug("Daikin AC Sensor Fields %r", self._cached_sens_fields)
                 except ConnectionError as e:
-                    log.warning("Daikin AC Couldn't perform API read {!r}".format(e))
+                    log_ratelimited(("daikin", "read"), logging.WARNING, "Daikin AC Couldn't perform API read %r", e)
 
             def _get_control(self, all_fields=False):
                 """ Replacement for daikinapi function to operate on cached control info """
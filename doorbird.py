@@ -35,7 +35,7 @@ class Doorbird(BasePlugin):
 
     async def handle(self, request):
         query = request.rel_url.query
-        log.debug(f"{self.device_name} handle: {query!r}")
+        log.debug("%s handle: %r", self.device_name, query)
         if "toggle" in query:
             if not "key" in query:
                 log.warning(f"{self.device_name} no FOB key given when handling {query!r}!")
@@ -71,25 +71,33 @@ class Doorbird(BasePlugin):
     async def process_direct(self, knx_group, value):
         try:
             o = self.get_obj_by_knxgrp(knx_group)
-            log.debug(f"{self.device_name} update internal state knx_group={knx_group} value={value}")
+            log.debug("%s update internal state knx_group=%s value=%s", self.device_name, knx_group, value)
             o["value"] = value
         except StopIteration:
             return
 
-    def run(self):
-        if self.cfg["enabled"]:
-            self.doorbird_app = web.Application(debug=True)
-            self.doorbird_app.router.add_get('/doorbird/{name}', self.handle)
-            self.doorbird_handler = self.doorbird_app.make_handler()
-            log.info(f"{self.device_name} running doorbird endpoint...")
-            doorbird_coro = self.d.loop.create_server(self.doorbird_handler, self.d.cfg["sys"]["listenHost"], self.cfg["listenPort"])
-            self.doorbird_server = self.d.loop.run_until_complete(doorbird_coro)
-            return None
+    def restore_state(self, values):
+        # the lock state as it's on the bus, until the first update arrives
+        for o in self.obj_list:
+            if o.knx_group in values:
+                o.value = values[o.knx_group]
 
-    def quit(self):
+    async def connect(self):
+        self.doorbird_app = web.Application(debug=True)
+        self.doorbird_app.router.add_get('/doorbird/{name}', self.handle)
+        self.doorbird_handler = self.doorbird_app.make_handler()
+        log.info(f"{self.device_name} running doorbird endpoint...")
+        self.doorbird_server = await self.d.loop.create_server(self.doorbird_handler, self.d.cfg["sys"]["listenHost"], self.cfg["listenPort"])
+
+    async def stop(self):
         if self.doorbird_server:
             log.info(f"{self.device_name} quit doorbird endpoint...")
             self.doorbird_server.close()
-            self.d.loop.run_until_complete(self.doorbird_app.shutdown())
-            self.d.loop.run_until_complete(self.doorbird_handler.shutdown(2.0))
-            self.d.loop.run_until_complete(self.doorbird_app.cleanup())
+            self.doorbird_server = None
+            await self.doorbird_app.shutdown()
+            await self.doorbird_handler.shutdown(2.0)
+            await self.doorbird_app.cleanup()
+
+    def quit(self):
+        if self.doorbird_server:
+            self.d.loop.run_until_complete(self.stop())
@@ -64,7 +64,7 @@ class gpio(BasePlugin):
                                 log.debug(f"{self.device_name} init. on value change to '{value}', call='{actioncbname}' for {o!r}")
                         else:
                             log.warning(f"{self.device_name} init illegal action '{actioncbname}' for {gpio_obj!r}")
-        log.debug("{} obj_list: {!r}".format(self.device_name, self.obj_list))
+        log.debug("%s obj_list: %r", self.device_name, self.obj_list)
 
     def gpio_action(self, evt, group, value):
         asyncio.run_coroutine_threadsafe(self.handle_gpio(group, value), self.d.loop).result()
@@ -73,14 +73,14 @@ class gpio(BasePlugin):
         await self.d.set_group_value_dict({group: value})
 
     def _get_output_obj_by_knxgrp_and_value(self, knx_group, value):
-        for item in self.obj_list:
-            if item["knx_group"] == knx_group and item["gpio_direction"] == self.GPIO_DIRECTION_OUTPUT:
+        for item in self.get_objs_by_knxgrp(knx_group):
+            if item.get("gpio_direction") == self.GPIO_DIRECTION_OUTPUT:
                 if value in item["actions"]:
                     return item
         return None
 
     async def process_direct(self, group, value):
-        log.debug(f"{self.device_name} process_direct(group={group}, value={value})")
+        log.debug("%s process_direct(group=%s, value=%s)", self.device_name, group, value)
         try:
             o = self._get_output_obj_by_knxgrp_and_value(group, value)
             if o:
@@ -94,7 +94,7 @@ class gpio(BasePlugin):
         try:
             knx_grp, raw = cmd.split("=")
             value = raw.strip()
-            log.debug(f"{self.device_name} process_knx(group={knx_grp}, value={value})")
+            log.debug("%s process_knx(group=%s, value=%s)", self.device_name, knx_grp, value)
             o = self._get_output_obj_by_knxgrp_and_value(knx_grp, value)
             if o:
                 await self.set_gpio(o, value)
@@ -105,7 +105,7 @@ class gpio(BasePlugin):
             return False
 
     async def set_gpio(self, o, value):
-        log.debug(f"{self.device_name} set_gpio({o!r}, {value})")
+        log.debug("%s set_gpio(%r, %s)", self.device_name, o, value)
         try:
             gpio_obj = o["gpio_object"]
             prev_value = gpio_obj.value
@@ -18,14 +18,46 @@
   USA.
 '''
 
+import json
+import queue
+import atexit
+import asyncio
 import logging
+import logging.handlers
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, partial
 from sys import stderr
+from time import monotonic
 
+NAN = float("nan")
+INF = float("inf")
+
+class JsonFormatter(logging.Formatter):
+    """ One compact JSON object per log record """
+    def format(self, record):
+        return json.dumps({"time": round(record.created, 3), "level": record.levelname,
+                           "logger": record.name, "message": record.getMessage()}, separators=(",", ":"))
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """ Enqueues records as they are, the stock prepare() would already merge msg % args and
+        format the traceback on the caller's thread. The queue never leaves the process, so
+        nothing needs to be picklable; arguments are rendered when the listener gets to them. """
+    def prepare(self, record):
+        return record
+
+# records are handed to a queue on the event loop, a listener thread formats and writes them
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler(stderr)
+_log_output.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+_log_input = _RecordQueueHandler(_log_queue)
 logging.basicConfig(
     level=logging.DEBUG,
-    format='%(levelname)s: %(message)s',
-    stream=stderr,
+    handlers=[_log_input],
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 knxalog = logging.getLogger(__name__)
 def log_async_exception(fun):
@@ -43,20 +75,366 @@ def setLogLevel(v):
     level = v in levels and levels[v] or logging.CRITICAL
     knxalog.setLevel(level)
 
+def setLogFormat(log_format):
+    """ "text" (default) or "json" lines """
+    if log_format == "json":
+        _log_output.setFormatter(JsonFormatter())
+    elif log_format not in (None, "text"):
+        knxalog.warning("unknown log_format %r, using text", log_format)
+
+_ratelimited = {}
+
+def log_ratelimited(key, level, msg, *args, interval=60.0):
+    """ Logs msg at most once every interval seconds per key, e.g. for a device which keeps
+        failing on every poll, and tells how many were left out in between """
+    if not knxalog.isEnabledFor(level):
+        return
+    now = monotonic()
+    last, suppressed, _ = _ratelimited.get(key, (None, 0, interval))
+    if last is not None and now - last < interval:
+        _ratelimited[key] = (last, suppressed + 1, interval)
+        return
+    if last is None:
+        # keys may carry a device or group name, forget the ones whose window has passed
+        for stale in [k for k, (t, _, i) in _ratelimited.items() if now - t >= i]:
+            del _ratelimited[stale]
+    _ratelimited[key] = (now, 0, interval)
+    if suppressed:
+        msg += " (%d more since the last one)"
+        args += (suppressed,)
+    knxalog.log(level, msg, *args)
+
+def new_event_loop(kind=None):
+    """ Creates the event loop configured as sys.event_loop, "asyncio" (default) or "uvloop",
+        falls back to asyncio's loop when uvloop isn't installed """
+    if kind == "uvloop":
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            knxalog.warning("uvloop isn't installed, using the asyncio event loop")
+    elif kind not in (None, "asyncio"):
+        knxalog.warning(f"unknown event_loop {kind!r}, using the asyncio event loop")
+    return asyncio.new_event_loop()
+
+class CallbackQueue:
+    """ Bounded queue with its own worker task feeding (group, value) updates to one consumer,
+        so a slow consumer doesn't hold up the producer. When full, the overflow policy either
+        drops the oldest update, coalesces updates per group or blocks the producer. """
+    POLICIES = ("drop_oldest", "coalesce", "block")
+
+    def __init__(self, callback, name, maxsize=100, policy="coalesce"):
+        if policy not in self.POLICIES:
+            knxalog.warning(f"{name} unknown overflow policy {policy!r}, using 'coalesce'")
+            policy = "coalesce"
+        self.callback = callback
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self._items = OrderedDict() if policy == "coalesce" else deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._worker = None
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    async def put(self, group, value):
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._work(), name=f"direct:{self.name}")
+        items = self._items
+        if self.policy == "coalesce":
+            if group in items:
+                items[group] = (value, items[group][1])
+                self.coalesced += 1
+                return
+            if len(items) >= self.maxsize:
+                items.popitem(last=False)
+                self.dropped += 1
+            items[group] = (value, monotonic())
+        else:
+            while self.policy == "block" and len(items) >= self.maxsize:
+                self._space.clear()
+                await self._space.wait()
+            if len(items) >= self.maxsize:
+                items.popleft()
+                self.dropped += 1
+            items.append((group, value, monotonic()))
+        self._ready.set()
+
+    def _pop(self):
+        if self.policy == "coalesce":
+            group, (value, queued) = self._items.popitem(last=False)
+        else:
+            group, value, queued = self._items.popleft()
+        self._space.set()
+        return group, value, queued
+
+    async def _work(self):
+        while True:
+            if not self._items:
+                self._ready.clear()
+                await self._ready.wait()
+            group, value, queued = self._pop()
+            self.lag = monotonic() - queued
+            self.max_lag = max(self.max_lag, self.lag)
+            try:
+                await self.callback(group, value)
+            except Exception:
+                knxalog.exception(f"{self.name} failed to process {group}={value}")
+            self.processed += 1
+
+    def stats(self):
+        return {"depth": self.depth, "lag": round(self.lag, 4), "max_lag": round(self.max_lag, 4),
+                "processed": self.processed, "dropped": self.dropped, "coalesced": self.coalesced}
+
+    def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+
+class GroupCache:
+    """ The last value written to or received from each group address, compared as sent on the
+        wire. filter() drops writes which wouldn't change a group, with a refresh_interval an
+        unchanged value is sent again once the last one is older than that many seconds.
+        Groups in exclude, e.g. pulse-like door openers, are always sent. """
+
+    def __init__(self, refresh_interval=0, exclude=()):
+        self.refresh_interval = refresh_interval
+        self.exclude = set(exclude)
+        self.values = {}
+        self.sent_at = {}
+        self.dropped = 0
+        # counts value changes, e.g. to tell whether a snapshot is out of date
+        self.generation = 0
+
+    def get(self, group, default=None):
+        return self.values.get(group, default)
+
+    def update(self, group, value, now=None):
+        """ Records a value which reached the bus some other way, e.g. an inbound LinKNX command """
+        wire = str(value)
+        if self.values.get(group) != wire:
+            self.values[group] = wire
+            self.generation += 1
+        self.sent_at[group] = monotonic() if now is None else now
+
+    def filter(self, group_value_dict, now=None):
+        """ Returns the writes of group_value_dict which change their group and records them """
+        now = monotonic() if now is None else now
+        values, sent_at = self.values, self.sent_at
+        changed = {}
+        for group, value in group_value_dict.items():
+            wire = str(value)
+            if values.get(group) == wire and group not in self.exclude:
+                if not self.refresh_interval or now - sent_at[group] < self.refresh_interval:
+                    self.dropped += 1
+                    continue
+            values[group] = wire
+            sent_at[group] = now
+            changed[group] = value
+        if changed:
+            self.generation += 1
+        return changed
+
+    def invalidate(self, groups):
+        """ Forgets groups whose write failed, so the next write of the same value goes out """
+        for group in groups:
+            self.values.pop(group, None)
+            self.sent_at.pop(group, None)
+        self.generation += 1
+
+def parse_hysteresis(hysteresis):
+    """ Returns (threshold, relative), "1.5%" is relative to the new value, numbers are absolute """
+    if isinstance(hysteresis, str):
+        hysteresis = hysteresis.strip()
+        if hysteresis.endswith("%"):
+            return float(hysteresis[:-1]) * 0.01, True
+        return float(hysteresis), False
+    if isinstance(hysteresis, (int, float)) and not isinstance(hysteresis, bool):
+        return float(hysteresis), False
+    return None, False
+
+class PluginObject:
+    """ A configured object compiled once at load time, so the hot paths read attributes
+        instead of parsing its config for every sample. Plugin specific properties are still
+        available as o["key"], o["value"] is the object's current value. """
+    __slots__ = ("cfg", "knx_group", "enabled", "value", "hysteresis", "relative", "rate_deadband",
+                 "min_interval", "magnitude", "precision", "fmt", "valmap", "reverse_valmap",
+                 "last", "sent_at", "absolute", "percent", "rate")
+
+    def __init__(self, cfg, default_hysteresis=None, default_precision=2, default_magnitude=1.0):
+        self.cfg = cfg
+        self.knx_group = cfg["knx_group"]
+        self.enabled = cfg["enabled"]
+        self.value = 0
+        self.hysteresis, self.relative = parse_hysteresis(cfg.get("hysteresis", default_hysteresis))
+        self.rate_deadband = cfg.get("rate_deadband")
+        self.min_interval = cfg.get("min_interval", 0)
+        # Deadband state, -1.0 disables a band
+        self.last = NAN
+        self.sent_at = -INF
+        self.absolute = self.hysteresis if self.hysteresis is not None and not self.relative else -1.0
+        self.percent = self.hysteresis if self.hysteresis is not None and self.relative else -1.0
+        self.rate = self.rate_deadband if self.rate_deadband is not None else -1.0
+        self.magnitude = cfg.get("magnitude", default_magnitude)
+        self.precision = cfg.get("precision", default_precision)
+        self.fmt = "%.{}f".format(self.precision)
+        self.valmap = cfg.get("valmap")
+        self.reverse_valmap = None
+        if isinstance(self.valmap, dict):
+            try:
+                reverse = {}
+                for key, val in self.valmap.items():
+                    reverse.setdefault(val, key)
+                self.reverse_valmap = reverse
+            except TypeError:
+                # nested valmaps, e.g. mqtt's per JSON property ones, only work forward
+                pass
+
+    def __getitem__(self, key):
+        if key == "value":
+            return self.value
+        return self.cfg[key]
+
+    def __setitem__(self, key, value):
+        if key == "value":
+            self.value = value
+        else:
+            self.cfg[key] = value
+
+    def __contains__(self, key):
+        return key == "value" or key in self.cfg
+
+    def get(self, key, default=None):
+        if key == "value":
+            return self.value
+        return self.cfg.get(key, default)
+
+    def __repr__(self):
+        return "PluginObject({!r}, value={!r})".format(self.cfg, self.value)
+
+class Deadband:
+    """ Change detection for a plugin's numeric objects. evaluate() checks a whole poll cycle
+        in one pass over the compiled objects and returns the formatted values of the objects
+        which changed. A value is sent when it leaves any of the configured deadbands:
+          hysteresis       absolute difference, or relative to the new value as "1.5%"
+          rate_deadband    change per second since the last sent value
+        and suppressed when it's unchanged or the object's last value was sent less than
+        min_interval seconds ago. The first value of every object is always sent. """
+
+    def __init__(self, objects, suppressed=None):
+        self.objects = list(objects)
+        self.suppressed = suppressed
+        # without time based bands the clock isn't needed at all
+        self.timed = any(o.rate >= 0.0 or o.min_interval for o in self.objects)
+
+    def evaluate(self, values, now=None):
+        """ values holds one float per object in the order of objects, NaN for objects not read this cycle """
+        if not self.timed:
+            return self._evaluate(values)
+        now = monotonic() if now is None else now
+        changed = {}
+        suppressed = 0
+        for o, value in zip(self.objects, values):
+            last = o.last
+            if value != value or value == last:
+                continue
+            elapsed = now - o.sent_at
+            if elapsed < o.min_interval:
+                suppressed += 1
+                continue
+            delta = abs(value - last)
+            absolute, percent, rate = o.absolute, o.percent, o.rate
+            if absolute >= 0.0 or percent >= 0.0 or rate >= 0.0:
+                # delta is NaN for the first value, which never compares as within a deadband
+                if not (absolute >= 0.0 and delta > absolute
+                        or percent >= 0.0 and delta > percent * abs(value)
+                        or rate >= 0.0 and delta > rate * elapsed
+                        or delta != delta):
+                    suppressed += 1
+                    continue
+            o.last = o.value = value
+            o.sent_at = now
+            changed[o.knx_group] = o.fmt % value
+        if suppressed and self.suppressed:
+            self.suppressed.inc(suppressed)
+        return changed
+
+    def restore(self, values):
+        """ Takes the numeric values of a state snapshot, {group: value}, as the last sent ones """
+        now = monotonic()
+        for o in self.objects:
+            wire = values.get(o.knx_group)
+            if wire is None:
+                continue
+            try:
+                o.last = o.value = float(wire)
+            except ValueError:
+                continue
+            # rate_deadband measures from here, with -INF every change would be within the band
+            o.sent_at = now
+
+    def _evaluate(self, values):
+        """ evaluate() for objects with value bands only, a disabled band of -1.0 never suppresses """
+        changed = {}
+        suppressed = 0
+        for o, value in zip(self.objects, values):
+            last = o.last
+            if value == last or value != value:
+                continue
+            delta = value - last
+            if delta < 0.0:
+                delta = -delta
+            if delta <= o.absolute or delta <= o.percent * (value if value >= 0.0 else -value):
+                suppressed += 1
+                continue
+            o.last = o.value = value
+            changed[o.knx_group] = o.fmt % value
+        if suppressed and self.suppressed:
+            self.suppressed.inc(suppressed)
+        return changed
+
 class BasePlugin:
+    # process_knx/process_direct only care about the groups in obj_list,
+    # plugins parsing other commands must set this to False
+    route_by_group = True
+    # threads for run_blocking, plugins whose client isn't thread-safe use 1
+    executor_workers = 2
+    # decimals of formatted numeric values unless configured per object or as default_precision
+    default_precision = 2
+    # plugins with their own per object properties compile them in a PluginObject subclass
+    object_class = PluginObject
+    # plugins sending numeric objects through a Deadband, its baseline is restored from the state snapshot
+    deadband = None
+
     def __init__(self, daemon, cfg):
             self.d = daemon
             self.cfg = cfg
             self.device_name = cfg["name"]
             self.client = None
-            self.obj_list = []
-            default_hysteresis = "default_hysteresis" in self.cfg and self.cfg["default_hysteresis"] or None
-            for obj in cfg["objects"]:
-                if obj["enabled"]:
-                    obj.update({"value": 0})
-                    if not "hysteresis" in obj and default_hysteresis:
-                        obj.update({"hysteresis": default_hysteresis})
-                    self.obj_list.append(obj)
+            default_hysteresis = cfg.get("default_hysteresis")
+            default_precision = cfg.get("default_precision", self.default_precision)
+            default_magnitude = cfg.get("default_magnitude", 1.0)
+            self.obj_list = [self.object_class(obj, default_hysteresis, default_precision, default_magnitude)
+                             for obj in cfg["objects"] if obj["enabled"]]
+            self._objs_by_knxgrp = {}
+            for obj in self.obj_list:
+                self._objs_by_knxgrp.setdefault(obj["knx_group"], []).append(obj)
+            self._executor = None
+            self.blocking_timeout = cfg.get("blocking_timeout", 10.0)
+            self.blocking_warn = cfg.get("blocking_warn", 1.0)
+            self.blocking_stats = {}
+
+    async def connect(self):
+        """ Connects to the device, raises an exception when it isn't reachable """
+        pass
 
     def _run(self):
         pass
@@ -66,12 +444,68 @@ class BasePlugin:
             runner = self._run()
             if runner:
                 knxalog.info("running client for {}...".format(self.device_name))
-                return runner
+                return [self._named_task(task) for task in runner]
+
+    def _named_task(self, task):
+        """ Task names carry the plugin's name, the admin task dumps and samples rely on it """
+        if asyncio.iscoroutine(task):
+            return self.d.loop.create_task(task, name=f"{self.device_name}:{task.__name__}")
+        if isinstance(task, asyncio.Task):
+            task.set_name(f"{self.device_name}:{task.get_coro().__name__}")
+        return task
+
+    async def stop(self):
+        """ Tears the plugin down on the running loop when a reload removes it, quit() is
+            only for the final shutdown outside of it. Plugins whose teardown has to await
+            something override both. """
+        self.quit()
 
     def quit(self):
         if self.client:
             knxalog.info("quit client for {}...".format(self.device_name))
             self.client.close()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def run_blocking(self, func, *args, timeout=None):
+        """ Runs a blocking call on the plugin's own thread pool instead of the event loop.
+            Raises asyncio.TimeoutError after timeout (default blocking_timeout) seconds,
+            the call itself can't be interrupted and is left to finish in its thread. """
+        if not self._executor:
+            workers = self.cfg.get("executor_workers", self.executor_workers)
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.device_name)
+        name = getattr(func, "__name__", repr(func))
+        stats = self.blocking_stats.setdefault(name, {"calls": 0, "timeouts": 0, "total": 0.0, "max": 0.0})
+        future = asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args))
+        start = monotonic()
+        try:
+            return await asyncio.wait_for(future, timeout or self.blocking_timeout)
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            knxalog.warning(f"{self.device_name} blocking call {name}{args!r} timed out")
+            raise
+        finally:
+            elapsed = monotonic() - start
+            stats["calls"] += 1
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+            if self.blocking_warn < elapsed < (timeout or self.blocking_timeout):
+                knxalog.warning(f"{self.device_name} blocking call {name}{args!r} took {elapsed:.2f} s")
+
+    def knx_groups(self):
+        return self._objs_by_knxgrp.keys()
+
+    def restore_state(self, values):
+        """ Called with the snapshot's {group: value} before the plugin starts """
+        if self.deadband:
+            self.deadband.restore(values)
+
+    def get_objs_by_knxgrp(self, knx_group):
+        return self._objs_by_knxgrp.get(knx_group, [])
 
     def get_obj_by_knxgrp(self, knx_group):
-        return next(item for item in self.obj_list if item["knx_group"] == knx_group)
+        try:
+            return self._objs_by_knxgrp[knx_group][0]
+        except KeyError:
+            raise StopIteration
@@ -22,10 +22,19 @@
 '''
 
 import sys
+import copy
 import json
+import time
 import asyncio
+import logging
 from importlib import import_module
-from helper import setLogLevel, knxalog as log
+from helper import setLogLevel, setLogFormat, log_ratelimited, new_event_loop, CallbackQueue, GroupCache, knxalog as log
+from linknx import LinknxClient
+from worker import PluginProcess
+from metrics import Metrics
+from admin import AdminControl
+from shaper import TrafficShaper
+from state import StateSnapshot
 
 PLUGINS = ("apc_ups", "daikin_ac", "doorbird", "gpio", "modbus_device", "mqtt", "onkyo_avr", "rfid", "rs485", "weather_station")
 
@@ -35,108 +44,478 @@ class KnxAdapter():
             cfg_file = sys.argv[1]
         else:
             cfg_file = sys.path[0] + '/config.json'
+        self.cfg_file = cfg_file
         try:
             with open(cfg_file) as json_data_file:
                 self.cfg = json.load(json_data_file)
+            # plugins keep state in their config dicts, reload() compares the files as they were read
+            self.loaded_cfg = copy.deepcopy(self.cfg)
 
         except FileNotFoundError:
             message = "Couldn't open the config file " + cfg_file
-            log.error(message, sys.exc_info()[0])
+            log.error(message)
             sys.exit(0)
 
         setLogLevel(self.cfg["sys"]["verbosity"])
+        setLogFormat(self.cfg["sys"].get("log_format"))
 
-        self.knx_client_reader = None
-        self.knx_client_writer = None
+        self.linknx = None
 
-        self._knx_lock = asyncio.Lock()
+        self.metrics = Metrics(enabled=bool(self.cfg["sys"].get("metrics_port")))
+        self._linknx_latency = self.metrics.histogram("knxadapter_linknx_request_seconds", "Round trip time of LinKNX requests")
+        self._linknx_errors = self.metrics.counter("knxadapter_linknx_errors_total", "Failed or rejected LinKNX requests")
+        self._dispatch_latency = self.metrics.histogram("knxadapter_knx_dispatch_seconds", "Time to dispatch an inbound LinKNX command to the plugins")
 
-        self.loop = asyncio.new_event_loop()
+        linknx_cfg = self.cfg["linknx"]
+        self.write_window = linknx_cfg.get("write_window", 0)
+        self.write_batch_max = linknx_cfg.get("write_batch_max", 32)
+        self.read_batch_max = linknx_cfg.get("read_batch_max", 32)
+        self.urgent_groups = set(linknx_cfg.get("urgent_groups", []))
+        self.sync_on_start = linknx_cfg.get("sync_on_start", True)
+        self.write_stats = {"requested": 0, "merged": 0, "batches": 0}
+        for key in self.write_stats:
+            self.metrics.counter_fn(f"knxadapter_writes_{key}_total", f"Group writes {key} by the write window",
+                                    lambda key=key: self.write_stats[key])
+        self._pending_writes = {}
+        self._pending_flushed = None
+        self._flush_handle = None
+        self._inflight_writes = {}
+        self.group_cache = None
+        if linknx_cfg.get("dedup_writes", True):
+            # urgent groups such as door openers are pulses, the actuator may have reset without a telegram
+            self.group_cache = GroupCache(linknx_cfg.get("refresh_interval", 0), set(linknx_cfg.get("dedup_exclude", [])) | self.urgent_groups)
+            self.metrics.counter_fn("knxadapter_writes_deduplicated_total", "Group writes dropped because the group already had the value",
+                                    lambda: self.group_cache.dropped)
+
+        self.loop = new_event_loop(self.cfg["sys"].get("event_loop"))
         asyncio.set_event_loop(self.loop)
 
+        self.shaper = None
+        if linknx_cfg.get("shaper"):
+            self.shaper = TrafficShaper(self, linknx_cfg["shaper"])
+
+        self.state = None
+        if self.cfg["sys"].get("state_file"):
+            if self.group_cache is None:
+                log.warning("state_file needs dedup_writes, not saving any state")
+            else:
+                self.state = StateSnapshot(self)
+
+        self.admin = AdminControl(self)
+        self.plugins = []
+        self.plugin_tasks = {}
+        self._reloading = False
+        self.startup_timings = {}
+
         self.knx_read_cbs = []
         self.value_direct_cbs = []
+        self.knx_routes = {}
+        self.direct_routes = {}
+        self._knx_unrouted = self.knx_read_cbs
+        self._direct_unrouted = self.value_direct_cbs
+        self.direct_queue_size = self.cfg["sys"].get("direct_queue_size", 100)
+        self.direct_overflow = self.cfg["sys"].get("direct_overflow", "coalesce")
+        self.direct_queues = {}
 
     async def linknx_client(self, loop, knxcfg):
-        self.knx_client_reader, self.knx_client_writer = await asyncio.open_connection(
-            knxcfg["host"], knxcfg["port"])
+        self.linknx = LinknxClient(knxcfg)
+        await self.linknx.connect()
 
     async def knx_server_handler(self, reader, writer):
-        data = await reader.readline()
-        cmd = data.decode()
-
+        """ Handles newline separated group=value commands until the client hangs up,
+            one-shot clients just send a single command and close the connection. """
         addr = writer.get_extra_info('peername')
-        log.debug("Received %r from %r" % (cmd, addr))
+        idle_timeout = self.cfg["linknx"].get("listen_idle_timeout", 600)
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.readline(), timeout=idle_timeout)
+                if not data:
+                    break
+                cmd = data.decode().strip()
+                if not cmd:
+                    continue
+                log.debug("Received %r from %r", cmd, addr)
+                await self.process_knx_cmd(cmd)
+        except asyncio.TimeoutError:
+            log.debug("Closing idle connection from %r", addr)
+        except ConnectionError as e:
+            log.debug("Connection from %r lost: %r", addr, e)
+        finally:
+            writer.close()
+
+    def build_routes(self):
+        """ Map each group address to the callbacks of the plugins which have objects for it,
+            callbacks of plugins which don't route by group get every command """
+        def routes_for(callbacks, wrap):
+            routes = {}
+            unrouted = []
+            for callback in callbacks:
+                plugin = getattr(callback, "__self__", None)
+                target = wrap(callback, plugin)
+                if getattr(plugin, "route_by_group", False):
+                    for group in plugin.knx_groups():
+                        routes.setdefault(group, []).append(target)
+                else:
+                    unrouted.append(target)
+            for group in routes:
+                routes[group] += unrouted
+            return routes, unrouted
+
+        def direct_queue(callback, plugin):
+            if not self.direct_queue_size:
+                return callback
+            if callback not in self.direct_queues:
+                name = "{} {}".format(getattr(plugin, "device_name", ""), getattr(callback, "__name__", callback)).strip()
+                queue = self.direct_queues[callback] = CallbackQueue(callback, name, self.direct_queue_size, self.direct_overflow)
+                self.metrics.gauge("knxadapter_direct_queue_depth", "Pending direct values per consumer", lambda: queue.depth, consumer=name)
+                self.metrics.gauge("knxadapter_direct_queue_lag_seconds", "Queueing delay of the last direct value per consumer", lambda: queue.lag, consumer=name)
+                self.metrics.counter_fn("knxadapter_direct_queue_dropped_total", "Direct values dropped per consumer", lambda: queue.dropped, consumer=name)
+            return self.direct_queues[callback].put
+
+        for callback in list(self.direct_queues):
+            if callback not in self.value_direct_cbs:
+                queue = self.direct_queues.pop(callback)
+                queue.stop()
+                self.metrics.remove(consumer=queue.name)
+        self.knx_routes, self._knx_unrouted = routes_for(self.knx_read_cbs, lambda callback, plugin: callback)
+        self.direct_routes, self._direct_unrouted = routes_for(self.value_direct_cbs, direct_queue)
+        log.debug("routing {} groups to plugins, {} unrouted callbacks".format(
+            len(self.knx_routes.keys() | self.direct_routes.keys()), len(self._knx_unrouted) + len(self._direct_unrouted)))
+
+    def direct_queue_stats(self):
+        return {queue.name: queue.stats() for queue in self.direct_queues.values()}
 
+    def get_group_value(self, group, default=None):
+        """ The last value written to or received for a group, as sent on the wire """
+        if self.group_cache is None:
+            return default
+        return self.group_cache.get(group, default)
+
+    async def sync_state(self, plugins=None):
+        """ Reads the current values of the plugins' groups from LinKNX and seeds the group cache
+            and the plugins' state with them, returns the number of values read """
+        plugins = self.plugins if plugins is None else plugins
+        groups = set()
+        for plugin in plugins:
+            groups.update(plugin.knx_groups())
+        if not groups:
+            return 0
+        started = time.monotonic()
+        try:
+            values = await self.linknx.read(sorted(groups), self.read_batch_max)
+        except Exception as e:
+            log.warning("couldn't read the group values from LinKNX: %r", e)
+            return 0
+        if self.group_cache is not None:
+            for group, value in values.items():
+                self.group_cache.update(group, value)
+        for plugin in plugins:
+            restore_state = getattr(plugin, "restore_state", None)
+            if restore_state:
+                restore_state(values)
+        log.info("read %d of %d group values from LinKNX in %.3f s", len(values), len(groups), time.monotonic() - started)
+        return len(values)
+
+    async def process_knx_cmd(self, cmd):
+        started = time.monotonic()
+        group, sep, value = cmd.partition("=")
+        if sep:
+            if self.group_cache is not None:
+                self.group_cache.update(group, value, started)
+            callbacks = self.knx_routes.get(group, self._knx_unrouted)
+        else:
+            callbacks = self.knx_read_cbs
         parse_errors = []
-        for callback in self.knx_read_cbs:
+        for callback in callbacks:
             if not await callback(cmd):
                 parse_errors.append(callback)
         if parse_errors:
-            log.error("Couldn't parse linknx command: {!r} in callback {!r}".format(cmd, parse_errors))
-        writer.close()
+            log_ratelimited(("parse", tuple(parse_errors)), logging.ERROR, "Couldn't parse linknx command: %r in callback %r", cmd, parse_errors)
+        self._dispatch_latency.observe(time.monotonic() - started)
 
     async def set_group_value_dict(self, group_value_dict, process_direct=True):
+        if process_direct:
+            for group, value in group_value_dict.items():
+                for callback in self.direct_routes.get(group, self._direct_unrouted):
+                    await callback(group, value)
+        # only LinKNX is spared unchanged values, direct consumers see every write, e.g. repeated pulses
+        if self.group_cache is not None:
+            group_value_dict = self.group_cache.filter(group_value_dict)
+        if self.shaper:
+            self.shaper.put(group_value_dict)
+            return
+        if self.write_window:
+            await self.queue_writes(group_value_dict)
+            return
         sequence = ""
         for group, value in group_value_dict.items():
             sequence += f'<object id="{group}" value="{value}"/>'
-            if process_direct:
-                for callback in self.value_direct_cbs:
-                    await callback(group, value)
         if sequence:
-            await self.send_knx(sequence)
+            written = False
+            try:
+                written = await self.send_knx(sequence)
+            finally:
+                if not written and self.group_cache is not None:
+                    self.group_cache.invalidate(group_value_dict)
+
+    async def queue_writes(self, group_value_dict):
+        """ Collect writes for write_window seconds, keeping the latest value per group """
+        if not group_value_dict:
+            return
+        urgent = False
+        for group, value in group_value_dict.items():
+            self.write_stats["requested"] += 1
+            if group in self._pending_writes:
+                self.write_stats["merged"] += 1
+            self._pending_writes[group] = value
+            urgent = urgent or group in self.urgent_groups
+
+        flushed = self._pending_flushed
+        if flushed is None:
+            flushed = self._pending_flushed = self.loop.create_future()
+            # a failed batch may have no waiters left, its callers were cancelled or only wait for ordering
+            flushed.add_done_callback(lambda future: future.cancelled() or future.exception())
+            self._flush_handle = self.loop.call_later(self.write_window, self._flush_writes)
+        if urgent or len(self._pending_writes) >= self.write_batch_max:
+            self._flush_writes()
+        await asyncio.shield(flushed)
+
+    def _flush_writes(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending_writes = self._pending_writes, {}
+        flushed, self._pending_flushed = self._pending_flushed, None
+        if flushed is not None:
+            self.loop.create_task(self._send_batch(pending, flushed))
+
+    async def _send_batch(self, pending, flushed):
+        # batches may travel on different LinKNX connections, keep them in order per group
+        earlier = {self._inflight_writes[group] for group in pending if group in self._inflight_writes}
+        for group in pending:
+            self._inflight_writes[group] = flushed
+        if earlier:
+            await asyncio.wait(earlier)
+        items = list(pending.items())
+        try:
+            for i in range(0, len(items), self.write_batch_max):
+                sequence = ""
+                for group, value in items[i:i+self.write_batch_max]:
+                    sequence += f'<object id="{group}" value="{value}"/>'
+                if not await self.send_knx(sequence) and self.group_cache is not None:
+                    self.group_cache.invalidate(dict(items[i:i+self.write_batch_max]))
+                self.write_stats["batches"] += 1
+            log.debug("flushed %d groups, write stats %r", len(items), self.write_stats)
+            flushed.set_result(None)
+        except Exception as e:
+            if self.group_cache is not None:
+                self.group_cache.invalidate(pending)
+            flushed.set_exception(e)
+        for group in pending:
+            if self._inflight_writes.get(group) is flushed:
+                del self._inflight_writes[group]
 
     async def send_knx(self, sequence):
-        async with self._knx_lock:
-            xml = '<write>' + sequence + '</write>\n\x04'
-            log.debug("sending to knx:{!r}".format(xml))
-            self.knx_client_writer.write(xml.encode(encoding='utf_8'))
-            await self.knx_client_writer.drain()
-            data = await asyncio.wait_for(self.knx_client_reader.readline(), timeout=30.0)
-            decoded = data.decode()
-            if "<write status='error'>" in decoded:
-                log.error("LinKNX {}".format(decoded[1:-1]))
-            else:
-                log.debug("LinKNX {!r}".format(decoded))
+        xml = '<write>' + sequence + '</write>\n\x04'
+        log.debug("sending to knx:%r", xml)
+        started = time.monotonic()
+        try:
+            decoded = await self.linknx.request(xml)
+        except Exception:
+            self._linknx_errors.inc()
+            raise
+        finally:
+            self._linknx_latency.observe(time.monotonic() - started)
+        if "<write status='error'>" in decoded:
+            self._linknx_errors.inc()
+            log_ratelimited("linknx write error", logging.ERROR, "LinKNX %s", decoded)
+            return False
+        log.debug("LinKNX %r", decoded)
+        return True
+
+    def load_plugin(self, plugin_config):
+        klass = plugin_config["class"]
+        timing = self.startup_timings.setdefault(plugin_config["name"], {})
+        if plugin_config.get("process"):
+            return PluginProcess(self, plugin_config)
+        try:
+            started = time.monotonic()
+            plugin_module = import_module(klass)
+            plugin_class = plugin_module.plugin_def()
+            timing["import"] = time.monotonic() - started
+            if plugin_class:
+                started = time.monotonic()
+                plugin = plugin_class(self, plugin_config)
+                timing["init"] = time.monotonic() - started
+                return plugin
+        except ModuleNotFoundError as e:
+            log.warning("module not found: {}. Plugin '{}' unavailable!".format(e, klass))
+
+    async def connect_plugin(self, plugin):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(plugin.connect(), timeout=plugin.cfg.get("connect_timeout", 10.0))
+            return True
+        except Exception as e:
+            log.warning("{} couldn't connect: {!r}".format(plugin.device_name, e))
+            return False
+        finally:
+            timing = self.startup_timings.setdefault(plugin.device_name, {})
+            timing["connect"] = timing.get("connect", 0) + time.monotonic() - started
+
+    async def run_plugin(self, plugin, connected):
+        """ Keeps retrying to connect a degraded plugin, then runs its tasks """
+        delay = plugin.cfg.get("retry_delay", 10)
+        while not connected:
+            log.warning("{} degraded, retrying in {} s".format(plugin.device_name, delay))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+            connected = await self.connect_plugin(plugin)
+        try:
+            tasks = plugin.run()
+            if tasks:
+                await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("{} stopped after an error".format(plugin.device_name))
+
+    async def start_plugins(self, plugins):
+        """ Connects all plugins concurrently, those which fail keep retrying in the background """
+        results = await asyncio.gather(*[self.connect_plugin(plugin) for plugin in plugins])
+        for plugin, connected in zip(plugins, results):
+            self.plugin_tasks[plugin.device_name] = self.loop.create_task(self.run_plugin(plugin, connected), name=plugin.device_name)
+        for plugin in plugins:
+            timing = self.startup_timings.get(plugin.device_name, {})
+            log.info("startup {}: {}".format(plugin.device_name, ", ".join("{} {:.3f} s".format(k, v) for k, v in timing.items())))
+
+    def plugin_configs(self, cfg):
+        return {plugin_config["name"]: plugin_config for plugin_config in cfg["plugins"]
+                if plugin_config["class"] in PLUGINS and plugin_config["enabled"]}
+
+    async def stop_plugin(self, plugin):
+        task = self.plugin_tasks.pop(plugin.device_name, None)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        try:
+            await plugin.stop()
+        except Exception:
+            # the plugin is dropped anyway, a reload mustn't stop half way
+            log.exception("{} didn't stop cleanly".format(plugin.device_name))
+        self.plugins.remove(plugin)
+        self.startup_timings.pop(plugin.device_name, None)
+        self.metrics.remove(plugin=plugin.device_name)
+        for callbacks in (self.knx_read_cbs, self.value_direct_cbs):
+            callbacks[:] = [callback for callback in callbacks if getattr(callback, "__self__", None) is not plugin]
+
+    async def reload(self):
+        """ Re-reads the config file and only stops, starts or restarts the plugins whose config changed,
+            the others keep their connections and the group cache stays as it is """
+        if self._reloading:
+            return "reload already running"
+        self._reloading = True
+        try:
+            try:
+                with open(self.cfg_file) as json_data_file:
+                    cfg = json.load(json_data_file)
+            except (OSError, ValueError) as e:
+                log.error(f"reload: couldn't read {self.cfg_file}: {e!r}")
+                return f"error: {e!r}"
+            for section in cfg.keys() | self.loaded_cfg.keys():
+                if section != "plugins" and cfg.get(section) != self.loaded_cfg.get(section):
+                    log.warning(f"reload: changes to {section!r} take effect after a restart")
+            old = self.plugin_configs(self.loaded_cfg)
+            new = self.plugin_configs(cfg)
+            running = {plugin.device_name: plugin for plugin in self.plugins}
+            stopped = [name for name in running if name not in new or new[name] != old.get(name)]
+            started = [name for name in new if name not in running or name in stopped]
+            for name in stopped:
+                log.info(f"reload: stopping {name}")
+                await self.stop_plugin(running[name])
+            self.loaded_cfg["plugins"] = copy.deepcopy(cfg["plugins"])
+            self.cfg["plugins"] = cfg["plugins"]
+            plugins = []
+            for name in started:
+                log.info(f"reload: starting {name}")
+                plugin = self.load_plugin(new[name])
+                if plugin:
+                    plugins.append(plugin)
+                    self.plugins.append(plugin)
+            self.build_routes()
+            if self.shaper:
+                self.shaper.assign(self.plugins, self.urgent_groups)
+            if self.group_cache is not None:
+                for plugin in plugins:
+                    restore_state = getattr(plugin, "restore_state", None)
+                    if restore_state:
+                        restore_state(self.group_cache.values)
+            if self.sync_on_start:
+                await self.sync_state(plugins)
+            await self.start_plugins(plugins)
+            result = "{} added, {} removed, {} restarted, {} unchanged".format(
+                len([name for name in started if name not in running]), len([name for name in stopped if name not in new]),
+                len([name for name in stopped if name in new]), len(running) - len(stopped))
+            log.info(f"reload: {result}")
+            return result
+        finally:
+            self._reloading = False
 
     def start(self):
-        log.info("Started KNX Bus Adapter Deamon.")
+        log.info("Started KNX Bus Adapter Deamon on {}.".format(type(self.loop).__module__))
 
         knx_client = self.loop.run_until_complete(self.linknx_client(self.loop, self.cfg["linknx"]))
 
         knx_server_coro = asyncio.start_server(self.knx_server_handler, self.cfg["sys"]["listenHost"], self.cfg["linknx"]["listenPort"])
         knx_server = self.loop.run_until_complete(knx_server_coro)
 
-        plugins = []
-        for plugin_config in self.cfg["plugins"]:
-            klass = plugin_config["class"]
-            if klass in PLUGINS and plugin_config["enabled"]:
-                try:
-                    plugin_module = import_module(klass)
-                    plugin_class = plugin_module.plugin_def()
-                    if plugin_class:
-                        plugins.append(plugin_class(self, plugin_config))
-                except ModuleNotFoundError as e:
-                    log.warning("module not found: {}. Plugin '{}' unavailable!".format(e, klass))
-
-        tasks = []
-        for plugin in plugins:
-            task = plugin.run()
-            if task:
-                tasks += task
+        self.loop.run_until_complete(self.admin.start())
+
+        if self.metrics.enabled:
+            metrics_host = self.cfg["sys"].get("metrics_host", "127.0.0.1")
+            self.loop.run_until_complete(self.metrics.serve(metrics_host, self.cfg["sys"]["metrics_port"]))
+
+        for plugin_config in self.plugin_configs(self.cfg).values():
+            plugin = self.load_plugin(plugin_config)
+            if plugin:
+                self.plugins.append(plugin)
 
-        futs = asyncio.gather(*tasks)
-        self.loop.run_until_complete(futs)
+        self.build_routes()
+        if self.shaper:
+            self.shaper.assign(self.plugins, self.urgent_groups)
+        if self.state:
+            self.state.restore(self.plugins)
+            self.state.start()
+        if self.sync_on_start:
+            self.loop.run_until_complete(self.sync_state())
 
         try:
+            self.loop.run_until_complete(self.start_plugins(self.plugins))
             self.loop.run_forever()
         except KeyboardInterrupt:
             pass
         finally:
             knx_server.close()
             self.loop.run_until_complete(knx_server.wait_closed())
-            for plugin in plugins:
+            for task in self.plugin_tasks.values():
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*self.plugin_tasks.values(), return_exceptions=True))
+            for queue in self.direct_queues.values():
+                queue.stop()
+            if self.shaper:
+                self.loop.run_until_complete(self.shaper.flush())
+                self.shaper.stop()
+            for plugin in self.plugins:
                 plugin.quit()
+            if self.state:
+                self.state.close()
+            self.linknx.close()
+            self.metrics.close()
+            self.admin.close()
+            leftovers = asyncio.all_tasks(self.loop)
+            for task in leftovers:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*leftovers, return_exceptions=True))
             self.loop.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+'''
+  linknx.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import asyncio
+import logging
+from time import monotonic
+from collections import deque
+from xml.etree import ElementTree
+from helper import log_ratelimited, knxalog as log
+
+class LinknxConnection:
+    """ One persistent, pipelined connection to the LinKNX XML server.
+        LinKNX answers requests strictly in order, so replies are matched
+        to the waiting requests in FIFO order. """
+
+    def __init__(self, host, port, timeout, name):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.stall_after = min(1.0, timeout / 10)
+        self.name = name
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._pending = deque()
+        self._connect_lock = asyncio.Lock()
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    @property
+    def load(self):
+        return len(self._pending)
+
+    @property
+    def stalled(self):
+        """ the oldest outstanding request waits unusually long for its reply """
+        return bool(self._pending) and monotonic() - self._pending[0][1] > self.stall_after
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.connected:
+                return
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), timeout=self.timeout)
+            self._reader_task = asyncio.create_task(self._read_replies(self._reader), name=f"{self.name}:replies")
+            log.debug(f"{self.name} connected to {self.host}:{self.port}")
+
+    async def request(self, xml):
+        if not self.connected:
+            await self.connect()
+        reply = asyncio.get_running_loop().create_future()
+        self._pending.append((reply, monotonic()))
+        self._writer.write(xml.encode(encoding='utf_8'))
+        try:
+            await self._writer.drain()
+            return await asyncio.wait_for(asyncio.shield(reply), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            reply.cancel()
+            # a late reply would be matched to the wrong request, start over
+            self.close(ConnectionError(f"{self.name} no reply within {self.timeout} s"))
+            raise
+        except ConnectionError as e:
+            self.close(e)
+            raise
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                data = await reader.readuntil(b'\x04')
+                decoded = data.decode().strip('\x04\r\n ')
+                if self._pending:
+                    reply, sent = self._pending.popleft()
+                    if not reply.done():
+                        reply.set_result(decoded)
+                else:
+                    log_ratelimited((self.name, "unexpected reply"), logging.WARNING, "%s unexpected reply %r", self.name, decoded)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = ConnectionError(f"{self.name} connection lost ({e!r})")
+        except Exception as e:
+            # e.g. a reply beyond the stream limit, the connection is out of step and has to be re-established
+            log.warning(f"{self.name} unreadable reply: {e!r}")
+            error = ConnectionError(f"{self.name} unreadable reply ({e!r})")
+        if reader is self._reader:
+            self._reader_task = None
+            self.close(error)
+
+    def close(self, error=None):
+        if self._writer:
+            self._writer.close()
+            log.debug(f"{self.name} disconnected")
+        self._reader = self._writer = None
+        if self._reader_task:
+            self._reader_task.cancel()
+            self._reader_task = None
+        while self._pending:
+            reply, sent = self._pending.popleft()
+            if not reply.done():
+                reply.set_exception(error or ConnectionError(f"{self.name} closed"))
+
+class LinknxClient:
+    """ Small pool of LinknxConnection which are used back-to-back.
+        Each request goes to the connection with the fewest outstanding replies,
+        stalled connections are avoided and dropped ones are re-established
+        on their next request. """
+
+    def __init__(self, knxcfg):
+        host, port = knxcfg["host"], knxcfg["port"]
+        timeout = knxcfg.get("timeout", 30.0)
+        size = max(1, knxcfg.get("connections", 1))
+        self.connections = [LinknxConnection(host, port, timeout, f"LinKNX#{i}") for i in range(size)]
+        self._next = 0
+
+    async def connect(self):
+        results = await asyncio.gather(*[c.connect() for c in self.connections], return_exceptions=True)
+        for conn, result in zip(self.connections, results):
+            if isinstance(result, Exception):
+                log.warning(f"{conn.name} couldn't connect to {conn.host}:{conn.port} ({result!r}), retrying on demand")
+
+    def _pick(self):
+        count = len(self.connections)
+        best = best_rank = None
+        for i in range(count):
+            conn = self.connections[(self._next + i) % count]
+            rank = (conn.connected and not conn.stalled, conn.connected, -conn.load)
+            if best is None or rank > best_rank:
+                best, best_rank = conn, rank
+        self._next = (self._next + 1) % count
+        return best
+
+    async def request(self, xml):
+        return await self._pick().request(xml)
+
+    async def read(self, groups, batch_max=32):
+        """ Reads the current values of groups with batched <read> requests spread over the pool,
+            returns {group: value} without the groups LinKNX couldn't read """
+        groups = list(groups)
+        results = await asyncio.gather(*[self._read_batch(groups[i:i+batch_max]) for i in range(0, len(groups), batch_max)])
+        values = {}
+        for result in results:
+            values.update(result)
+        return values
+
+    async def _read_batch(self, groups):
+        if len(groups) == 1:
+            xml = f'<read><object id="{groups[0]}"/></read>\n\x04'
+        else:
+            xml = '<read><objects>' + "".join(f'<object id="{group}"/>' for group in groups) + '</objects></read>\n\x04'
+        reply = await self.request(xml)
+        try:
+            root = ElementTree.fromstring(reply)
+        except ElementTree.ParseError:
+            log.warning("LinKNX unexpected read reply %r", reply)
+            return {}
+        if root.get("status") != "success":
+            if len(groups) == 1:
+                log.debug("LinKNX couldn't read %s: %s", groups[0], root.text)
+                return {}
+            # a single unknown group fails the whole batch, read them one by one instead
+            values = {}
+            for result in await asyncio.gather(*[self._read_batch([group]) for group in groups]):
+                values.update(result)
+            return values
+        if len(groups) == 1:
+            return {groups[0]: (root.text or "").strip()}
+        return {o.get("id"): o.get("value") for o in root.iter("object") if o.get("value") is not None}
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
@@ -0,0 +1,720 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+  loadtest.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+# End-to-end load test: starts knxadapter3.py against local stand-ins for LinKNX, a Modbus-TCP
+# meter, an MQTT broker, apcupsd's network information server and an Onkyo eISCP receiver.
+#   loadtest.py --rate 200 --duration 20            one stage at 200 messages/s
+#   loadtest.py --ramp 50:2:6400                    double the rate from 50/s until the daemon can't keep up
+#   loadtest.py --event-loops asyncio,uvloop        run the same stages on each event loop and compare them
+# Pushed messages (MQTT publishes, eISCP volume changes and group=value commands sent to listenPort)
+# are generated at --rate, the polled devices change their values every --change-interval.
+# Every value is tracked from the moment a stand-in changes it until it arrives as LinKNX <write>
+# (or for commands, as MQTT publish), values overwritten before the daemon picked them up count as
+# superseded. A rate is sustainable when no more than --max-loss of the pushed values got lost and
+# their 99th percentile latency stays below --max-p99. Plugins whose dependencies aren't installed
+# don't start, the daemon's log in the temporary directory tells which.
+
+import os
+import sys
+import json
+import random
+import signal
+import socket
+import struct
+import asyncio
+import argparse
+import tempfile
+import importlib.util
+from collections import Counter, OrderedDict, defaultdict
+from time import monotonic
+
+DAEMON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "knxadapter3.py")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class Tracker:
+    """ Matches the values produced by the stand-ins with what arrives at the other end """
+
+    def __init__(self):
+        self.pending = {}
+        self.sources = {}
+        self.reset()
+
+    def reset(self):
+        self.latencies = defaultdict(list)
+        self.produced = Counter()
+        self.superseded = Counter()
+        self.lost = Counter()
+        self.unexpected = 0
+
+    def expect(self, source, group, value):
+        values = self.pending.setdefault(group, OrderedDict())
+        values.pop(value, None)
+        values[value] = monotonic()
+        self.sources[group] = source
+        self.produced[source] += 1
+
+    def seen(self, group, value):
+        values = self.pending.get(group)
+        if not values or value not in values:
+            self.unexpected += 1
+            return
+        source = self.sources[group]
+        while values:
+            pending_value, produced = values.popitem(last=False)
+            if pending_value == value:
+                self.latencies[source].append(monotonic() - produced)
+                return
+            self.superseded[source] += 1
+
+    def finish(self):
+        """ Everything still pending at the end of a stage is lost """
+        for group, values in self.pending.items():
+            self.lost[self.sources[group]] += len(values)
+            values.clear()
+
+class FakeLinknx:
+    """ Answers <write> requests after a configurable latency, rejects a share of them
+        and sends group=value commands to the daemon's listenPort like LinKNX rules do """
+
+    def __init__(self, tracker, latency, jitter, error_rate):
+        self.tracker = tracker
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.port = None
+        self.requests = 0
+        self.objects = 0
+        self.errors = 0
+        self.values = {}
+        self._server = None
+        self._inbound = []
+        self._oneshot = None
+        self._tasks = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        replies = asyncio.Queue()
+        replier = asyncio.create_task(self._reply(writer, replies))
+        try:
+            while True:
+                request = await reader.readuntil(b'\x04')
+                received = monotonic()
+                self.requests += 1
+                delay = self.latency + (random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+                if request.startswith(b"<read"):
+                    reply = self._read(request.decode())
+                elif random.random() < self.error_rate:
+                    self.errors += 1
+                    reply = b"<write status='error'>simulated error</write>\n\x04"
+                else:
+                    reply = b"<write status='success'/>\n\x04"
+                    self._record(request.decode())
+                replies.put_nowait((received + max(0.0, delay), reply))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            replier.cancel()
+            writer.close()
+
+    def _record(self, request):
+        for part in request.split('<object id="')[1:]:
+            group, _, rest = part.partition('" value="')
+            value = rest.partition('"')[0]
+            self.objects += 1
+            self.values[group] = value
+            self.tracker.seen(group, value)
+
+    def _read(self, request):
+        groups = [part.partition('"')[0] for part in request.split('<object id="')[1:]]
+        # like LinKNX, one unknown object fails the whole request
+        if any(group not in self.values for group in groups):
+            return b"<read status='error'>Object ID not found</read>\n\x04"
+        if "<objects>" not in request:
+            return f"<read status='success'>{self.values[groups[0]]}</read>\n\x04".encode()
+        objects = "".join(f'<object id="{group}" value="{self.values[group]}"/>' for group in groups)
+        return f"<read status='success'><objects>{objects}</objects></read>\n\x04".encode()
+
+    async def _reply(self, writer, replies):
+        # replies leave in request order, like LinKNX handling one pipelined request after another
+        while True:
+            due, reply = await replies.get()
+            wait = due - monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            writer.write(reply)
+            await writer.drain()
+
+    async def connect_inbound(self, port, connections, oneshot):
+        self._oneshot = port if oneshot else None
+        if not oneshot:
+            for _ in range(connections):
+                self._inbound.append((await asyncio.open_connection("127.0.0.1", port))[1])
+
+    def send_command(self, n, group, value):
+        self.tracker.expect("inbound", group, value)
+        line = f"{group}={value}\n".encode()
+        if self._oneshot:
+            task = asyncio.create_task(self._send_oneshot(line))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self._inbound[n % len(self._inbound)].write(line)
+
+    async def _send_oneshot(self, line):
+        try:
+            writer = (await asyncio.open_connection("127.0.0.1", self._oneshot))[1]
+            writer.write(line)
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+    async def drain(self):
+        for writer in self._inbound:
+            await writer.drain()
+
+    def close(self):
+        for writer in self._inbound:
+            writer.close()
+        self._server.close()
+
+class FakeModbus:
+    """ Modbus-TCP server answering 'read holding registers' with U32 values changing every tick """
+
+    def __init__(self, tracker, objects):
+        self.tracker = tracker
+        self.groups = [f"load:modbus:register_{i}" for i in range(objects)]
+        self.values = [1000 * i for i in range(objects)]
+        self.port = None
+        self.requests = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def plugin_config(self, poll_interval):
+        return {"class": "modbus_device", "name": "load modbus", "enabled": True, "host": "127.0.0.1", "port": self.port,
+                "poll_interval": poll_interval, "modbus_wordorder": "BE", "default_magnitude": 1.0, "default_precision": 0,
+                "objects": [{"register": 2 * i, "knx_group": group, "data_type": "U32", "hysteresis": 0, "enabled": True}
+                            for i, group in enumerate(self.groups)]}
+
+    def tick(self):
+        for i, group in enumerate(self.groups):
+            self.values[i] += 1
+            self.tracker.expect("modbus", group, str(self.values[i]))
+
+    def register(self, address):
+        value = self.values[address // 2] if address // 2 < len(self.values) else 0
+        return value >> 16 if address % 2 == 0 else value & 0xffff
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                tid, pid, length, unit = struct.unpack(">HHHB", await reader.readexactly(7))
+                pdu = await reader.readexactly(length - 1)
+                self.requests += 1
+                if pdu[0] == 3:
+                    address, count = struct.unpack(">HH", pdu[1:5])
+                    data = b"".join(struct.pack(">H", self.register(address + i)) for i in range(count))
+                    pdu = struct.pack(">BB", 3, len(data)) + data
+                else:
+                    pdu = struct.pack(">BB", pdu[0] | 0x80, 1)
+                writer.write(struct.pack(">HHHB", tid, pid, len(pdu) + 1, unit) + pdu)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self._server.close()
+
+class FakeApcupsd:
+    """ apcupsd network information server whose line voltage and load change every tick """
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.linev = 200.0
+        self.load = 10.0
+        self.port = None
+        self.requests = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def plugin_config(self, poll_interval):
+        return {"class": "apc_ups", "name": "load ups", "enabled": True, "host": "127.0.0.1", "port": self.port,
+                "poll_interval": poll_interval,
+                "objects": [{"ups_expr": "LINEV *: ([0-9.]*) Volts", "knx_group": "load:ups:line_voltage", "hysteresis": 0.2, "enabled": True},
+                            {"ups_expr": "LOADPCT *: ([0-9.]*) Percent", "knx_group": "load:ups:load", "hysteresis": 0.2, "enabled": True}]}
+
+    def tick(self):
+        self.linev += 1.0
+        self.load += 1.0
+        self.tracker.expect("apcupsd", "load:ups:line_voltage", f"{self.linev:.2f}")
+        self.tracker.expect("apcupsd", "load:ups:load", f"{self.load:.2f}")
+
+    def status(self):
+        lines = ("APC      : 001,036,0887", "HOSTNAME : loadtest", "UPSNAME  : SmartUPS", "MODEL    : Smart-UPS 750",
+                 "STATUS   : ONLINE ", f"LINEV    : {self.linev:.1f} Volts", f"LOADPCT  : {self.load:.1f} Percent",
+                 "BCHARGE  : 100.0 Percent", "TIMELEFT : 48.0 Minutes", "BATTV    : 27.3 Volts", "LINEFREQ : 50.0 Hz",
+                 "END APC  : 2021-03-01 12:00:01 +0100")
+        return b"".join(struct.pack(">H", len(l) + 1) + (l + "\n").encode("ascii") for l in lines) + b"\x00\x00"
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                length = struct.unpack(">H", await reader.readexactly(2))[0]
+                if await reader.readexactly(length) == b"status":
+                    self.requests += 1
+                    writer.write(self.status())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self._server.close()
+
+class FakeEiscp:
+    """ Onkyo receiver pushing master volume changes over eISCP """
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.volume = 0
+        self.port = None
+        self.received = 0
+        self._writers = []
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def plugin_config(self):
+        return {"class": "onkyo_avr", "name": "load avr", "enabled": True, "host": "127.0.0.1", "port": self.port,
+                "objects": [{"avr_object": "master-volume", "avr_zone": "main", "knx_group": "load:avr:volume", "enabled": True}]}
+
+    @staticmethod
+    def packet(command):
+        data = b"!1" + command.encode("ascii") + b"\x1a\r\n"
+        return b"ISCP" + struct.pack(">IIB3x", 16, len(data), 1) + data
+
+    @property
+    def connected(self):
+        return bool(self._writers)
+
+    def push(self):
+        self.volume = (self.volume + 1) % 81
+        self.tracker.expect("eiscp", "load:avr:volume", str(round((self.volume * 255.0) / 196.0)))
+        for writer in self._writers:
+            writer.write(self.packet(f"MVL{self.volume:02X}"))
+
+    async def handle(self, reader, writer):
+        self._writers.append(writer)
+        try:
+            while True:
+                header = await reader.readexactly(16)
+                await reader.readexactly(struct.unpack(">I", header[8:12])[0])
+                self.received += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.remove(writer)
+            writer.close()
+
+    def close(self):
+        self._server.close()
+
+class FakeMqttBroker:
+    """ Just enough MQTT 3.1.1 for one client: publishes sensor topics and takes its publishes """
+
+    def __init__(self, tracker, topics):
+        self.tracker = tracker
+        self.topics = topics
+        self.port = None
+        self.received = 0
+        self._clients = {}
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def plugin_config(self):
+        objects = [{"topic": f"load/sensor/{i}", "knx_group": f"load:mqtt:sensor_{i}", "enabled": True} for i in range(self.topics)]
+        objects += [{"topic": f"load/state/{i}", "publish_topic": f"load/set/{i}", "knx_group": f"load:mqtt:set_{i}", "enabled": True}
+                    for i in range(self.topics)]
+        return {"class": "mqtt", "name": "load mqtt", "enabled": True, "host": "127.0.0.1", "port": self.port,
+                "user": "", "pass": "", "poll_interval": 1, "objects": objects}
+
+    @property
+    def connected(self):
+        return any(self._clients.values())
+
+    @staticmethod
+    def packet(kind, body):
+        length, remaining = b"", len(body)
+        while True:
+            byte, remaining = remaining % 128, remaining // 128
+            length += bytes((byte | 0x80 if remaining else byte,))
+            if not remaining:
+                return bytes((kind,)) + length + body
+
+    @staticmethod
+    def string(s):
+        s = s.encode()
+        return struct.pack(">H", len(s)) + s
+
+    def publish(self, n, value):
+        topic = f"load/sensor/{n % self.topics}"
+        for writer, subscriptions in self._clients.items():
+            if topic in subscriptions:
+                self.tracker.expect("mqtt", f"load:mqtt:sensor_{n % self.topics}", value)
+                writer.write(self.packet(0x30, self.string(topic) + value.encode()))
+
+    async def handle(self, reader, writer):
+        subscriptions = self._clients[writer] = set()
+        try:
+            while True:
+                first = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                kind = first >> 4
+                if kind == 1:
+                    writer.write(self.packet(0x20, b"\x00\x00"))
+                elif kind == 8:
+                    packet_id, pos, granted = body[:2], 2, b""
+                    while pos < len(body):
+                        size = struct.unpack(">H", body[pos:pos + 2])[0]
+                        subscriptions.add(body[pos + 2:pos + 2 + size].decode())
+                        pos += size + 3
+                        granted += b"\x00"
+                    writer.write(self.packet(0x90, packet_id + granted))
+                elif kind == 10:
+                    writer.write(self.packet(0xb0, body[:2]))
+                elif kind == 3:
+                    size = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + size].decode()
+                    pos = 2 + size
+                    if first & 0x06:
+                        writer.write(self.packet(0x40, body[pos:pos + 2]))
+                        pos += 2
+                    self.received += 1
+                    if topic.startswith("load/set/"):
+                        self.tracker.seen(f"load:mqtt:set_{topic[9:]}", body[pos:].decode())
+                elif kind == 12:
+                    writer.write(self.packet(0xd0, b""))
+                elif kind == 14:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._clients[writer]
+            writer.close()
+
+    def close(self):
+        self._server.close()
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.tracker = Tracker()
+        self.linknx = FakeLinknx(self.tracker, args.linknx_latency, args.linknx_jitter, args.linknx_error_rate)
+        self.modbus = FakeModbus(self.tracker, args.modbus_objects) if "modbus" in args.devices else None
+        self.apcupsd = FakeApcupsd(self.tracker) if "apcupsd" in args.devices else None
+        self.eiscp = FakeEiscp(self.tracker) if "eiscp" in args.devices else None
+        self.mqtt = FakeMqttBroker(self.tracker, args.mqtt_topics) if "mqtt" in args.devices else None
+        self.polled = [d for d in (self.modbus, self.apcupsd) if d]
+        self.stand_ins = [d for d in (self.linknx, self.modbus, self.apcupsd, self.eiscp, self.mqtt) if d]
+        self.listen_port = free_port()
+        self.daemon = None
+        self.workdir = tempfile.mkdtemp(prefix="knxadapter-load-")
+        self.sent = 0
+        self.results = []
+
+    def config(self):
+        args = self.args
+        plugins = []
+        for device in self.polled:
+            plugins.append(device.plugin_config(args.poll_interval))
+        for device in (self.eiscp, self.mqtt):
+            if device:
+                plugins.append(device.plugin_config())
+        return {"sys": {"listenHost": "127.0.0.1", "verbosity": args.verbosity, "event_loop": args.event_loop},
+                "linknx": {"host": "127.0.0.1", "port": self.linknx.port, "listenPort": self.listen_port,
+                           "connections": args.connections, "timeout": 30.0,
+                           "write_window": args.write_window, "write_batch_max": 32},
+                "plugins": plugins}
+
+    async def start_daemon(self):
+        cfg_file = os.path.join(self.workdir, "config.json")
+        with open(cfg_file, "w") as f:
+            json.dump(self.config(), f, indent=2)
+        self.log_file = os.path.join(self.workdir, "knxadapter3.log")
+        with open(self.log_file, "wb") as log:
+            self.daemon = await asyncio.create_subprocess_exec(sys.executable, DAEMON, cfg_file, stderr=log, stdout=log)
+        deadline = monotonic() + 15
+        while True:
+            try:
+                writer = (await asyncio.open_connection("127.0.0.1", self.listen_port))[1]
+                writer.close()
+                break
+            except OSError:
+                if self.daemon.returncode is not None or monotonic() > deadline:
+                    raise RuntimeError(f"knxadapter3 didn't start, see {self.log_file}")
+                await asyncio.sleep(0.1)
+        await self.linknx.connect_inbound(self.listen_port, self.args.inbound_connections, self.args.inbound_oneshot)
+        await asyncio.sleep(self.args.warmup)
+
+    def daemon_cpu(self):
+        try:
+            with open(f"/proc/{self.daemon.pid}/stat") as f:
+                fields = f.read().rpartition(")")[2].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def push_channels(self):
+        channels = []
+        if self.mqtt and self.mqtt.connected:
+            channels.append("mqtt")
+            if self.args.inbound_share > 0:
+                channels.append("inbound")
+        if self.eiscp and self.eiscp.connected:
+            channels.append("eiscp")
+        return channels
+
+    def push(self, channel):
+        self.sent += 1
+        if channel == "inbound":
+            self.linknx.send_command(self.sent, f"load:mqtt:set_{self.sent % self.args.mqtt_topics}", str(self.sent))
+        elif channel == "mqtt":
+            self.mqtt.publish(self.sent, str(self.sent))
+        elif channel == "eiscp":
+            self.eiscp.push()
+
+    async def generate(self, rate, duration):
+        """ Sends rate messages per second without drifting, returns the number sent """
+        channels = self.push_channels()
+        others = [c for c in channels if c != "inbound"]
+        share = self.args.inbound_share if others else 1.0
+        started = monotonic()
+        next_tick = started + self.args.change_interval
+        sent = 0
+        while True:
+            now = monotonic()
+            if now - started >= duration:
+                break
+            if self.polled and now >= next_tick:
+                for device in self.polled:
+                    device.tick()
+                next_tick += self.args.change_interval
+            due = int((now - started) * rate) - sent if channels else 0
+            for _ in range(due):
+                if "inbound" in channels and (not others or random.random() < share):
+                    self.push("inbound")
+                elif others:
+                    self.push(others[sent % len(others)])
+                sent += 1
+            if due:
+                await self.linknx.drain()
+            await asyncio.sleep(0.001)
+        return sent / (monotonic() - started)
+
+    async def stage(self, rate):
+        args = self.args
+        self.tracker.reset()
+        requests, objects, errors = self.linknx.requests, self.linknx.objects, self.linknx.errors
+        cpu = self.daemon_cpu()
+        started = monotonic()
+        offered = await self.generate(rate, args.duration)
+        await asyncio.sleep(args.drain)
+        elapsed = monotonic() - started
+        self.tracker.finish()
+        if cpu is not None:
+            cpu = (self.daemon_cpu() - cpu) / elapsed
+
+        requests = (self.linknx.requests - requests) / elapsed
+        objects = (self.linknx.objects - objects) / elapsed
+        errors = self.linknx.errors - errors
+        print(f"\nrate {rate:g}/s: offered {offered:.1f}/s, LinKNX {requests:.1f} requests/s with {objects:.1f} objects/s, "
+              f"{errors} rejected" + (f", daemon cpu {cpu:.0%}" if cpu is not None else ""))
+        print(f"  {'source':10} {'produced':>9} {'delivered':>9} {'superseded':>10} {'lost':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        pushed_lost = pushed_total = 0
+        pushed_latencies = []
+        for source in sorted(self.tracker.produced):
+            latencies = sorted(self.tracker.latencies[source])
+            lost = self.tracker.lost[source]
+            print(f"  {source:10} {self.tracker.produced[source]:>9} {len(latencies):>9} {self.tracker.superseded[source]:>10} {lost:>6} "
+                  + " ".join(f"{percentile(latencies, p) * 1000:>8.1f}" for p in (0.5, 0.9, 0.99, 1.0)))
+            if source not in ("modbus", "apcupsd"):
+                pushed_lost += lost
+                pushed_total += self.tracker.produced[source]
+                pushed_latencies += latencies
+        if self.tracker.unexpected:
+            print(f"  {self.tracker.unexpected} values arrived which weren't pending")
+
+        if not pushed_total:
+            # without pushed traffic only the polled devices' losses count, their latency includes the poll interval
+            print("  no pushed messages, the mqtt and eiscp plugins aren't running")
+            polled_lost = sum(self.tracker.lost.values())
+            sustainable = polled_lost <= args.max_loss * sum(self.tracker.produced.values())
+            print(f"  {'sustainable' if sustainable else 'NOT sustainable'} ({polled_lost} polled values lost)")
+            pushed_latencies = sorted(latency for latencies in self.tracker.latencies.values() for latency in latencies)
+        else:
+            pushed_latencies.sort()
+            p99 = percentile(pushed_latencies, 0.99)
+            sustainable = pushed_lost <= args.max_loss * pushed_total and p99 <= args.max_p99 and offered >= 0.95 * rate
+            if offered < 0.95 * rate:
+                print("  the load generator couldn't keep up, run it on a separate machine for higher rates")
+            print(f"  {'sustainable' if sustainable else 'NOT sustainable'} (pushed p99 {p99 * 1000:.1f} ms, {pushed_lost} of {pushed_total} lost)")
+        self.results.append({"rate": rate, "p50": percentile(pushed_latencies, 0.5), "p99": percentile(pushed_latencies, 0.99),
+                             "cpu": cpu, "sustainable": sustainable})
+        return sustainable
+
+    def rates(self):
+        if not self.args.ramp:
+            return [self.args.rate]
+        start, factor, maximum = (float(v) for v in self.args.ramp.split(":"))
+        rates = []
+        while start <= maximum:
+            rates.append(start)
+            start *= factor
+        return rates
+
+    async def run(self):
+        for stand_in in self.stand_ins:
+            await stand_in.start()
+        try:
+            await self.start_daemon()
+            print(f"knxadapter3 pid {self.daemon.pid} running in {self.workdir}")
+            missing = [name for name, device in (("mqtt", self.mqtt), ("eiscp", self.eiscp)) if device and not device.connected]
+            missing += [name for name, device in (("modbus", self.modbus), ("apcupsd", self.apcupsd)) if device and not device.requests]
+            self.polled = [device for device in self.polled if device.requests]
+            if missing:
+                print(f"{', '.join(missing)} plugins didn't connect, see {self.log_file}")
+            best = None
+            rates = self.rates() if self.push_channels() else [0]
+            for rate in rates:
+                if await self.stage(rate):
+                    best = rate
+                elif self.args.ramp:
+                    break
+            if self.args.ramp and rate:
+                print(f"\nmaximum sustainable rate: {f'{best:g} messages/s' if best else 'none of the tested rates'}")
+        finally:
+            if self.daemon and self.daemon.returncode is None:
+                self.daemon.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(self.daemon.wait(), timeout=10)
+                except asyncio.TimeoutError:
+                    self.daemon.kill()
+                    await self.daemon.wait()
+            for stand_in in self.stand_ins:
+                stand_in.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="knxadapter3 end-to-end load test")
+    parser.add_argument("--rate", type=float, default=100, help="pushed messages per second (default %(default)s)")
+    parser.add_argument("--ramp", help="start:factor:max, multiply the rate per stage until it isn't sustainable")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per stage (default %(default)s)")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for stragglers after a stage (default %(default)s)")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds for the plugins to connect (default %(default)s)")
+    parser.add_argument("--devices", default="modbus,apcupsd,eiscp,mqtt", help="stand-ins to run (default %(default)s)")
+    parser.add_argument("--modbus-objects", type=int, default=20, help="registers polled from the modbus meter (default %(default)s)")
+    parser.add_argument("--mqtt-topics", type=int, default=10, help="sensor and command topics (default %(default)s)")
+    parser.add_argument("--poll-interval", type=float, default=1, help="poll interval of modbus and apcupsd (default %(default)s)")
+    parser.add_argument("--change-interval", type=float, default=1, help="seconds between value changes of polled devices (default %(default)s)")
+    parser.add_argument("--inbound-share", type=float, default=0.3, help="share of pushed messages sent as group=value commands (default %(default)s)")
+    parser.add_argument("--inbound-connections", type=int, default=1, help="persistent connections to listenPort (default %(default)s)")
+    parser.add_argument("--inbound-oneshot", action="store_true", help="open a connection per command like simple LinKNX rules")
+    parser.add_argument("--linknx-latency", type=float, default=0.005, help="seconds until LinKNX replies (default %(default)s)")
+    parser.add_argument("--linknx-jitter", type=float, default=0.0, help="random +- seconds added to the latency (default %(default)s)")
+    parser.add_argument("--linknx-error-rate", type=float, default=0.0, help="share of rejected writes (default %(default)s)")
+    parser.add_argument("--connections", type=int, default=2, help="linknx connections of the daemon (default %(default)s)")
+    parser.add_argument("--write-window", type=float, default=0.0, help="linknx write_window of the daemon (default %(default)s)")
+    parser.add_argument("--max-loss", type=float, default=0.01, help="share of pushed values which may get lost (default %(default)s)")
+    parser.add_argument("--max-p99", type=float, default=0.5, help="sustainable 99th percentile latency in seconds (default %(default)s)")
+    parser.add_argument("--event-loops", default="asyncio", help="comma separated event loops of the daemon to compare, asyncio and uvloop (default %(default)s)")
+    parser.add_argument("--verbosity", default="warning", help="log level of the daemon (default %(default)s)")
+    args = parser.parse_args()
+    args.devices = set(args.devices.split(","))
+    if args.inbound_share > 0 and "mqtt" not in args.devices:
+        parser.error("group=value commands are published to MQTT, they need the mqtt stand-in")
+    results = {}
+    for event_loop in args.event_loops.split(","):
+        if event_loop != "asyncio" and not importlib.util.find_spec(event_loop):
+            print(f"{event_loop} isn't installed, skipping it")
+            continue
+        args.event_loop = event_loop
+        print(f"\n=== {event_loop} event loop")
+        load_test = LoadTest(args)
+        asyncio.run(load_test.run())
+        results[event_loop] = load_test.results
+    if len(results) > 1:
+        compare(results)
+
+def compare(results):
+    """ Prints latency and cpu of each stage side by side, relative to the first event loop """
+    loops = list(results)
+    base = loops[0]
+    print(f"\n{'rate':>8} {'loop':10} {'p50 ms':>8} {'p99 ms':>8} {'cpu':>6}  vs {base}")
+    for i, stage in enumerate(results[base]):
+        for event_loop in loops:
+            if i >= len(results[event_loop]):
+                continue
+            result = results[event_loop][i]
+            cpu = f"{result['cpu']:.0%}" if result["cpu"] is not None else "-"
+            versus = ""
+            if event_loop != base:
+                versus = f"p99 {result['p99'] / stage['p99']:.2f}x" if stage["p99"] > 0 else ""
+                if result["cpu"] and stage["cpu"]:
+                    versus += f", cpu {result['cpu'] / stage['cpu']:.2f}x"
+            print(f"{result['rate']:>8g} {event_loop:10} {result['p50'] * 1000:>8.1f} {result['p99'] * 1000:>8.1f} {cpu:>6}  {versus}")
+    for event_loop in loops:
+        best = [result["rate"] for result in results[event_loop] if result["sustainable"]]
+        print(f"{event_loop}: highest sustainable rate {f'{max(best):g}/s' if best else 'none'}")
+
+if __name__ == "__main__":
+    main()
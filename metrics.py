@@ -0,0 +1,179 @@
+'''
+  metrics.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import asyncio
+from bisect import bisect_left
+from time import monotonic
+from helper import knxalog as log
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for le, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            yield name + "_bucket", labels + (("le", str(le)),), cumulative
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, self.count
+
+class Gauge:
+    """ Read from a function when scraped, so it costs nothing in between """
+    __slots__ = ("fn",)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def samples(self, name, labels):
+        yield name, labels, self.fn()
+
+class NullMetric:
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+NULL_METRIC = NullMetric()
+
+class Metrics:
+    """ Registry of counters, histograms and gauges rendered in the Prometheus text format.
+        Metric objects are looked up once by their users and updated directly on the hot path,
+        when disabled all of them are the same no-op object. """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._families = {}
+        self._server = None
+        self._lag_task = None
+
+    def _get(self, kind, name, help_text, labels, factory):
+        if not self.enabled:
+            return NULL_METRIC
+        family = self._families.setdefault(name, (kind, help_text, {}))
+        key = tuple(sorted(labels.items()))
+        if key not in family[2]:
+            family[2][key] = factory()
+        return family[2][key]
+
+    def counter(self, name, help_text, **labels):
+        return self._get("counter", name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        return self._get("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def _register_fn(self, kind, name, help_text, fn, labels):
+        if not self.enabled:
+            return
+        family = self._families.setdefault(name, (kind, help_text, {}))
+        family[2][tuple(sorted(labels.items()))] = Gauge(fn)
+
+    def gauge(self, name, help_text, fn, **labels):
+        self._register_fn("gauge", name, help_text, fn, labels)
+
+    def counter_fn(self, name, help_text, fn, **labels):
+        """ A counter kept by someone else, fn returns its ever increasing value when scraped """
+        self._register_fn("counter", name, help_text, fn, labels)
+
+    def remove(self, **labels):
+        """ Drops every series carrying all of the given labels, e.g. those of a plugin that was stopped """
+        wanted = set(labels.items())
+        for name, (kind, help_text, metrics) in list(self._families.items()):
+            for key in [key for key in metrics if wanted <= set(key)]:
+                del metrics[key]
+            if not metrics:
+                del self._families[name]
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, metrics) in sorted(self._families.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics.items():
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    if sample_labels:
+                        label_str = ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in sample_labels)
+                        lines.append(f"{sample}{{{label_str}}} {value}")
+                    else:
+                        lines.append(f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5.0)
+            while (await asyncio.wait_for(reader.readline(), timeout=5.0)).strip():
+                pass
+            if request.split()[1:2] == [b"/metrics"]:
+                status, body = "200 OK", self.render()
+            else:
+                status, body = "404 Not Found", "Not found\n"
+            payload = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    async def _watch_loop_lag(self, interval):
+        lag = self.histogram("knxadapter_loop_lag_seconds", "Delay of event loop wakeups")
+        while True:
+            started = monotonic()
+            await asyncio.sleep(interval)
+            lag.observe(max(0.0, monotonic() - started - interval))
+
+    async def serve(self, host, port):
+        if not self.enabled:
+            return
+        self._server = await asyncio.start_server(self._handle_http, host, port)
+        self._lag_task = asyncio.create_task(self._watch_loop_lag(0.5))
+        log.info(f"serving metrics on http://{host}:{port}/metrics")
+
+    def close(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+        if self._server:
+            self._server.close()
@@ -0,0 +1,252 @@
+'''
+  modbus_client.py is part of knxadapter3.py
+  Copyright (C) 2020 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import struct
+import asyncio
+from time import monotonic
+from helper import knxalog as log
+
+READ_HOLDING_REGISTERS = 3
+# exception codes of a device refusing the registers asked for
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+# a read reply carries at most 125 registers
+MAX_BLOCK = 125
+
+# registers per data type and their struct format
+DATA_TYPES = {"float": (2, "f"), "I16": (1, "h"), "U16": (1, "H"), "I32": (2, "i"), "U32": (2, "I"), "U64": (4, "Q")}
+# compiled once per data type for big endian words, and for little endian word order: after swapping the
+# bytes of every register, a value whose least significant register comes first reads as little endian
+_STRUCTS = {data_type: (struct.Struct(">" + fmt), struct.Struct("<" + fmt)) for data_type, (count, fmt) in DATA_TYPES.items()}
+
+class ModbusError(Exception):
+    """ The device answered with a Modbus exception response """
+    def __init__(self, function, code):
+        super().__init__(f"function {function} exception code {code}")
+        self.function = function
+        self.code = code
+
+class ReadBlock:
+    """ A range of registers read with one request and the values decoded from it.
+        fields holds (index, byte offset, data type) per value, index is the value's position in the results. """
+    __slots__ = ("start", "count", "fields", "parts")
+
+    def __init__(self, start, count, fields):
+        self.start = start
+        self.count = count
+        self.fields = fields
+        # set when the device refused the whole block, then its values are read one by one
+        self.parts = None
+
+    def split(self):
+        return [ReadBlock(self.start + offset // 2, DATA_TYPES[data_type][0], [(index, 0, data_type)])
+                for index, offset, data_type in self.fields]
+
+    def decode(self, data, values, wordorder="BE"):
+        """ Decodes the block's reply bytes into values """
+        little = wordorder == "LE"
+        if little:
+            swapped = bytearray(len(data))
+            swapped[0::2] = data[1::2]
+            swapped[1::2] = data[0::2]
+            data = swapped
+        for index, offset, data_type in self.fields:
+            value = _STRUCTS[data_type][little].unpack_from(data, offset)[0]
+            values[index] = round(value, 2) if data_type == "float" else value
+
+    def __repr__(self):
+        return f"ReadBlock({self.start}+{self.count}, {len(self.fields)} values)"
+
+def plan_blocks(objects, max_block=MAX_BLOCK, max_gap=0):
+    """ Merges (index, register, data type) into blocks of at most max_block registers, registers
+        which are up to max_gap registers apart share a block and the gap is read along """
+    blocks = []
+    block = None
+    for index, register, data_type in sorted(objects, key=lambda o: (o[1], o[0])):
+        count = DATA_TYPES[data_type][0]
+        if block and register <= block.start + block.count + max_gap and register + count - block.start <= max_block:
+            block.count = max(block.count, register + count - block.start)
+        else:
+            block = ReadBlock(register, count, [])
+            blocks.append(block)
+        block.fields.append((index, (register - block.start) * 2, data_type))
+    return blocks
+
+class ModbusClient:
+    """ Modbus-TCP client on asyncio streams. Requests carry a transaction id, so several of them can
+        be in flight on the one connection and their replies are matched in any order. A dropped
+        connection fails the pending requests and is re-established by the next request, as is one
+        which stopped answering. Consecutive requests are sent at least pacing seconds apart, and
+        as long after the previous reply, for gateways which need a pause on their serial line. """
+
+    def __init__(self, host, port, timeout=3.0, connect_timeout=5.0, max_inflight=4, pacing=0.0, name="modbus"):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.name = name
+        self.max_timeouts = 3
+        self.max_inflight = max(1, max_inflight)
+        self.pacing = pacing
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._next_send = 0.0
+        self._connect_lock = asyncio.Lock()
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._pending = {}
+        self._tid = 0
+        self._timeouts = 0
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.connected:
+                return
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), timeout=self.connect_timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError(f"{self.name} no connection to {self.host}:{self.port} within {self.connect_timeout} s")
+            self._timeouts = 0
+            self._reader_task = asyncio.get_running_loop().create_task(self._read_replies(self._reader), name=f"{self.name}:replies")
+            log.debug("%s connected to %s:%s", self.name, self.host, self.port)
+
+    async def request(self, unit, pdu, timeout=None):
+        """ Sends one request PDU and returns the reply's PDU without the function code """
+        async with self._inflight:
+            if not self.connected:
+                await self.connect()
+            if self.pacing:
+                # re-checked after the sleep, another request may have been sent meanwhile
+                while (wait := self._next_send - monotonic()) > 0:
+                    await asyncio.sleep(wait)
+                self._next_send = monotonic() + self.pacing
+            self._tid = (self._tid + 1) & 0xFFFF
+            tid = self._tid
+            reply = asyncio.get_running_loop().create_future()
+            self._pending[tid] = reply
+            writer = self._writer
+            writer.write(struct.pack(">HHHB", tid, 0, len(pdu) + 1, unit) + pdu)
+            try:
+                await writer.drain()
+                return await asyncio.wait_for(reply, timeout=timeout or self.timeout)
+            except asyncio.TimeoutError:
+                self._timeouts += 1
+                if self._timeouts >= self.max_timeouts and writer is self._writer:
+                    self.close(ConnectionError(f"{self.name} {self._timeouts} requests without reply"))
+                raise
+            except ConnectionError as e:
+                # the connection may have been replaced by another request meanwhile
+                if writer is self._writer:
+                    self.close(e)
+                raise
+            finally:
+                self._pending.pop(tid, None)
+                if self.pacing:
+                    self._next_send = max(self._next_send, monotonic() + self.pacing)
+
+    async def read_registers(self, address, count, unit, timeout=None):
+        """ Reads count holding registers, returns their bytes """
+        data = await self.request(unit, struct.pack(">BHH", READ_HOLDING_REGISTERS, address, count), timeout)
+        if len(data) < 1 + 2 * count or data[0] != 2 * count:
+            raise ModbusError(READ_HOLDING_REGISTERS, "short reply")
+        return data[1:1 + 2 * count]
+
+    async def read_holding_registers(self, address, count, unit, timeout=None):
+        return struct.unpack(f">{count}H", await self.read_registers(address, count, unit, timeout))
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                tid, protocol, length, unit = struct.unpack(">HHHB", await reader.readexactly(7))
+                if not 2 <= length <= 254:
+                    # unit id and function code at least, a PDU has at most 253 bytes
+                    raise ValueError(f"invalid MBAP length {length}")
+                pdu = await reader.readexactly(length - 1)
+                # any reply, even a late one, shows the connection still works, a unit which
+                # doesn't answer behind a gateway mustn't get the connection of the others closed
+                self._timeouts = 0
+                reply = self._pending.get(tid)
+                if reply is None or reply.done():
+                    # the request timed out already
+                    continue
+                function = pdu[0]
+                if function & 0x80:
+                    reply.set_exception(ModbusError(function & 0x7F, pdu[1] if len(pdu) > 1 else None))
+                else:
+                    reply.set_result(pdu[1:])
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = ConnectionError(f"{self.name} connection lost ({e!r})")
+        except ValueError as e:
+            # the stream is out of step, every unit on the connection needs a new one
+            log.warning("%s unreadable reply: %r", self.name, e)
+            error = ConnectionError(f"{self.name} unreadable reply ({e!r})")
+        if reader is self._reader:
+            self._reader_task = None
+            self.close(error)
+
+    def close(self, error=None):
+        if self._writer:
+            self._writer.close()
+            log.debug("%s disconnected", self.name)
+        self._reader = self._writer = None
+        if self._reader_task:
+            self._reader_task.cancel()
+            self._reader_task = None
+        for reply in self._pending.values():
+            if not reply.done():
+                reply.set_exception(error or ConnectionError(f"{self.name} closed"))
+
+# clients shared by all plugins talking to the same host and port, [client, users]
+_gateways = {}
+
+def acquire(host, port, timeout=3.0, connect_timeout=5.0, max_inflight=4, pacing=0.0):
+    """ Returns the client of a host and port, so devices behind one Modbus-TCP gateway share its
+        connection. The first user's max_inflight applies, the longest pacing of all users. """
+    key = (host, port)
+    entry = _gateways.get(key)
+    if entry is None:
+        client = ModbusClient(host, port, timeout=timeout, connect_timeout=connect_timeout, max_inflight=max_inflight,
+                              pacing=pacing, name=f"modbus {host}:{port}")
+        _gateways[key] = entry = [client, 0]
+    else:
+        client = entry[0]
+        if max(1, max_inflight) != client.max_inflight:
+            log.warning("%s already allows %d requests in flight, ignoring %d", client.name, client.max_inflight, max_inflight)
+        if pacing > client.pacing:
+            client.pacing = pacing
+    entry[1] += 1
+    return client
+
+def release(client):
+    """ Gives up a client from acquire(), the last user closes its connection """
+    key = (client.host, client.port)
+    entry = _gateways.get(key)
+    if entry is None or entry[0] is not client:
+        client.close()
+        return
+    entry[1] -= 1
+    if entry[1] <= 0:
+        del _gateways[key]
+        client.close()
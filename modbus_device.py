@@ -20,118 +20,168 @@
 
 import asyncio
 import logging
-from helper import BasePlugin, knxalog as log
-import pymodbus
-from pymodbus.client.sync import ModbusTcpClient
+from time import monotonic
+from helper import BasePlugin, Deadband, NAN, log_ratelimited, knxalog as log
+import struct
+import modbus_client
+from modbus_client import ModbusError, DATA_TYPES, MAX_BLOCK, ILLEGAL_DATA_ADDRESS, ILLEGAL_DATA_VALUE, plan_blocks
 
 def plugin_def():
     return ModbusDevice
 
 class ModbusDevice(BasePlugin):
-    def _read_float(self,register):
-        reg = self.client.read_holding_registers(register, 2, unit=71)
-        pay = self.modbus_bin_pay_dec.fromRegisters(reg.registers, byteorder=self._BE, wordorder=self.wordorder)
-        return round(pay.decode_32bit_float(), 2)
-
-    def _read_i16(self,register):
-        reg = self.client.read_holding_registers(register, 1, unit=71)
-        pay = self.modbus_bin_pay_dec.fromRegisters(reg.registers, byteorder=self._BE, wordorder=self.wordorder)
-        return pay.decode_16bit_int()
-
-    def _read_u16(self,register):
-        reg = self.client.read_holding_registers(register, 1, unit=71)
-        pay = self.modbus_bin_pay_dec.fromRegisters(reg.registers, byteorder=self._BE, wordorder=self.wordorder)
-        return pay.decode_16bit_uint()
-
-    def _read_i32(self,register):
-        reg = self.client.read_holding_registers(register, 2, unit=71)
-        pay = self.modbus_bin_pay_dec.fromRegisters(reg.registers, byteorder=self._BE, wordorder=self.wordorder)
-        return pay.decode_32bit_int()
-
-    def _read_u32(self,register):
-        reg = self.client.read_holding_registers(register, 2, unit=71)
-        pay = self.modbus_bin_pay_dec.fromRegisters(reg.registers, byteorder=self._BE, wordorder=self.wordorder)
-        return pay.decode_32bit_uint()
-
-    def _read_u64(self,register):
-        reg = self.client.read_holding_registers(register, 4, unit=71)
-        pay = self.modbus_bin_pay_dec.fromRegisters(reg.registers, byteorder=self._BE, wordorder=self.wordorder)
-        return pay.decode_64bit_uint()
-
-    def _read_modbus(self, data_type, register):
-        methods = {"float": self._read_float, "I16": self._read_i16, "U16": self._read_u16, "I32": self._read_i32, "U32": self._read_u32, "U64": self._read_u64}
-        ret = None
-        try:
-            func = methods[data_type]
-            ret = func(register)
-        except KeyError:
-            log.warning("Modbus Data Type {} not found for register {} on device {}".format(data_type, register, self.device_name))
-        except:
-            log.warning("Couldn't read register {} from Modbus device {}".format(register, self.device_name))
-        return ret
+    # pymodbus' ModbusTcpClient isn't thread-safe, keep its requests in order
+    executor_workers = 1
+    default_precision = 0
+    # the device's Modbus unit id unless configured as unit_id
+    unit = 71
 
     def __init__(self, daemon, cfg):
         super(ModbusDevice, self).__init__(daemon, cfg)
-        modbuslog = logging.getLogger('pymodbus')
-        modbuslog.setLevel(logging.ERROR)
+        # "async" talks Modbus-TCP on the event loop, "pymodbus" runs pymodbus' blocking client on a thread
+        self.client_mode = cfg.get("modbus_client", "async")
+        self.unit = cfg.get("unit_id", self.unit)
+        self.timeout = cfg.get("modbus_timeout", 3.0)
+        if self.client_mode == "pymodbus":
+            modbuslog = logging.getLogger('pymodbus')
+            modbuslog.setLevel(logging.ERROR)
+
+        self.wordorder = cfg.get("modbus_wordorder", "BE")
+        self.max_block = max(1, min(cfg.get("modbus_max_block", MAX_BLOCK), MAX_BLOCK))
+        self.max_gap = cfg.get("modbus_max_gap", 0)
 
         self.poll_interval = "poll_interval" in cfg and cfg["poll_interval"] or 10
-        default_magnitude = "default_magnitude" in self.cfg and self.cfg["default_magnitude"] or 1.0
-        default_precision = "default_precision" in self.cfg and self.cfg["default_precision"] or 0
-        for obj in self.obj_list:
-            if not "magnitude" in obj:
-                obj.update({"magnitude": default_magnitude})
-            if not "precision" in obj:
-                obj.update({"precision": default_precision})
+        self.rates = self.plan_rates()
+        # blocks per combination of poll intervals due together
+        self._plans = {}
+        self._poll_duration = daemon.metrics.histogram("knxadapter_poll_seconds", "Duration of a plugin's poll cycle", plugin=self.device_name)
+        self.deadband = Deadband(self.obj_list, daemon.metrics.counter("knxadapter_hysteresis_suppressed_total", "Values not sent because of hysteresis", plugin=self.device_name))
+
+    # poll intervals falling due within this many seconds of each other are read together
+    schedule_slack = 0.05
+
+    def plan_rates(self):
+        """ Groups the objects by their poll_interval, the plugin's one unless set per object """
+        rates = {}
+        for i, o in enumerate(self.obj_list):
+            if o["data_type"] not in DATA_TYPES:
+                log.warning("Modbus Data Type %s not found for register %s on device %s", o["data_type"], o["register"], self.device_name)
+                continue
+            interval = o.get("poll_interval") or self.poll_interval
+            rates.setdefault(interval, []).append((i, o["register"], o["data_type"]))
+        return rates
+
+    def plan_reads(self, intervals):
+        """ Returns the blocks reading the objects of the given poll intervals with one request each """
+        blocks = self._plans.get(intervals)
+        if blocks is None:
+            objects = [obj for interval in intervals for obj in self.rates[interval]]
+            blocks = self._plans[intervals] = plan_blocks(objects, self.max_block, self.max_gap)
+            log.debug("%s reads %d registers every %r s in %r", self.device_name, len(objects), intervals, blocks)
+        return blocks
 
     async def handle_sm(self):
         log.debug('handle_sm...')
-        from pymodbus.constants import Endian
-        from pymodbus.payload import BinaryPayloadDecoder
-        self._BE = Endian.Big
-        if self.cfg["modbus_wordorder"] == "LE":
-            self.wordorder = Endian.Little
-        else:
-            self.wordorder = Endian.Big
-        self.modbus_bin_pay_dec = BinaryPayloadDecoder
+        if not self.rates:
+            log.warning("%s has no registers to read", self.device_name)
+            return
+        # every interval runs on a fixed grid from the start, the time a poll takes doesn't shift the next one
+        start = monotonic()
+        next_due = {interval: start for interval in self.rates}
         while True:
-            group_value_dict = {}
-
-            for o in self.obj_list:
-                register = o["register"]
-                raw_val = self._read_modbus(o["data_type"], o["register"])
-                if raw_val is None:
-                    continue
-                prev_val = o["value"]
-
-                mag = o["magnitude"]
-                value = round(raw_val * o["magnitude"], 3)
-
-                debug_msg = "{} read {} raw={} => value={}".format(self.device_name, o["knx_group"], raw_val, value)
-
-                hysteresis = o["hysteresis"]
-                if type(hysteresis) == str and "%" in hysteresis and abs(value - prev_val) <= float(hysteresis.strip('%'))*value*0.01 or type(hysteresis) in (int, float) and abs(value - prev_val) <= hysteresis:
-                    log.debug("{}-{} < {} hysteresis, ignored!".format(debug_msg, prev_val, hysteresis))
-                    continue
-                elif prev_val == value:
-                    log.debug("{} unchanged, ignored!".format(debug_msg))
-                    continue
-                else:
-                    log.debug("{} UPDATED from {}".format(debug_msg,prev_val))
-
-                prec = o["precision"]
-                str_value = "%.{}f".format(prec) % round(value, prec)
-                group_value_dict[o["knx_group"]] = str_value
-
-                o["value"] = value
-
-            if group_value_dict:
-                await self.d.set_group_value_dict(group_value_dict)
-
-            await asyncio.sleep(self.poll_interval)
+            now = monotonic()
+            due = tuple(sorted(interval for interval, t in next_due.items() if t <= now + self.schedule_slack))
+            if due:
+                raw_values = await self.read_objects(self.plan_reads(due))
+                group_value_dict = self.process_readings(raw_values)
+                finished = monotonic()
+                self._poll_duration.observe(finished - now)
+                for interval in due:
+                    t = next_due[interval] + interval
+                    if t <= finished:
+                        # the poll overran, skip the slots it missed instead of catching up in a burst
+                        skipped = (finished - t) // interval + 1
+                        log_ratelimited((self.device_name, "overrun"), logging.WARNING, "%s poll took %.1f s, skipping %d polls of the %s s interval", self.device_name, finished - now, skipped, interval)
+                        t += skipped * interval
+                    next_due[interval] = t
+                if group_value_dict:
+                    await self.d.set_group_value_dict(group_value_dict)
+            await asyncio.sleep(max(0.0, min(next_due.values()) - monotonic()))
+
+    def _read_registers_sync(self, address, count):
+        try:
+            reg = self.client.read_holding_registers(address, count, unit=self.unit)
+        except Exception as e:
+            # pymodbus raises its own exceptions for connection problems
+            raise ConnectionError(repr(e)) from e
+        if reg.isError():
+            raise ModbusError(3, getattr(reg, "exception_code", None))
+        return struct.pack(f">{count}H", *reg.registers)
+
+    async def read_registers(self, address, count):
+        if self.client_mode == "pymodbus":
+            return await self.run_blocking(self._read_registers_sync, address, count)
+        return await self.client.read_registers(address, count, self.unit, self.timeout)
+
+    async def _read_block(self, block, values):
+        if block.parts:
+            for part in block.parts:
+                await self._read_block(part, values)
+            return
+        try:
+            data = await self.read_registers(block.start, block.count)
+        except ModbusError as e:
+            if len(block.fields) > 1 and e.code in (ILLEGAL_DATA_ADDRESS, ILLEGAL_DATA_VALUE):
+                # the block may span registers the device doesn't have, read its values one by one from now on
+                log.warning("%s refused to read registers %s-%s (%r), reading them separately", self.device_name, block.start, block.start + block.count - 1, e)
+                block.parts = block.split()
+                await self._read_block(block, values)
+            else:
+                log_ratelimited((self.device_name, block.start), logging.WARNING, "Couldn't read register %s from Modbus device %s: %r", block.start, self.device_name, e)
+            return
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+            log_ratelimited((self.device_name, block.start), logging.WARNING, "Couldn't read registers %s-%s from Modbus device %s: %r", block.start, block.start + block.count - 1, self.device_name, e)
+            return
+        block.decode(data, values, self.wordorder)
+
+    async def read_objects(self, blocks):
+        """ Returns the raw values in the order of obj_list, NaN for registers which weren't or couldn't be read """
+        values = [NAN] * len(self.obj_list)
+        # the blocks are in flight together, up to modbus_inflight at a time; the pymodbus client takes them in turn
+        await asyncio.gather(*[self._read_block(block, values) for block in blocks])
+        return values
+
+    def process_readings(self, raw_values):
+        values = [round(raw_val * o.magnitude, 3) for raw_val, o in zip(raw_values, self.obj_list)]
+        group_value_dict = self.deadband.evaluate(values)
+        log.debug("%s read %r, changed: %r", self.device_name, raw_values, group_value_dict)
+        return group_value_dict
+
+    async def connect(self):
+        if self.client_mode != "pymodbus":
+            # devices behind the same gateway share its connection
+            if self.client is None:
+                self.client = modbus_client.acquire(self.cfg["host"], self.cfg["port"], timeout=self.timeout,
+                                                    connect_timeout=self.cfg.get("connect_timeout", 10.0),
+                                                    max_inflight=self.cfg.get("modbus_inflight", 4),
+                                                    pacing=self.cfg.get("modbus_pacing", 0.0))
+            await self.client.connect()
+            return
+        # connect retries reuse the client, a failed attempt closes its socket
+        if self.client is None:
+            from pymodbus.client.sync import ModbusTcpClient
+            self.client = ModbusTcpClient(self.cfg["host"],port=self.cfg["port"])
+        if not await self.run_blocking(self.client.connect):
+            self.client.close()
+            raise ConnectionError(f"{self.device_name} can't connect to {self.cfg['host']}:{self.cfg['port']}")
+
+    def quit(self):
+        if self.client_mode != "pymodbus" and self.client:
+            log.info("release gateway connection of %s...", self.device_name)
+            modbus_client.release(self.client)
+            self.client = None
+        super().quit()
 
     def _run(self):
-        self.client = ModbusTcpClient(self.cfg["host"],port=self.cfg["port"])
-        self.client.connect()
         handle_task = self.d.loop.create_task(self.handle_sm())
         return [handle_task]
@@ -21,7 +21,7 @@
 import asyncio
 import logging
 from contextlib import AsyncExitStack, asynccontextmanager
-from helper import BasePlugin, knxalog as log
+from helper import BasePlugin, log_ratelimited, knxalog as log
 from asyncio_mqtt import Client, MqttCodeError, MqttError
 from json import loads
 
@@ -37,13 +37,22 @@ class MQTT(BasePlugin):
         self._mqtt_tasks = None
         self._mqtt_client = None
         self.status_pending_for_groups = []
+        self._received = daemon.metrics.counter("knxadapter_mqtt_messages_total", "MQTT messages handled", plugin=self.device_name, direction="received")
+        self._published = daemon.metrics.counter("knxadapter_mqtt_messages_total", "MQTT messages handled", plugin=self.device_name, direction="published")
+        self._objs_by_topic = {}
+        self._json_topics = set()
+        for o in self.obj_list:
+            self._objs_by_topic.setdefault(o["topic"], []).append(o)
+            if o.valmap:
+                # only valmaps look into JSON payloads
+                self._json_topics.add(o["topic"])
 
     async def mqtt_loop(self):
         while True:
           try:
               await self.mqtt_stack()
           except MqttError as error:
-              log.warning("MqttError: {error}. Reconnecting in {self.poll_interval} seconds.")
+              log.warning("MqttError: %s. Reconnecting in %s seconds.", error, self.poll_interval)
           finally:
               await asyncio.sleep(self.poll_interval)
 
@@ -71,19 +80,22 @@ class MQTT(BasePlugin):
             await asyncio.gather(*self._mqtt_tasks)
 
     async def mqtt_handle(self, messages, obj):
-        group_value_dict = {}
         async for message in messages:
+            self._received.inc()
+            group_value_dict = {}
             payload = message.payload.decode()
-            try:
-                jsonobj = loads(payload)
-            except ValueError:
-                jsonobj = None
-                value = str(payload)
+            value = payload
             objects = self._get_objects_by_topic(message.topic)
+            jsonobj = None
+            if message.topic in self._json_topics:
+                try:
+                    jsonobj = loads(payload)
+                except ValueError:
+                    pass
             for o in objects:
-                knx_group = o["knx_group"]
-                if jsonobj and "valmap" in o:
-                    for key, valdict in o["valmap"].items():
+                knx_group = o.knx_group
+                if isinstance(jsonobj, dict) and o.valmap:
+                    for key, valdict in o.valmap.items():
                         if key in jsonobj:
                             prop = jsonobj[key]
                             if type(valdict) == dict and prop in valdict:
@@ -92,20 +104,18 @@ class MQTT(BasePlugin):
                                 value = str(prop)
                         else:
                             value = None
-                            continue
-                prev_val = o["value"]
-                if value == None:
+                if value is None:
                     pass
-                elif prev_val != value:
-                    o["value"] = value
+                elif o.value != value:
+                    log.debug("%s mqtt topic=%s payload=%s knx_group=%s updated value %s=>%s", self.device_name, message.topic, payload, knx_group, o.value, value)
+                    o.value = value
                     group_value_dict[knx_group] = value
-                    log.debug(f"{self.device_name} mqtt topic={message.topic} payload={payload} knx_group={knx_group} updated value {prev_val}=>{value}")
-                    if group_value_dict:
-                        await self.d.set_group_value_dict(group_value_dict)
                 else:
-                    log.debug(f"{self.device_name} mqtt topic={message.topic} payload={payload} knx_group={knx_group} value={value} unchanged, ignored")
+                    log.debug("%s mqtt topic=%s payload=%s knx_group=%s value=%s unchanged, ignored", self.device_name, message.topic, payload, knx_group, value)
                 if knx_group in self.status_pending_for_groups:
                     self.status_pending_for_groups.remove(knx_group)
+            if group_value_dict:
+                await self.d.set_group_value_dict(group_value_dict)
 
     async def cancel_tasks(self):
         for task in self._mqtt_tasks:
@@ -126,37 +136,34 @@ class MQTT(BasePlugin):
             knx_group, knx_val = cmd.strip().split("=")
             try:
                 o = self.get_obj_by_knxgrp(knx_group)
-                if o["enabled"]:
+                if o.enabled:
                     debug_msg = f"{self.device_name} process_knx({knx_group}={knx_val})"
                     await self._write_mqtt(knx_group, knx_val, debug_msg)
             except StopIteration:
                 pass
             return True
         except Exception as e:
-            log.warning(f"{self.device_name} couldn't parse KNX command {cmd} ({str(e)})!")
+            log_ratelimited((self.device_name, "parse"), logging.WARNING, "%s couldn't parse KNX command %s (%s)!", self.device_name, cmd, e)
             return False
 
     async def _write_mqtt(self, knx_group, knx_val, debug_msg):
         if not self._mqtt_client:
             return
-        objects = []
-        request_status = False
-        for item in self.obj_list:
-            if item["knx_group"] == knx_group:
-                objects.append(item)
-                request_status = "request_status" in item
+        objects = self.get_objs_by_knxgrp(knx_group)
+        request_status = bool(objects) and "request_status" in objects[-1]
         for o in objects:
             if "publish_topic" in o:
                 topic = o["publish_topic"]
-                prev_val = o["value"]
-                if "valmap" in o:
-                    payload = o["valmap"][knx_val]
+                prev_val = o.value
+                if o.valmap:
+                    payload = o.valmap[knx_val]
                 else:
                     payload = knx_val
-                log.info(f"{debug_msg} topic {topic} updating {prev_val}=>{knx_val} ({payload})")
+                log.info("%s topic %s updating %s=>%s (%s)", debug_msg, topic, prev_val, knx_val, payload)
                 try:
                     await self._mqtt_client.publish(topic, payload, qos=1, retain=True)
-                    o["value"] = knx_val
+                    self._published.inc()
+                    o.value = knx_val
                 except MqttCodeError as error:
                     log.error(f"{debug_msg} MqttCodeError {error} on topic {topic}")
         if objects and request_status and "status_object" in self.cfg and self._mqtt_client and not knx_group in self.status_pending_for_groups:
@@ -167,17 +174,14 @@ class MQTT(BasePlugin):
             await asyncio.sleep(delay)
             try:
                 await self._mqtt_client.publish(topic, payload, qos=1, retain=True)
-                log.debug(f"{debug_msg} requested status topic {topic} payload=>{payload}")
+                self._published.inc()
+                log.debug("%s requested status topic %s payload=>%s", debug_msg, topic, payload)
                 self.status_pending_for_groups.append(knx_group)
             except MqttCodeError as error:
                 log.error(f"{debug_msg} MqttCodeError {error} on topic {topic}")
 
     def _get_objects_by_topic(self, topic):
-        objects = []
-        for item in self.obj_list:
-            if item["topic"] == topic:
-                objects.append(item)
-        return objects
+        return self._objs_by_topic.get(topic, [])
 
     def _run(self):
         loop_task = self.d.loop.create_task(self.mqtt_loop())
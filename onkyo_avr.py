@@ -31,7 +31,10 @@ class OnkyoAVR(BasePlugin):
         self.avr_reader = None
         self.avr_writer = None
         daemon.knx_read_cbs.append(self.process_knx)
-        log.debug("{} obj_list: {!r}".format(self.device_name, self.obj_list))
+        self._objs_by_avr = {}
+        for o in self.obj_list:
+            self._objs_by_avr.setdefault(o["avr_object"], o)
+        log.debug("%s obj_list: %r", self.device_name, self.obj_list)
 
     async def avr_client(self):
         self.avr_reader, self.avr_writer = await asyncio.open_connection(
@@ -39,34 +42,53 @@ class OnkyoAVR(BasePlugin):
 
     async def send_avr(self, iscp_command):
         rawdata = onkyo.command_to_packet(iscp_command)
-        log.debug(f"{self.device_name} sending iscp command {iscp_command} to AVR")
+        log.debug("%s sending iscp command %s to AVR", self.device_name, iscp_command)
         self.avr_writer.write(rawdata)
         await self.avr_writer.drain()
 
+    def get_obj_by_avr(self, avr_object):
+        try:
+            return self._objs_by_avr[avr_object]
+        except KeyError:
+            raise StopIteration
+
     def get_value_by_avr(self, avr_object):
-        return next(item for item in self.obj_list if item["avr_object"] == avr_object)["value"]
+        return self.get_obj_by_avr(avr_object).value
 
     def get_knx_by_avr(self, avr_object):
-        return next(item for item in self.obj_list if item["avr_object"] == avr_object)["knx_group"]
+        return self.get_obj_by_avr(avr_object).knx_group
 
     def set_value_for_avr(self, avr_object, value):
-        next(item for item in self.obj_list if item["avr_object"] == avr_object)["value"] = value
+        self.get_obj_by_avr(avr_object).value = value
+
+    def _avr_value(self, avr_object, knx_val):
+        value = int(knx_val)
+        if "volume" in avr_object:
+            value = round((value * 196.0) / 255.0)
+        return value
+
+    def restore_state(self, values):
+        # the AVR's values as they're on the bus, so unchanged KNX commands aren't sent again
+        for o in self.obj_list:
+            if o.knx_group in values:
+                try:
+                    o.value = self._avr_value(o["avr_object"], values[o.knx_group])
+                except ValueError:
+                    pass
 
     async def process_knx(self, cmd):
         try:
             knx_group, knx_val = cmd.strip().split("=")
             try:
                 avr_obj = self.get_obj_by_knxgrp(knx_group)
-                if avr_obj["enabled"]:
-                    value = int(knx_val)
+                if avr_obj.enabled:
                     avr_cmd = avr_obj["avr_object"]
-                    if "volume" in avr_cmd:
-                        value = round((int(knx_val) * 196.0) / 255.0)
-                    if value == avr_obj["value"]:
+                    value = self._avr_value(avr_cmd, knx_val)
+                    if value == avr_obj.value:
                         #log.debug(f"{self.device_name} {avr_obj} unchanged, ignored!")
                         return True
                     avr_zone = avr_obj["avr_zone"]
-                    log.info(f"{self.device_name} {avr_obj} => {avr_cmd}, {value}, zone={avr_zone}")
+                    log.info("%s %s => %s, %s, zone=%s", self.device_name, avr_obj, avr_cmd, value, avr_zone)
                     iscp_command = onkyo.command_to_iscp(avr_cmd, [str(value)], zone=avr_zone)
                     await self.send_avr(iscp_command)
                     self.set_value_for_avr(avr_cmd, value)
@@ -106,8 +128,7 @@ class OnkyoAVR(BasePlugin):
 
                         self.set_value_for_avr(avr_object, value)
                         group_value_dict[knx_grp] = knx_val
-                        log.info("{} received {!r} from AVR, set {}={}".format(
-                            self.device_name, command, knx_grp, knx_val))
+                        log.info("%s received %r from AVR, set %s=%s", self.device_name, command, knx_grp, knx_val)
                     except StopIteration:
                         pass
                         #log.debug(f"{self.device_name} command {avr_object} not handled")
@@ -122,6 +143,8 @@ class OnkyoAVR(BasePlugin):
             if group_value_dict:
                 await self.d.set_group_value_dict(group_value_dict)
 
+    async def connect(self):
+        await self.avr_client()
+
     def _run(self):
-        self.client = self.d.loop.run_until_complete(self.avr_client())
         return [self.handle_avr()]
@@ -25,35 +25,47 @@ def plugin_def():
     return PioneerAVR
 
 class PioneerAVR(BasePlugin):
+    # LinKNX rules send raw AVR commands like "Pon" or "V128"
+    route_by_group = False
+
     def __init__(self, daemon, cfg):
         super(PioneerAVR, self).__init__(daemon, cfg)
         self.avr_reader = None
         self.avr_writer = None
         self.accu_word = None
         daemon.knx_read_cbs.append(self.process_knx)
-        log.debug("{} obj_list: {!r}".format(self.device_name, self.obj_list))
+        self._objs_by_avr = {}
+        for o in self.obj_list:
+            self._objs_by_avr.setdefault(o["avr_object"], o)
+        log.debug("%s obj_list: %r", self.device_name, self.obj_list)
 
     async def avr_client(self):
         self.avr_reader, self.avr_writer = await asyncio.open_connection(
             self.cfg["host"], self.cfg["port"])
 
     async def send_avr(self, data):
-        log.debug("sending to avr: '%s'" % data)
+        log.debug("sending to avr: '%s'", data)
         self.avr_writer.write((data+'\r').encode(encoding='ascii'))
         self.avr_writer.drain()
 
+    def get_obj_by_avr(self, avr_object):
+        try:
+            return self._objs_by_avr[avr_object]
+        except KeyError:
+            raise StopIteration
+
     def get_value_by_avr(self, avr_object):
-        return next(item for item in self.obj_list if item["avr_object"] == avr_object)["value"]
+        return self.get_obj_by_avr(avr_object).value
 
     def get_knx_by_avr(self, avr_object):
-        return next(item for item in self.obj_list if item["avr_object"] == avr_object)["knx_group"]
+        return self.get_obj_by_avr(avr_object).knx_group
 
     def set_value_for_avr(self, avr_object, value):
-        next(item for item in self.obj_list if item["avr_object"] == avr_object)["value"] = value
+        self.get_obj_by_avr(avr_object).value = value
 
     async def process_knx(self, cmd):
         msg = None
-        log.debug("avr processes knx command '%r'" % cmd)
+        log.debug("avr processes knx command '%r'", cmd)
         try:
             if cmd[0] == 'P':
                 if cmd[1:3] == "on" and self.get_value_by_avr("power") != "on":
@@ -86,33 +98,33 @@ class PioneerAVR(BasePlugin):
                 break
 
             line = data.decode('ascii')
-            log.debug('avr received {!r}'.format(line))
+            log.debug('avr received %r', line)
 
             if line.startswith('FL02'):
               if line == "FL022020202020202020202020202020\r\n":
                 self.accu_word = self.accu_word and self.accu_word.rstrip() or ""
                 self.set_value_for_avr("display_text", self.accu_word)
                 group_value_dict[self.get_knx_by_avr("display_text")] = self.get_value_by_avr("display_text")
-                log.debug("display_text complete! '%s'" % self.get_value_by_avr("display_text"))
+                log.debug("display_text complete! '%s'", self.get_value_by_avr("display_text"))
               else:
                 new_word = bytes.fromhex(line[4:-2]).decode('iso8859_15')
                 if self.accu_word == None:
                     self.accu_word = new_word
-                    log.debug("1START new_word={!r} accu_word={!r}".format(new_word, self.accu_word))
+                    log.debug("1START new_word=%r accu_word=%r", new_word, self.accu_word)
                 elif self.accu_word[-13:] != new_word[:-1]:
                     if not self.get_value_by_avr("display_text") or new_word not in self.get_value_by_avr("display_text"):
                         self.set_value_for_avr("display_text", None)
                         self.accu_word = new_word
                         group_value_dict[self.get_knx_by_avr("display_text")] = self.accu_word
-                        log.debug("CHANGE new_word={!r} accu_word={!r}".format(new_word, self.accu_word))
+                        log.debug("CHANGE new_word=%r accu_word=%r", new_word, self.accu_word)
                     else:
-                        log.debug("STARTOVER new_word={!r} accu_word={!r}".format(new_word, self.accu_word))
+                        log.debug("STARTOVER new_word=%r accu_word=%r", new_word, self.accu_word)
                 else:
                   self.accu_word += new_word[-1:]
-                  log.debug("+++++ new_word={!r} accu_word={!r}".format(new_word, self.accu_word))
+                  log.debug("+++++ new_word=%r accu_word=%r", new_word, self.accu_word)
                 if not self.get_value_by_avr("display_text") and self.accu_word[-1] != ' ':
                   group_value_dict[self.get_knx_by_avr("display_text")] = self.accu_word.rstrip()
-                  log.debug("COMMIT new_word={!r} accu_word={!r}".format(new_word, self.accu_word))
+                  log.debug("COMMIT new_word=%r accu_word=%r", new_word, self.accu_word)
 
             elif line.startswith('VOL'):
               avr_volume = int(line[3:])
@@ -141,6 +153,8 @@ class PioneerAVR(BasePlugin):
             if group_value_dict:
                 await self.d.set_group_value_dict(group_value_dict)
 
+    async def connect(self):
+        await self.avr_client()
+
     def _run(self):
-        self.client = self.d.loop.run_until_complete(self.avr_client(self.d.loop))
         return [self.handle_avr()]
@@ -20,7 +20,7 @@
 
 import asyncio
 import logging
-from helper import BasePlugin, knxalog as log
+from helper import BasePlugin, log_ratelimited, knxalog as log
 import serial_asyncio
 from serial.serialutil import SerialException
 
@@ -32,7 +32,7 @@ class RS485(BasePlugin):
         super(RS485, self).__init__(daemon, cfg)
         daemon.knx_read_cbs.append(self.process_knx)
         daemon.value_direct_cbs.append(self.process_direct)
-        log.debug("{} obj_list: {!r}".format(self.device_name, self.obj_list))
+        log.debug("%s obj_list: %r", self.device_name, self.obj_list)
         self._reader = None
         self._writer = None
 
@@ -50,21 +50,21 @@ class RS485(BasePlugin):
             try:
                 line = await self._reader.readline()
                 cmd = line.decode('utf-8').strip()
-                log.debug(self.device_name+" received: '"+cmd+"'")
+                log.debug("%s received: '%s'", self.device_name, cmd)
                 (key, val) = cmd.split('=')
 
                 o = self._get_obj_by_key(key)
-                if "receive" in o["enabled"]:
-                    if "valmap" in o and val in o["valmap"]:
-                        knxval = o["valmap"][val]
+                if "receive" in o.enabled:
+                    if o.valmap and val in o.valmap:
+                        knxval = o.valmap[val]
                     else:
                         knxval = val
-                    await self.d.set_group_value_dict({o["knx_group"]: knxval})
+                    await self.d.set_group_value_dict({o.knx_group: knxval})
                 else:
                     log.warning(f"{self.device_name} command key {key} is not a receiving object!")
 
             except ValueError:
-                log.warning("{} couldn't parse command {!r}!".format(self.device_name, line))
+                log_ratelimited((self.device_name, "parse"), logging.WARNING, "%s couldn't parse command %r!", self.device_name, line)
             except StopIteration:
                 log.warning(f"{self.device_name} command key {key} not configured!")
 
@@ -74,7 +74,7 @@ class RS485(BasePlugin):
     async def process_direct(self, knx_group, knx_val):
         try:
             o = self.get_obj_by_knxgrp(knx_group)
-            if "send" in o["enabled"]:
+            if "send" in o.enabled:
                 debug_msg = f"{self.device_name} process_direct({knx_group}={knx_val})"
                 await self.write_rs485(o, knx_val, debug_msg)
         except StopIteration:
@@ -85,7 +85,7 @@ class RS485(BasePlugin):
             knx_group, knx_val = cmd.split("=")
             try:
                 o = self.get_obj_by_knxgrp(knx_group)
-                if "send" in o["enabled"]:
+                if "send" in o.enabled:
                     debug_msg = f"{self.device_name} process_knx({knx_group}={knx_val})"
                     await self.write_rs485(o, knx_val, debug_msg)
             except StopIteration:
@@ -96,17 +96,21 @@ class RS485(BasePlugin):
 
     async def write_rs485(self, o, value, debug_msg):
         rs485key = o["rs485key"]
-        if "valmap" in o:
-            val = next((key for key, val in o["valmap"].items() if val == value), value)
+        if o.reverse_valmap:
+            val = o.reverse_valmap.get(value, value)
         else:
             val = value
         cmd = (rs485key+'='+val)
-        log.debug(f"{debug_msg} writing RS485 command {cmd}")
+        log.debug("%s writing RS485 command %s", debug_msg, cmd)
         self._writer.write((cmd+'\r\n').encode(encoding='ascii'))
         await self._writer.drain()
 
+    async def connect(self):
+        await self.rs485_connection(self.d.loop)
+        if not self._reader:
+            raise ConnectionError(f"{self.device_name} serial device not available")
+
     def _run(self):
-        self._client = self.d.loop.run_until_complete(self.rs485_connection(self.d.loop))
         if self._reader and self._writer:
             return [self.handle_rs485()]
         else:
@@ -0,0 +1,222 @@
+'''
+  shaper.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import asyncio
+import logging
+from collections import OrderedDict
+from time import monotonic
+from helper import log_ratelimited, knxalog as log
+
+LANES = ("security", "control", "telemetry")
+# lanes whose writes are queued again when they couldn't be delivered to LinKNX
+RETRY_LANES = ("security", "control")
+
+class Lane:
+    def __init__(self, name, metrics):
+        self.name = name
+        # group -> (value, queued_at), a newer value replaces the queued one in place
+        self.items = OrderedDict()
+        self.sent = 0
+        self.replaced = 0
+        self.max_delay = 0.0
+        self.delay = metrics.histogram("knxadapter_shaper_delay_seconds", "Time group writes waited in the traffic shaper", lane=name)
+        metrics.gauge("knxadapter_shaper_queue_depth", "Group writes waiting in the traffic shaper", lambda: len(self.items), lane=name)
+        metrics.counter_fn("knxadapter_shaper_replaced_total", "Queued group writes replaced by a newer value", lambda: self.replaced, lane=name)
+
+    def stats(self):
+        return {"depth": len(self.items), "sent": self.sent, "replaced": self.replaced, "max_delay": self.max_delay}
+
+class TrafficShaper:
+    """ Schedules the daemon's group writes onto the KNX line, which only carries a few dozen
+        telegrams per second. Writes wait in priority lanes, only the latest value per group is
+        kept, and are sent in batches as a token bucket of rate telegrams per second (burst
+        deep) allows. A group isn't written again within its group_interval. The security lane
+        is never held back by the bucket, it just leaves less for the others.
+        Lanes and intervals are set per plugin or per object with "lane" and "group_interval".
+        Security and control writes which didn't reach LinKNX are queued again after retry_delay
+        seconds, at shutdown the lanes get flush_timeout seconds to drain. """
+
+    def __init__(self, daemon, cfg):
+        self.d = daemon
+        self.rate = cfg.get("rate", 20)
+        self.burst = cfg.get("burst", 10)
+        self.default_lane = cfg.get("default_lane", "telemetry")
+        self.default_interval = cfg.get("group_interval", 0)
+        self.batch_max = daemon.write_batch_max
+        self.retry_delay = cfg.get("retry_delay", 1.0)
+        self.flush_timeout = cfg.get("flush_timeout", 2.0)
+        self.lanes = OrderedDict((name, Lane(name, daemon.metrics)) for name in LANES)
+        if self.default_lane not in self.lanes:
+            log.warning(f"shaper: unknown default lane {self.default_lane!r}, using 'telemetry'")
+            self.default_lane = "telemetry"
+        self.group_lanes = {}
+        self.group_intervals = {}
+        self._next_allowed = {}
+        self._tokens = float(self.burst)
+        self._refilled = monotonic()
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._sending = False
+
+    def assign(self, plugins, urgent_groups=()):
+        """ (Re)builds the lane and interval of every group from the plugins' configs """
+        group_lanes, group_intervals = {}, {}
+        for plugin in plugins:
+            plugin_lane = plugin.cfg.get("lane", self.default_lane)
+            plugin_interval = plugin.cfg.get("group_interval", self.default_interval)
+            for obj in plugin.cfg.get("objects", []):
+                group = obj.get("knx_group")
+                if not group:
+                    continue
+                lane = obj.get("lane", plugin_lane)
+                if lane not in self.lanes:
+                    log.warning(f"{plugin.device_name} unknown lane {lane!r} for {group}, using {self.default_lane!r}")
+                    lane = self.default_lane
+                # a group shared by several plugins gets the most urgent lane of them
+                if group not in group_lanes or LANES.index(lane) < LANES.index(group_lanes[group]):
+                    group_lanes[group] = lane
+                interval = obj.get("group_interval", plugin_interval)
+                if interval:
+                    group_intervals[group] = min(interval, group_intervals.get(group, interval))
+        for group in urgent_groups:
+            group_lanes[group] = "security"
+            group_intervals.pop(group, None)
+        self.group_lanes, self.group_intervals = group_lanes, group_intervals
+        log.debug("shaper: {} groups in lanes {!r}".format(len(group_lanes), {name: sum(1 for lane in group_lanes.values() if lane == name) for name in self.lanes}))
+
+    def put(self, group_value_dict):
+        """ Queues writes without waiting for them to be sent """
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._work(), name="shaper")
+        now = monotonic()
+        stats = self.d.write_stats
+        for group, value in group_value_dict.items():
+            lane = self.lanes[self.group_lanes.get(group, self.default_lane)]
+            stats["requested"] += 1
+            queued = lane.items.get(group)
+            if queued is not None:
+                lane.items[group] = (value, queued[1])
+                lane.replaced += 1
+                stats["merged"] += 1
+            else:
+                lane.items[group] = (value, now)
+        self._wakeup.set()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _take(self, now):
+        """ Dequeues the next batch in lane order, returns it and the seconds until more can be sent """
+        self._refill(now)
+        batch = {}
+        wait = None
+        for lane in self.lanes.values():
+            bypass = lane.name == "security"
+            for group, (value, queued_at) in list(lane.items.items()):
+                if len(batch) >= self.batch_max:
+                    return batch, 0
+                allowed = self._next_allowed.get(group, 0)
+                if allowed > now:
+                    wait = allowed - now if wait is None else min(wait, allowed - now)
+                    continue
+                if self._tokens < 1.0 and not bypass:
+                    refill = (1.0 - self._tokens) / self.rate
+                    return batch, refill if wait is None else min(wait, refill)
+                del lane.items[group]
+                self._tokens -= 1.0
+                batch[group] = value
+                delay = now - queued_at
+                lane.delay.observe(delay)
+                lane.sent += 1
+                if delay > lane.max_delay:
+                    lane.max_delay = delay
+                interval = self.group_intervals.get(group)
+                if interval:
+                    self._next_allowed[group] = now + interval
+                elif group in self._next_allowed:
+                    del self._next_allowed[group]
+        return batch, wait
+
+    async def _work(self):
+        while True:
+            batch, wait = self._take(monotonic())
+            if batch:
+                self._sending = True
+                try:
+                    if not await self._send(batch):
+                        await asyncio.sleep(self.retry_delay)
+                finally:
+                    self._sending = False
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, batch):
+        """ Writes a batch, returns whether LinKNX took it """
+        sequence = ""
+        for group, value in batch.items():
+            sequence += f'<object id="{group}" value="{value}"/>'
+        written = False
+        try:
+            written = await self.d.send_knx(sequence)
+            self.d.write_stats["batches"] += 1
+        except Exception as e:
+            log_ratelimited("shaper write", logging.WARNING, "shaper couldn't write %d groups: %r", len(batch), e)
+            # LinKNX wasn't reached, a batch it refused would only be refused again
+            self._requeue(batch)
+        if not written and self.d.group_cache is not None:
+            self.d.group_cache.invalidate(batch)
+        return written
+
+    def _requeue(self, batch):
+        now = monotonic()
+        for group, value in batch.items():
+            lane = self.lanes[self.group_lanes.get(group, self.default_lane)]
+            # a newer value queued meanwhile wins
+            if lane.name in RETRY_LANES and group not in lane.items:
+                lane.items[group] = (value, now)
+                lane.items.move_to_end(group, last=False)
+                self._next_allowed.pop(group, None)
+
+    def pending(self):
+        return sum(len(lane.items) for lane in self.lanes.values())
+
+    async def flush(self, timeout=None):
+        """ Waits up to timeout (default flush_timeout) seconds for the queued writes to be sent """
+        deadline = monotonic() + (self.flush_timeout if timeout is None else timeout)
+        while self._worker and (self.pending() or self._sending):
+            if monotonic() >= deadline:
+                log.warning(f"shaper: {self.pending()} queued writes not sent")
+                return False
+            self._wakeup.set()
+            await asyncio.sleep(0.02)
+        return True
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+    def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
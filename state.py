@@ -0,0 +1,125 @@
+'''
+  state.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import os
+import json
+import time
+import asyncio
+from helper import knxalog as log
+
+class StateSnapshot:
+    """ Persists the group cache, the last value of every group, so a restarted daemon doesn't
+        write all of them to LinKNX again and the deadbands start from the values on the bus.
+        The snapshot is written every state_interval seconds when something changed and at
+        shutdown, snapshots older than state_max_age seconds are ignored. """
+
+    VERSION = 1
+
+    def __init__(self, daemon):
+        self.d = daemon
+        cfg = daemon.cfg["sys"]
+        self.path = os.path.join(os.path.dirname(os.path.abspath(daemon.cfg_file)), cfg["state_file"])
+        self.interval = cfg.get("state_interval", 60)
+        self.max_age = cfg.get("state_max_age", 3600)
+        self._saved_generation = None
+        self._task = None
+
+    def load(self):
+        """ Returns the snapshot's {group: value}, empty when there's none or it's too old """
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f"couldn't read state snapshot {self.path}: {e!r}")
+            return {}
+        if snapshot.get("version") != self.VERSION:
+            log.warning(f"ignoring state snapshot {self.path} of version {snapshot.get('version')!r}")
+            return {}
+        age = time.time() - snapshot.get("saved", 0)
+        if self.max_age and age > self.max_age:
+            log.info(f"ignoring state snapshot {self.path}, it's {age:.0f} s old")
+            return {}
+        values = snapshot.get("values", {})
+        log.info(f"restored {len(values)} group values from {self.path} ({age:.0f} s old)")
+        return values
+
+    def restore(self, plugins):
+        """ Seeds the group cache and the plugins' deadbands before the plugins start """
+        cache = self.d.group_cache
+        values = self.load()
+        if not values:
+            return
+        for group, value in values.items():
+            cache.update(group, value)
+        self._saved_generation = cache.generation
+        for plugin in plugins:
+            restore_state = getattr(plugin, "restore_state", None)
+            if restore_state:
+                # worker process plugins get them forwarded once their worker runs
+                restore_state(values)
+            else:
+                log.warning(f"state snapshot not applied to {plugin.device_name}, it can't restore state")
+
+    def _write(self, values):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": self.VERSION, "saved": time.time(), "values": values}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def save(self):
+        cache = self.d.group_cache
+        generation = cache.generation
+        if generation == self._saved_generation:
+            return
+        self._write(dict(cache.values))
+        self._saved_generation = generation
+        log.debug(f"saved {len(cache.values)} group values to {self.path}")
+
+    async def _save_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            cache = self.d.group_cache
+            if cache.generation == self._saved_generation:
+                continue
+            generation = cache.generation
+            try:
+                # the copy is taken on the loop, the disk write happens on a thread
+                await loop.run_in_executor(None, self._write, dict(cache.values))
+                self._saved_generation = generation
+            except OSError as e:
+                log.warning(f"couldn't write state snapshot {self.path}: {e!r}")
+
+    def start(self):
+        if self.interval:
+            self._task = self.d.loop.create_task(self._save_periodically(), name="state:save")
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        try:
+            self.save()
+        except OSError as e:
+            log.warning(f"couldn't write state snapshot {self.path}: {e!r}")
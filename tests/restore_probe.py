@@ -0,0 +1,31 @@
+'''
+  restore_probe.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import json
+from helper import BasePlugin
+
+def plugin_def():
+    return RestoreProbe
+
+class RestoreProbe(BasePlugin):
+    """ Test plugin for worker processes, writes every restored state back as probe:restored """
+
+    def restore_state(self, values):
+        self.d.loop.create_task(self.d.set_group_value_dict({"probe:restored": json.dumps(values, sort_keys=True)}))
@@ -0,0 +1,78 @@
+'''
+  test_deadband.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+from time import monotonic
+from helper import Deadband, PluginObject
+from metrics import Counter
+
+NAN = float("nan")
+
+def objects(*cfgs):
+    return [PluginObject(dict({"knx_group": f"g{i}", "enabled": True}, **cfg), default_precision=1) for i, cfg in enumerate(cfgs)]
+
+def test_first_value_is_always_sent():
+    deadband = Deadband(objects({"hysteresis": 5}))
+    assert deadband.evaluate([1.0]) == {"g0": "1.0"}
+
+def test_absolute_hysteresis():
+    suppressed = Counter()
+    deadband = Deadband(objects({"hysteresis": 0.5}), suppressed)
+    deadband.evaluate([10.0])
+    assert deadband.evaluate([10.4]) == {}
+    assert deadband.evaluate([10.6]) == {"g0": "10.6"}
+    assert suppressed.value == 1
+
+def test_relative_hysteresis():
+    deadband = Deadband(objects({"hysteresis": "10%"}))
+    deadband.evaluate([100.0])
+    assert deadband.evaluate([105.0]) == {}
+    assert deadband.evaluate([120.0]) == {"g0": "120.0"}
+
+def test_unchanged_and_unread_values_are_skipped():
+    deadband = Deadband(objects({}, {}))
+    assert deadband.evaluate([1.0, 2.0]) == {"g0": "1.0", "g1": "2.0"}
+    assert deadband.evaluate([1.0, NAN]) == {}
+    assert deadband.evaluate([NAN, 3.0]) == {"g1": "3.0"}
+
+def test_rate_deadband():
+    deadband = Deadband(objects({"rate_deadband": 1.0}))
+    assert deadband.timed
+    deadband.evaluate([10.0], now=100.0)
+    assert deadband.evaluate([14.0], now=105.0) == {}
+    assert deadband.evaluate([20.0], now=106.0) == {"g0": "20.0"}
+
+def test_min_interval():
+    deadband = Deadband(objects({"min_interval": 10}))
+    deadband.evaluate([1.0], now=100.0)
+    assert deadband.evaluate([2.0], now=105.0) == {}
+    assert deadband.evaluate([2.0], now=110.0) == {"g0": "2.0"}
+
+def test_restore_sets_the_baseline():
+    deadband = Deadband(objects({"hysteresis": 1.0}, {}))
+    deadband.restore({"g0": "10", "g1": "not a number"})
+    assert deadband.evaluate([10.5, 7.0]) == {"g1": "7.0"}
+    assert deadband.evaluate([12.0, 7.0]) == {"g0": "12.0"}
+
+def test_restore_keeps_the_rate_deadband_working():
+    deadband = Deadband(objects({"rate_deadband": 1.0}))
+    deadband.restore({"g0": "10"})
+    now = monotonic()
+    assert deadband.evaluate([10.5], now=now + 1.0) == {}
+    assert deadband.evaluate([20.0], now=now + 2.0) == {"g0": "20.0"}
@@ -0,0 +1,114 @@
+'''
+  test_group_cache.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import asyncio
+from helper import GroupCache
+
+def test_unchanged_writes_are_dropped():
+    cache = GroupCache()
+    assert cache.filter({"a": 1, "b": "on"}, now=0) == {"a": 1, "b": "on"}
+    assert cache.filter({"a": 1, "b": "off"}, now=1) == {"b": "off"}
+    assert cache.dropped == 1
+    assert cache.get("a") == "1"
+
+def test_values_compare_as_sent():
+    cache = GroupCache()
+    cache.filter({"a": 1}, now=0)
+    assert cache.filter({"a": "1"}, now=1) == {}
+    assert cache.filter({"a": 1.0}, now=2) == {"a": 1.0}
+
+def test_refresh_interval_resends_unchanged_values():
+    cache = GroupCache(refresh_interval=60)
+    cache.filter({"a": 1}, now=0)
+    assert cache.filter({"a": 1}, now=30) == {}
+    assert cache.filter({"a": 1}, now=61) == {"a": 1}
+
+def test_excluded_groups_are_always_sent():
+    cache = GroupCache(exclude=["door"])
+    cache.filter({"door": "on"}, now=0)
+    assert cache.filter({"door": "on"}, now=1) == {"door": "on"}
+
+def test_inbound_values_and_invalidate():
+    cache = GroupCache()
+    cache.update("a", "on", now=0)
+    assert cache.filter({"a": "on"}, now=1) == {}
+    cache.invalidate(["a"])
+    assert cache.get("a") is None
+    assert cache.filter({"a": "on"}, now=2) == {"a": "on"}
+
+def test_generation_counts_changes():
+    cache = GroupCache()
+    generation = cache.generation
+    cache.update("a", "on")
+    cache.update("a", "on")
+    assert cache.generation == generation + 1
+    cache.filter({"a": "on"})
+    assert cache.generation == generation + 1
+    cache.filter({"a": "off"})
+    assert cache.generation == generation + 2
+
+def test_direct_consumers_see_deduplicated_writes():
+    from knxadapter3 import KnxAdapter
+    adapter = KnxAdapter.__new__(KnxAdapter)
+    adapter.group_cache = GroupCache()
+    adapter.shaper = None
+    adapter.write_window = 0
+    direct, sent = [], []
+    async def consumer(group, value):
+        direct.append((group, value))
+    async def send_knx(sequence):
+        sent.append(sequence)
+        return True
+    adapter.direct_routes = {}
+    adapter._direct_unrouted = [consumer]
+    adapter.send_knx = send_knx
+    async def run():
+        await adapter.set_group_value_dict({"pulse": "on"})
+        await adapter.set_group_value_dict({"pulse": "on"})
+    asyncio.run(run())
+    assert direct == [("pulse", "on"), ("pulse", "on")]
+    assert sent == ['<object id="pulse" value="on"/>']
+
+def test_failed_batch_without_waiters_is_retrieved():
+    import gc
+    from knxadapter3 import KnxAdapter
+    adapter = KnxAdapter.__new__(KnxAdapter)
+    adapter.group_cache = GroupCache()
+    adapter.write_window = 0.01
+    adapter.write_batch_max = 50
+    adapter.write_stats = {"requested": 0, "merged": 0, "batches": 0}
+    adapter.urgent_groups = set()
+    adapter._pending_writes, adapter._pending_flushed, adapter._flush_handle = {}, None, None
+    adapter._inflight_writes = {}
+    async def send_knx(sequence):
+        raise ConnectionError("linknx gone")
+    adapter.send_knx = send_knx
+    unhandled = []
+    async def run():
+        adapter.loop = asyncio.get_running_loop()
+        adapter.loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+        writer = asyncio.create_task(adapter.queue_writes({"a": "on"}))
+        await asyncio.sleep(0)
+        writer.cancel()
+        await asyncio.sleep(0.05)
+        gc.collect()
+    asyncio.run(run())
+    assert unhandled == []
+    assert adapter.group_cache.get("a") is None
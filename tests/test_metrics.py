@@ -0,0 +1,63 @@
+'''
+  test_metrics.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import asyncio
+from metrics import Metrics
+
+class Plugin:
+    def __init__(self, device_name):
+        self.device_name = device_name
+
+    async def stop(self):
+        pass
+
+def test_remove_drops_matching_series_and_empty_families():
+    metrics = Metrics()
+    metrics.counter("messages_total", "Messages", plugin="a", direction="received").inc()
+    metrics.counter("messages_total", "Messages", plugin="b", direction="received").inc()
+    metrics.histogram("poll_seconds", "Poll", plugin="a").observe(0.1)
+    metrics.remove(plugin="a")
+    text = metrics.render()
+    assert 'plugin="b"' in text
+    assert 'plugin="a"' not in text
+    assert "poll_seconds" not in text
+
+def test_reregistering_gauge_replaces_the_old_series():
+    metrics = Metrics()
+    metrics.gauge("depth", "Depth", lambda: 1, consumer="x")
+    metrics.gauge("depth", "Depth", lambda: 2, consumer="x")
+    assert metrics.render().splitlines()[2:] == ['depth{consumer="x"} 2']
+
+def test_stop_plugin_unregisters_its_metrics():
+    from knxadapter3 import KnxAdapter
+    adapter = KnxAdapter.__new__(KnxAdapter)
+    adapter.metrics = Metrics()
+    adapter.plugin_tasks = {}
+    adapter.startup_timings = {}
+    adapter.knx_read_cbs, adapter.value_direct_cbs = [], []
+    old, kept = Plugin("old"), Plugin("kept")
+    adapter.plugins = [old, kept]
+    for plugin in adapter.plugins:
+        adapter.metrics.counter("knxadapter_hysteresis_suppressed_total", "Suppressed", plugin=plugin.device_name).inc()
+    asyncio.run(adapter.stop_plugin(old))
+    text = adapter.metrics.render()
+    assert 'plugin="kept"' in text
+    assert 'plugin="old"' not in text
+    assert adapter.plugins == [kept]
@@ -0,0 +1,110 @@
+'''
+  test_modbus_client.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import struct
+import asyncio
+import pytest
+from modbus_client import ModbusClient, ModbusError
+
+def read_reply(tid, unit, registers):
+    data = struct.pack(f">{len(registers)}H", *registers)
+    pdu = struct.pack(">BB", 3, len(data)) + data
+    return struct.pack(">HHHB", tid, 0, len(pdu) + 1, unit) + pdu
+
+async def serve(respond, test):
+    """ Runs test(client) against a server which hands each request (tid, unit, pdu) to respond,
+        respond returns the bytes to answer with, all requests seen so far are passed along """
+    async def handle(reader, writer):
+        requests = []
+        try:
+            while True:
+                tid, protocol, length, unit = struct.unpack(">HHHB", await reader.readexactly(7))
+                requests.append((tid, unit, await reader.readexactly(length - 1)))
+                writer.write(respond(requests))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    client = ModbusClient("127.0.0.1", server.sockets[0].getsockname()[1], timeout=1.0)
+    try:
+        await test(client)
+    finally:
+        client.close()
+        server.close()
+
+def test_read_holding_registers():
+    def respond(requests):
+        tid, unit, pdu = requests[-1]
+        function, address, count = struct.unpack(">BHH", pdu)
+        assert function == 3
+        return read_reply(tid, unit, [address + i for i in range(count)])
+    async def test(client):
+        assert await client.read_holding_registers(100, 3, 71) == (100, 101, 102)
+        assert await client.read_registers(7, 1, 1) == b"\x00\x07"
+    asyncio.run(serve(respond, test))
+
+def test_replies_are_matched_by_transaction_id():
+    def respond(requests):
+        # answers the two requests in reverse order once both arrived
+        if len(requests) < 2:
+            return b""
+        return b"".join(read_reply(tid, unit, [unit]) for tid, unit, pdu in reversed(requests))
+    async def test(client):
+        assert await asyncio.gather(client.read_holding_registers(0, 1, 1), client.read_holding_registers(0, 1, 2)) == [(1,), (2,)]
+    asyncio.run(serve(respond, test))
+
+def test_exception_response():
+    def respond(requests):
+        tid, unit, pdu = requests[-1]
+        return struct.pack(">HHHBBB", tid, 0, 3, unit, 0x83, 2)
+    async def test(client):
+        with pytest.raises(ModbusError) as error:
+            await client.read_holding_registers(0, 1, 1)
+        assert (error.value.function, error.value.code) == (3, 2)
+        assert client.connected
+    asyncio.run(serve(respond, test))
+
+def test_short_reply():
+    def respond(requests):
+        tid, unit, pdu = requests[-1]
+        return read_reply(tid, unit, [1])
+    async def test(client):
+        with pytest.raises(ModbusError):
+            await client.read_holding_registers(0, 2, 1)
+    asyncio.run(serve(respond, test))
+
+@pytest.mark.parametrize("length", [0, 1, 300])
+def test_invalid_length_closes_the_connection(length):
+    def respond(requests):
+        tid, unit, pdu = requests[-1]
+        return struct.pack(">HHHB", tid, 0, length, unit)
+    async def test(client):
+        with pytest.raises(ConnectionError):
+            await client.read_holding_registers(0, 1, 1)
+        assert not client.connected
+    asyncio.run(serve(respond, test))
+
+def test_no_reply_times_out():
+    async def test(client):
+        client.timeout = 0.05
+        with pytest.raises(asyncio.TimeoutError):
+            await client.read_holding_registers(0, 1, 1)
+    asyncio.run(serve(lambda requests: b"", test))
@@ -0,0 +1,75 @@
+'''
+  test_modbus_planner.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import struct
+from modbus_client import plan_blocks
+
+def spans(blocks):
+    return [(block.start, block.count) for block in blocks]
+
+def test_adjacent_registers_share_a_block():
+    blocks = plan_blocks([(0, 100, "U32"), (1, 102, "float"), (2, 104, "U16")])
+    assert spans(blocks) == [(100, 5)]
+    assert blocks[0].fields == [(0, 0, "U32"), (1, 4, "float"), (2, 8, "U16")]
+
+def test_gaps_split_blocks_unless_tolerated():
+    objects = [(0, 100, "U32"), (1, 105, "U32")]
+    assert spans(plan_blocks(objects)) == [(100, 2), (105, 2)]
+    assert spans(plan_blocks(objects, max_gap=3)) == [(100, 7)]
+
+def test_blocks_are_limited_to_max_block():
+    objects = [(i, 2 * i, "U32") for i in range(70)]
+    assert spans(plan_blocks(objects)) == [(0, 124), (124, 16)]
+    assert spans(plan_blocks(objects[:4], max_block=4)) == [(0, 4), (4, 4)]
+
+def test_objects_are_planned_in_register_order():
+    blocks = plan_blocks([(0, 110, "I16"), (1, 100, "U64"), (2, 104, "U16")], max_gap=5)
+    assert spans(blocks) == [(100, 11)]
+    assert [index for index, offset, data_type in blocks[0].fields] == [1, 2, 0]
+
+def test_overlapping_objects():
+    blocks = plan_blocks([(0, 100, "U32"), (1, 100, "U16"), (2, 101, "U16")])
+    assert spans(blocks) == [(100, 2)]
+    values = [None] * 3
+    blocks[0].decode(struct.pack(">I", 0x00010002), values)
+    assert values == [0x00010002, 1, 2]
+
+def words(fmt, value, wordorder):
+    raw = struct.pack(">" + fmt, value)
+    registers = [raw[i:i + 2] for i in range(0, len(raw), 2)]
+    return b"".join(reversed(registers) if wordorder == "LE" else registers)
+
+def test_decode_all_data_types_in_both_word_orders():
+    objects = [(0, 0, "float"), (1, 2, "I16"), (2, 3, "U16"), (3, 4, "I32"), (4, 6, "U32"), (5, 8, "U64")]
+    samples = [("f", 1.234567), ("h", -2), ("H", 65535), ("i", -100000), ("I", 4000000000), ("Q", 2**40 + 5)]
+    [block] = plan_blocks(objects)
+    for wordorder in ("BE", "LE"):
+        values = [None] * len(objects)
+        block.decode(b"".join(words(fmt, value, wordorder) for fmt, value in samples), values, wordorder)
+        assert values == [1.23, -2, 65535, -100000, 4000000000, 2**40 + 5]
+
+def test_split_reads_every_value_on_its_own():
+    [block] = plan_blocks([(0, 100, "U32"), (1, 104, "I16")], max_gap=2)
+    parts = block.split()
+    assert spans(parts) == [(100, 2), (104, 1)]
+    values = [None] * 2
+    parts[0].decode(struct.pack(">I", 7), values)
+    parts[1].decode(struct.pack(">h", -7), values)
+    assert values == [7, -7]
@@ -0,0 +1,45 @@
+'''
+  test_ratelimit.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import logging
+import helper
+
+def test_expired_keys_are_forgotten(monkeypatch, caplog):
+    now = [1000.0]
+    monkeypatch.setattr(helper, "monotonic", lambda: now[0])
+    monkeypatch.setattr(helper, "_ratelimited", {})
+    caplog.set_level(logging.WARNING, logger=helper.knxalog.name)
+    for i in range(50):
+        helper.log_ratelimited(("parse", i), logging.WARNING, "bad %d", i, interval=10)
+    assert len(helper._ratelimited) == 50
+    now[0] += 11
+    helper.log_ratelimited(("parse", "new"), logging.WARNING, "bad %s", "new", interval=10)
+    assert list(helper._ratelimited) == [("parse", "new")]
+
+def test_suppressed_messages_are_counted(monkeypatch, caplog):
+    now = [1000.0]
+    monkeypatch.setattr(helper, "monotonic", lambda: now[0])
+    monkeypatch.setattr(helper, "_ratelimited", {})
+    caplog.set_level(logging.WARNING, logger=helper.knxalog.name)
+    for _ in range(3):
+        helper.log_ratelimited("key", logging.WARNING, "failed")
+    now[0] += 61
+    helper.log_ratelimited("key", logging.WARNING, "failed")
+    assert [r.getMessage() for r in caplog.records] == ["failed", "failed (2 more since the last one)"]
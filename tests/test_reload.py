@@ -0,0 +1,94 @@
+'''
+  test_reload.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import os
+import sys
+import json
+import signal
+import asyncio
+import pytest
+from loadtest import Tracker, FakeLinknx, FakeModbus, free_port, DAEMON
+
+pytestmark = pytest.mark.skipif(not os.path.isdir("/proc/self"), reason="finds the worker processes in /proc")
+
+def workers(daemon_pid, name):
+    """ Returns the pids of the daemon's worker processes for the plugin name """
+    pids = []
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                args = f.read().split(b"\0")
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == daemon_pid and any(arg.endswith(b"worker.py") for arg in args) and name.encode() in args:
+            pids.append(int(pid))
+    return pids
+
+async def wait_for(condition, timeout=10.0):
+    for _ in range(int(timeout / 0.1)):
+        if condition():
+            return True
+        await asyncio.sleep(0.1)
+    return condition()
+
+async def admin(path, command):
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(command.encode() + b"\n")
+    reply = await reader.readline()
+    writer.close()
+    return reply.decode().strip()
+
+def test_reload_replaces_a_worker_process(tmp_path):
+    async def run():
+        tracker = Tracker()
+        linknx = FakeLinknx(tracker, 0.0, 0.0, 0.0)
+        modbus = FakeModbus(tracker, 4)
+        await linknx.start()
+        await modbus.start()
+        plugin = dict(modbus.plugin_config(0.2), process=True)
+        cfg = {"sys": {"listenHost": "127.0.0.1", "verbosity": "info", "admin_socket": "admin.sock"},
+               "linknx": {"host": "127.0.0.1", "port": linknx.port, "listenPort": free_port(), "sync_on_start": False},
+               "plugins": [plugin]}
+        cfg_file = tmp_path / "config.json"
+        cfg_file.write_text(json.dumps(cfg))
+        with open(tmp_path / "log", "wb") as log:
+            daemon = await asyncio.create_subprocess_exec(sys.executable, DAEMON, str(cfg_file), stdout=log, stderr=log)
+        try:
+            name = plugin["name"]
+            assert await wait_for(lambda: len(workers(daemon.pid, name)) == 1 and modbus.requests)
+            [before] = workers(daemon.pid, name)
+
+            plugin["poll_interval"] = 0.3
+            cfg_file.write_text(json.dumps(cfg))
+            assert await admin(str(tmp_path / "admin.sock"), "reload") == "0 added, 0 removed, 1 restarted, 0 unchanged"
+            assert await wait_for(lambda: len(workers(daemon.pid, name)) == 1 and before not in workers(daemon.pid, name))
+            await asyncio.sleep(0.5)
+            assert len(workers(daemon.pid, name)) == 1
+
+            cfg["plugins"] = []
+            cfg_file.write_text(json.dumps(cfg))
+            assert await admin(str(tmp_path / "admin.sock"), "reload") == "0 added, 1 removed, 0 restarted, 0 unchanged"
+            assert await wait_for(lambda: not workers(daemon.pid, name))
+        finally:
+            daemon.send_signal(signal.SIGINT)
+            await asyncio.wait_for(daemon.wait(), 10)
+    asyncio.run(run())
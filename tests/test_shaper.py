@@ -0,0 +1,132 @@
+'''
+  test_shaper.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import asyncio
+from metrics import Metrics
+from shaper import TrafficShaper
+
+class FakeDaemon:
+    write_batch_max = 4
+    group_cache = None
+
+    def __init__(self, failures=0):
+        self.metrics = Metrics(enabled=False)
+        self.write_stats = {"requested": 0, "merged": 0, "batches": 0}
+        self.failures = failures
+        self.sent = []
+
+    async def send_knx(self, sequence):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("LinKNX down")
+        self.sent.append(sequence)
+        return True
+
+class FakePlugin:
+    device_name = "fake"
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+def shaper(cfg=None, daemon=None, plugins=(), urgent=()):
+    shaper = TrafficShaper(daemon or FakeDaemon(), dict({"rate": 10, "burst": 2}, **(cfg or {})))
+    shaper.assign(plugins, urgent)
+    # a full bucket at time 0, the tests pass their own clock to _take()
+    shaper._refilled = 0.0
+    return shaper
+
+def queue(shaper, lane, *groups, at=0.0):
+    for group in groups:
+        shaper.lanes[lane].items[group] = (f"{group}-value", at)
+
+def test_lanes_are_taken_in_priority_order():
+    s = shaper(cfg={"burst": 10})
+    queue(s, "telemetry", "t1")
+    queue(s, "control", "c1")
+    queue(s, "security", "s1")
+    batch, wait = s._take(0.0)
+    assert list(batch) == ["s1", "c1", "t1"]
+    assert wait is None
+
+def test_token_bucket_limits_all_but_security():
+    s = shaper()
+    queue(s, "telemetry", "t1", "t2", "t3")
+    batch, wait = s._take(0.0)
+    assert list(batch) == ["t1", "t2"]
+    assert wait == 0.1
+    queue(s, "security", "s1", "s2")
+    batch, wait = s._take(0.0)
+    assert list(batch) == ["s1", "s2"]
+    # the security writes used up tokens as well, which leaves less for the others
+    assert s._take(0.1)[0] == {}
+    assert list(s._take(0.35)[0]) == ["t3"]
+
+def test_batches_are_capped_at_write_batch_max():
+    s = shaper(cfg={"burst": 10})
+    queue(s, "telemetry", *[f"t{i}" for i in range(6)])
+    batch, wait = s._take(0.0)
+    assert len(batch) == 4 and wait == 0
+    batch, wait = s._take(0.0)
+    assert list(batch) == ["t4", "t5"]
+
+def test_group_interval_holds_a_group_back():
+    s = shaper(cfg={"burst": 10, "group_interval": 5})
+    s.assign([FakePlugin({"objects": [{"knx_group": "t1"}]})])
+    queue(s, "telemetry", "t1")
+    assert list(s._take(0.0)[0]) == ["t1"]
+    queue(s, "telemetry", "t1")
+    batch, wait = s._take(1.0)
+    assert batch == {} and wait == 4.0
+    assert list(s._take(5.0)[0]) == ["t1"]
+
+def test_lanes_are_assigned_from_the_config():
+    plugin = FakePlugin({"lane": "control", "objects": [{"knx_group": "c1"}, {"knx_group": "t1", "lane": "telemetry"},
+                                                        {"knx_group": "x1", "lane": "bogus"}]})
+    s = shaper(plugins=[plugin], urgent=["door"])
+    assert s.group_lanes == {"c1": "control", "t1": "telemetry", "x1": "telemetry", "door": "security"}
+
+def test_put_keeps_the_latest_value():
+    async def run():
+        s = shaper(cfg={"rate": 0.001, "burst": 0})
+        s.put({"t1": 1})
+        s.put({"t1": 2})
+        assert s.lanes["telemetry"].items["t1"][0] == 2
+        assert s.lanes["telemetry"].replaced == 1
+        s.stop()
+    asyncio.run(run())
+
+def test_undelivered_urgent_writes_are_retried():
+    async def run():
+        daemon = FakeDaemon(failures=1)
+        s = shaper(cfg={"retry_delay": 0.01}, daemon=daemon, urgent=["door"])
+        s.put({"door": "on", "t1": 1})
+        assert await s.flush(1.0)
+        s.stop()
+        assert len(daemon.sent) == 1 and 'id="door"' in daemon.sent[0] and 't1' not in daemon.sent[0]
+    asyncio.run(run())
+
+def test_flush_gives_up_after_its_timeout():
+    async def run():
+        s = shaper(cfg={"retry_delay": 0.01}, daemon=FakeDaemon(failures=1000), urgent=["door"])
+        s.put({"door": "on"})
+        assert not await s.flush(0.1)
+        assert s.pending() == 1
+        s.stop()
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+'''
+  test_worker.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import os
+import json
+import asyncio
+from worker import PluginProcess
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+class FakeCore:
+    def __init__(self, cfg_file, cache):
+        self.cfg_file = cfg_file
+        self.cache = cache
+        self.knx_read_cbs = []
+        self.value_direct_cbs = []
+        self.loop = asyncio.get_running_loop()
+        self.restored = asyncio.Queue()
+
+    def build_routes(self):
+        pass
+
+    def get_group_value(self, group, default=None):
+        return self.cache.get(group, default)
+
+    async def set_group_value_dict(self, group_value_dict, process_direct=True):
+        self.restored.put_nowait(json.loads(group_value_dict["probe:restored"]))
+
+def test_worker_plugins_get_the_restored_state(tmp_path, monkeypatch):
+    # the worker imports the probe plugin from the tests
+    monkeypatch.setenv("PYTHONPATH", TESTS)
+    plugin = {"class": "restore_probe", "name": "probe", "enabled": True,
+              "objects": [{"knx_group": "probe:a", "enabled": True}, {"knx_group": "probe:b", "enabled": True}]}
+    cfg_file = tmp_path / "config.json"
+    cfg_file.write_text(json.dumps({"sys": {"verbosity": "info"}, "plugins": [plugin]}))
+
+    async def run():
+        core = FakeCore(str(cfg_file), {"probe:b": "2"})
+        process = PluginProcess(core, plugin)
+        # e.g. the state snapshot, before the worker runs
+        process.restore_state({"probe:a": "1", "other:group": "x"})
+        supervise = asyncio.create_task(process.supervise())
+        try:
+            assert await asyncio.wait_for(core.restored.get(), 10) == {"probe:a": "1", "probe:b": "2"}
+            # e.g. the admin socket's sync, while the worker runs
+            process.restore_state({"probe:a": "3"})
+            assert await asyncio.wait_for(core.restored.get(), 10) == {"probe:a": "3"}
+        finally:
+            await process.stop()
+            supervise.cancel()
+            await asyncio.gather(supervise, return_exceptions=True)
+    asyncio.run(run())
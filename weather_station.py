@@ -19,12 +19,22 @@
 '''
 
 from aiohttp import web
-from helper import BasePlugin, knxalog as log
+from helper import BasePlugin, PluginObject, Deadband, NAN, knxalog as log
 
 def plugin_def():
     return WeatherStation
 
+class WeatherObject(PluginObject):
+    __slots__ = ("sensor", "conversion")
+
+    def __init__(self, cfg, *defaults):
+        super(WeatherObject, self).__init__(cfg, *defaults)
+        self.sensor = cfg["sensor"]
+        self.conversion = WeatherStation.Unit_converter.get(cfg.get("conversion") or "")
+
 class WeatherStation(BasePlugin):
+    object_class = WeatherObject
+
     Unit_converter = {
         "mph_to_kmh": lambda v: (v*1.60934),
         "F_to_C": lambda t: ((t-32) / 1.8),
@@ -37,70 +47,57 @@ class WeatherStation(BasePlugin):
         self.ws_app = None
         self.ws_handler = None
         self.ws_server = None
+        self.deadband = Deadband(self.obj_list, daemon.metrics.counter("knxadapter_hysteresis_suppressed_total", "Values not sent because of hysteresis", plugin=self.device_name))
 
     async def process_values(self, query):
         group_value_dict = {}
-        for obj in self.obj_list:
-            sensor = obj["sensor"]
-            group = obj["knx_group"]
-            debug_msg = "%s->%s" % (sensor, group)
-
-            if sensor in query and obj["enabled"]:
-                try:
-                    value = float(query[sensor])
-                    if value == -9999:
-                        log.debug("bogus value for {}, ignored!".format(debug_msg))
-                        continue
-                    debug_msg += " numeric value: {0:g}".format(value)
-                    conversion = obj["conversion"]
-                    if conversion and conversion in self.Unit_converter:
-                        value = round(self.Unit_converter[conversion](value), 2)
-                        debug_msg += "^={0:g}".format(value)
-
-                    hysteresis = obj["hysteresis"]
-                    prev_val = obj["value"]
-                    if type(hysteresis) == str and "%" in hysteresis and abs(value - prev_val) <= float(hysteresis.strip('%'))*value*0.01 or type(hysteresis) == float and abs(value - prev_val) <= hysteresis:
-                            log.debug("{0}-{1:g} < {2:g} hysteresis, ignored!".
-                                    format(debug_msg, prev_val, hysteresis))
-                            continue
-                    elif prev_val == value:
-                        log.debug("{!r} unchanged, ignored!".format(debug_msg))
-                        continue
-                    group_value_dict[group] = "%.2f" % value
-
-                except ValueError:
-                    value = query[sensor]
-                    debug_msg += " non-numeric value:", value
-                    if group in self.previous_values and value == self.previous_values[group]:
-                        log.debug("{!r} unchanged, ignored!".format(debug_msg))
-                        continue
-                    group_value_dict[group] = value
-
-                obj["value"] = value
-                log.debug(debug_msg)
-
+        values = [NAN] * len(self.obj_list)
+        for i, obj in enumerate(self.obj_list):
+            raw = query.get(obj.sensor)
+            if raw is None:
+                continue
+            try:
+                value = float(raw)
+            except ValueError:
+                if raw == obj.value:
+                    log.debug("%s->%s non-numeric value %r unchanged, ignored!", obj.sensor, obj.knx_group, raw)
+                    continue
+                group_value_dict[obj.knx_group] = raw
+                obj.value = raw
+                continue
+            if value == -9999:
+                log.debug("%s->%s bogus value, ignored!", obj.sensor, obj.knx_group)
+                continue
+            if obj.conversion:
+                value = round(obj.conversion(value), 2)
+            values[i] = value
+
+        group_value_dict.update(self.deadband.evaluate(values))
+        log.debug("%s values %r", self.device_name, group_value_dict)
         if group_value_dict:
             await self.d.set_group_value_dict(group_value_dict)
 
     async def handle(self, request):
-        log.debug("handle: {!r}".format(request.rel_url.query))
+        log.debug("handle: %r", request.rel_url.query)
         await self.process_values(request.rel_url.query)
         return web.Response(text="success\n")
 
-    def run(self):
-        if self.cfg["enabled"]:
-            self.ws_app = web.Application(debug=True)
-            self.ws_app.router.add_get('/weatherstation/{name}', self.handle)
-            self.ws_handler = self.ws_app.make_handler()
-            log.info("running weather station receiver...")
-            ws_coro = self.d.loop.create_server(self.ws_handler, self.d.cfg["sys"]["listenHost"], self.cfg["listenPort"])
-            self.ws_server = self.d.loop.run_until_complete(ws_coro)
-            return None
+    async def connect(self):
+        self.ws_app = web.Application(debug=True)
+        self.ws_app.router.add_get('/weatherstation/{name}', self.handle)
+        self.ws_handler = self.ws_app.make_handler()
+        log.info("running weather station receiver...")
+        self.ws_server = await self.d.loop.create_server(self.ws_handler, self.d.cfg["sys"]["listenHost"], self.cfg["listenPort"])
 
-    def quit(self):
+    async def stop(self):
         if self.ws_server:
             log.info("quit weather station receiver...")
             self.ws_server.close()
-            self.d.loop.run_until_complete(self.ws_app.shutdown())
-            self.d.loop.run_until_complete(self.ws_handler.shutdown(2.0))
-            self.d.loop.run_until_complete(self.ws_app.cleanup())
+            self.ws_server = None
+            await self.ws_app.shutdown()
+            await self.ws_handler.shutdown(2.0)
+            await self.ws_app.cleanup()
+
+    def quit(self):
+        if self.ws_server:
+            self.d.loop.run_until_complete(self.stop())
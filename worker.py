@@ -0,0 +1,312 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+  worker.py is part of knxadapter3.py
+  Copyright (C) 2018-2021 Andreas Frisch <fraxinas@purplegecko.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this program; if not, write to the Free Software
+  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+  USA.
+'''
+
+import os
+import sys
+import json
+import asyncio
+from importlib import import_module
+from helper import setLogLevel, setLogFormat, new_event_loop, knxalog as log
+from metrics import Metrics
+
+# Plugins configured with "process": true run in a worker process of their own.
+# Core and worker exchange one compact JSON object per line over the worker's stdin/stdout:
+#   worker -> core: {"op":"hello","route":bool,"groups":[...]}
+#                   {"op":"set","id":n,"values":{group:value},"direct":bool}
+#                   {"op":"knx_done","id":n,"ok":bool}
+#   core -> worker: {"op":"restore","values":{group:value}}, always the first message, again on a sync
+#                   {"op":"knx","id":n,"cmd":str}
+#                   {"op":"direct","group":str,"value":value}
+#                   {"op":"set_done","id":n,"error":str|null}
+
+def encode(msg):
+    return (json.dumps(msg, separators=(',', ':')) + '\n').encode()
+
+class PluginProcess:
+    """ Stands in for a plugin running in a worker process, forwards inbound commands and
+        direct values to it and relays its group values. Restarts the worker when it dies. """
+
+    def __init__(self, daemon, cfg):
+        self.d = daemon
+        self.cfg = cfg
+        self.device_name = cfg["name"]
+        self.route_by_group = True
+        self._groups = {o["knx_group"] for o in cfg["objects"] if o["enabled"]}
+        self.restart_delay = cfg.get("restart_delay", 5)
+        self._proc = None
+        # group values to seed a worker's plugin with, a restarted worker gets them again
+        self._restore = {}
+        self._pending = {}
+        self._next_id = 0
+        self._quit = False
+        daemon.knx_read_cbs.append(self.process_knx)
+        daemon.value_direct_cbs.append(self.process_direct)
+
+    def knx_groups(self):
+        return self._groups
+
+    async def connect(self):
+        pass
+
+    def _send(self, msg):
+        if self._proc and self._proc.returncode is None:
+            self._proc.stdin.write(encode(msg))
+            return True
+        return False
+
+    async def process_knx(self, cmd):
+        self._next_id += 1
+        msg_id = self._next_id
+        if not self._send({"op": "knx", "id": msg_id, "cmd": cmd}):
+            return True
+        done = self._pending[msg_id] = self.d.loop.create_future()
+        try:
+            return await asyncio.wait_for(done, timeout=self.cfg.get("knx_timeout", 10.0))
+        except asyncio.TimeoutError:
+            log.warning(f"{self.device_name} worker didn't handle {cmd!r} in time")
+            return True
+        finally:
+            self._pending.pop(msg_id, None)
+
+    def restore_state(self, values):
+        """ Forwards the values of the plugin's groups to the worker, or keeps them until it starts """
+        restore = {group: values[group] for group in self._groups if group in values}
+        if restore:
+            self._restore.update(restore)
+            self._send({"op": "restore", "values": restore})
+
+    def _restore_values(self):
+        values = dict(self._restore)
+        for group in self._groups:
+            value = self.d.get_group_value(group)
+            if value is not None:
+                values[group] = value
+        return values
+
+    async def process_direct(self, group, value):
+        self._send({"op": "direct", "group": group, "value": value})
+
+    async def _set_values(self, msg_id, values, direct):
+        error = None
+        try:
+            await self.d.set_group_value_dict(values, direct)
+        except Exception as e:
+            error = repr(e)
+        self._send({"op": "set_done", "id": msg_id, "error": error})
+
+    def _handle_message(self, msg):
+        op = msg["op"]
+        if op == "set":
+            self.d.loop.create_task(self._set_values(msg["id"], msg["values"], msg["direct"]))
+        elif op == "knx_done":
+            done = self._pending.pop(msg["id"], None)
+            if done and not done.done():
+                done.set_result(msg["ok"])
+        elif op == "hello":
+            route, groups = msg["route"], set(msg["groups"])
+            self.route_by_group, self._groups = route, groups
+            self.d.build_routes()
+            log.info(f"{self.device_name} worker process {self._proc.pid} ready")
+
+    async def _handle_worker(self):
+        while True:
+            try:
+                # readline raises ValueError for a line beyond the stream limit
+                line = await self._proc.stdout.readline()
+                if not line:
+                    break
+                self._handle_message(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                # e.g. a stray print or a line cut off in a crash, the channel can't be trusted anymore
+                log.error(f"{self.device_name} worker process sent a malformed message ({e!r}), restarting it")
+                self._proc.kill()
+                break
+
+    async def supervise(self):
+        delay = self.restart_delay
+        while not self._quit:
+            worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+            self._proc = await asyncio.create_subprocess_exec(sys.executable, worker, self.d.cfg_file, self.device_name,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=2**20)
+            self._send({"op": "restore", "values": self._restore_values()})
+            started = self.d.loop.time()
+            await self._handle_worker()
+            code = await self._proc.wait()
+            for done in self._pending.values():
+                if not done.done():
+                    done.set_result(True)
+            if self._quit:
+                break
+            if self.d.loop.time() - started > 60:
+                delay = self.restart_delay
+            log.error(f"{self.device_name} worker process exited with {code}, restarting in {delay} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+    def run(self):
+        if self.cfg["enabled"]:
+            log.info(f"starting worker process for {self.device_name}...")
+            return [self.d.loop.create_task(self.supervise(), name=f"{self.device_name}:supervise")]
+
+    async def stop(self):
+        """ Terminates the worker and waits for it, a reload mustn't leave it driving the device """
+        self.quit()
+        if self._proc and self._proc.returncode is None:
+            try:
+                await asyncio.wait_for(self._proc.wait(), timeout=self.cfg.get("stop_timeout", 5.0))
+            except asyncio.TimeoutError:
+                log.warning(f"{self.device_name} worker process {self._proc.pid} didn't quit, killing it")
+                self._proc.kill()
+                await self._proc.wait()
+
+    def quit(self):
+        self._quit = True
+        if self._proc and self._proc.returncode is None:
+            log.info(f"quit worker process for {self.device_name}...")
+            self._proc.terminate()
+
+class WorkerDaemon:
+    """ What a plugin sees as its daemon inside the worker process """
+
+    def __init__(self, cfg, channel_fd):
+        self.cfg = cfg
+        self.knx_read_cbs = []
+        self.value_direct_cbs = []
+        self.metrics = Metrics(enabled=False)
+        self._channel_fd = channel_fd
+        self._writer = None
+        self._inbox = asyncio.Queue()
+        self._pending = {}
+        self._next_id = 0
+        # only the groups this worker wrote or was sent, the core's cache has the full picture
+        self._group_values = {}
+        self.plugin = None
+        self.loop = new_event_loop(cfg["sys"].get("event_loop"))
+        asyncio.set_event_loop(self.loop)
+
+    async def open_channel(self):
+        self._reader = asyncio.StreamReader(limit=2**20)
+        await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(self._reader), sys.stdin)
+        transport, protocol = await self.loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(self._channel_fd, 'wb'))
+        self._writer = asyncio.StreamWriter(transport, protocol, None, self.loop)
+
+    async def set_group_value_dict(self, group_value_dict, process_direct=True):
+        if not group_value_dict:
+            return
+        self._next_id += 1
+        done = self.loop.create_future()
+        self._pending[self._next_id] = done
+        self._writer.write(encode({"op": "set", "id": self._next_id, "values": group_value_dict, "direct": process_direct}))
+        await self._writer.drain()
+        error = await done
+        if error:
+            raise ConnectionError(f"core couldn't write values: {error}")
+        for group, value in group_value_dict.items():
+            self._group_values[group] = str(value)
+
+    def get_group_value(self, group, default=None):
+        return self._group_values.get(group, default)
+
+    async def handle_core(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                log.info("core process went away, quitting worker")
+                return
+            msg = json.loads(line)
+            if msg["op"] == "set_done":
+                done = self._pending.pop(msg["id"], None)
+                if done and not done.done():
+                    done.set_result(msg["error"])
+            else:
+                self._inbox.put_nowait(msg)
+
+    async def dispatch(self):
+        while True:
+            msg = await self._inbox.get()
+            if msg["op"] == "knx":
+                group, sep, value = msg["cmd"].partition("=")
+                if sep:
+                    self._group_values[group] = value
+                ok = True
+                for callback in self.knx_read_cbs:
+                    ok = await callback(msg["cmd"]) and ok
+                self._writer.write(encode({"op": "knx_done", "id": msg["id"], "ok": ok}))
+            elif msg["op"] == "direct":
+                self._group_values[msg["group"]] = str(msg["value"])
+                for callback in self.value_direct_cbs:
+                    await callback(msg["group"], msg["value"])
+            elif msg["op"] == "restore":
+                self.restore(msg["values"])
+
+    def restore(self, values):
+        self._group_values.update(values)
+        self.plugin.restore_state(values)
+
+    async def receive_restore(self):
+        """ Reads the core's first message, the values to seed the plugin with before it runs """
+        msg = json.loads(await self._reader.readline())
+        if msg["op"] == "restore":
+            self.restore(msg["values"])
+        else:
+            self._inbox.put_nowait(msg)
+
+    def start(self, plugin_config):
+        self.loop.run_until_complete(self.open_channel())
+        plugin_class = import_module(plugin_config["class"]).plugin_def()
+        plugin = self.plugin = plugin_class(self, plugin_config)
+        self.loop.run_until_complete(asyncio.wait_for(self.receive_restore(), timeout=10.0))
+        hello = {"op": "hello", "route": getattr(plugin, "route_by_group", False), "groups": list(plugin.knx_groups())}
+        self._writer.write(encode(hello))
+
+        # the worker ends when the core goes away or the plugin fails, then the core restarts it
+        self.loop.run_until_complete(asyncio.wait_for(plugin.connect(), timeout=plugin_config.get("connect_timeout", 10.0)))
+        tasks = plugin.run() or []
+        self.loop.create_task(self.dispatch())
+        core = self.loop.create_task(self.handle_core())
+        running = {core}
+        if tasks:
+            running.add(asyncio.gather(*tasks))
+        try:
+            while core in running:
+                done, running = self.loop.run_until_complete(asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    task.result()
+        finally:
+            plugin.quit()
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+
+if __name__ == "__main__":
+    cfg_file, name = sys.argv[1], sys.argv[2]
+    with open(cfg_file) as json_data_file:
+        cfg = json.load(json_data_file)
+    setLogLevel(cfg["sys"]["verbosity"])
+    setLogFormat(cfg["sys"].get("log_format"))
+    # stdout is the channel to the core, anything printed by plugins goes to stderr
+    channel_fd = os.dup(1)
+    os.dup2(2, 1)
+    plugin_config = next(p for p in cfg["plugins"] if p["name"] == name)
+    WorkerDaemon(cfg, channel_fd).start(plugin_config)